@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import asyncio
+import getpass
+import os
+import time
+
+import asyncpg
+import nacl.pwhash
+import nacl.secret
+import redis.asyncio
+
+from secure_index import dictionary as zstd_dictionary
+from secure_index import local_mapping
+from secure_index.async_client import AsyncQueryClient
+from secure_index.cache import GroupCache
+from secure_index.client import REWRITE_TABLES
+from secure_index.mapping.heterogeneous import HeterogeneousMapping
+
+
+MAPPINGS = {
+    "heterogeneous": HeterogeneousMapping,
+}
+
+TABLES = {
+    "normal": "wrapped",
+    "mapping": "wrapped_with_mapping",
+    "normalization": "wrapped_with_normalization"
+}
+
+
+async def run(client, queries, concurrency):
+    """Run the queries keeping at most concurrency of them in flight."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def execute(query):
+        async with semaphore:
+            return await client.execute(query)
+
+    return await asyncio.gather(*(execute(query) for query in queries))
+
+
+async def main(args, mapping, box, dictionary, table):
+    script = None
+    if not args.kvstore:
+        # Connect to database
+        engine = await asyncpg.create_pool(args.url,
+                                           max_size=args.concurrency *
+                                           args.partitions)
+    else:
+        # Connect to kv store
+        host, port = args.url.split(":")
+        engine = redis.asyncio.Redis(host=host, port=port)
+        root = os.path.realpath(os.path.join(__file__, "..", ".."))
+        script_path = os.path.join(root, "redis", "indices.lua")
+        with open(script_path) as script_file:
+            script = engine.register_script(script_file.read())
+
+    local = None
+    if args.local_mapping:
+        local = local_mapping.load(local_mapping.path_of(args.input), box)
+
+    cache = GroupCache(int(args.cache * 2**20)) if args.cache else None
+    client = AsyncQueryClient(mapping,
+                              box,
+                              engine,
+                              representation=args.representation,
+                              serialization=args.serialization,
+                              compression=args.compression,
+                              script=script,
+                              cache=cache,
+                              dictionary=dictionary,
+                              postings=args.postings,
+                              range_cover=args.range_cover,
+                              partitions=args.partitions,
+                              local_mapping=local,
+                              complement=args.complement)
+
+    queries = [
+        f"SELECT * FROM {table} WHERE \"AGE\" = 18",
+        f"SELECT \"AGE\", \"STATEFIP\", \"OCC\" FROM {table}" +
+            " WHERE \"AGE\"<=18",
+        f"SELECT COUNT(*) FROM \"{table}\" WHERE 18 >= \"AGE\"",
+        f"SELECT COUNT(*) FROM \"{table}\"" +
+            " WHERE \"AGE\"<=18 AND \"STATEFIP\"=55",
+        f"SELECT COUNT(*) FROM {table} WHERE \"AGE\" <20 GROUP BY \"AGE\"",
+    ] * args.repeat
+
+    print(f"[*] Run {len(queries)} queries, {args.concurrency} at a time")
+    start = time.perf_counter()
+    results = await run(client, queries, args.concurrency)
+    elapsed = time.perf_counter() - start
+    print(f"[*] {len(results)} queries in {elapsed:.3f} s " +
+          f"({len(results) / elapsed:.1f} queries/s)")
+
+    await engine.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run concurrent queries against the database hosting ' +
+                    'the wrapped dataset using the given mapping.'
+    )
+    parser.add_argument('input', metavar='INPUT', help='path to the mapping')
+    parser.add_argument('url', metavar='URL',
+                        help='URL of the database (postgresql://...) or the '
+                             'kv store (host:port) where the dataset is '
+                             'stored')
+    parser.add_argument('--cache',
+                        metavar='MB',
+                        type=float,
+                        help='memory budget of the client-side cache of '
+                             'decrypted groups in MB (disabled by default)')
+    parser.add_argument('--complement',
+                        metavar='SHARE',
+                        type=float,
+                        help='rewrite the conditions selecting more than the '
+                             'given share of the tokens of a column (e.g., '
+                             '0.5) to the tokens they exclude, or drop them '
+                             'when they exclude almost none (DBMS only)')
+    parser.add_argument('-c',
+                        '--compression',
+                        metavar='ALGORITHM',
+                        choices=['none', 'lz4', 'snappy', 'zstd', 'zstd-dict'],
+                        default='zstd',
+                        help='compression algorithm: none, lz4, snappy, zstd '
+                             '(default), zstd-dict (trained dictionary)')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=16,
+                        help='maximum number of queries in flight (default: '
+                             '16)')
+    parser.add_argument('-k',
+                        '--kvstore',
+                        dest='kvstore',
+                        action='store_true',
+                        help='prepare the files with the kv-store as the '
+                             'target')
+    parser.add_argument('--local-mapping',
+                        action='store_true',
+                        help='resolve the conditions to GroupIds with the '
+                             'encrypted copy of the mapping table stored by '
+                             'wrap.py -m, so that the server only looks up '
+                             'the groups by GroupId (mapping representation)')
+    parser.add_argument('--partitions',
+                        type=int,
+                        default=1,
+                        help='number of partitions of a partitioned table '
+                             'queried concurrently (default: 1)')
+    parser.add_argument('--password',
+                        help='password necessary to read the mapping')
+    parser.add_argument('--postings',
+                        metavar='MODE',
+                        choices=['auto', 'lua', 'roaring'],
+                        default='lua',
+                        help='evaluation of the posting lists of the kv '
+                             'store: auto, lua (default, server-side script), '
+                             'roaring (client-side bitmaps)')
+    parser.add_argument('--range-cover',
+                        action='store_true',
+                        help='request the nodes of the range covers stored '
+                             'by wrap.py --range-cover instead of a label per '
+                             'generalization of the range columns')
+    parser.add_argument('-r',
+                        '--representation',
+                        metavar='REPRESENTATION',
+                        default='normal',
+                        help='server-side representation of the dataset: '
+                             'normal (default), mapping, normalization')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=10,
+                        help='number of times each test query is run '
+                             '(default: 10)')
+    parser.add_argument('-s',
+                        '--serialization',
+                        metavar='FORMAT',
+                        choices=['columnar', 'json', 'msgpack', 'pickle'],
+                        default='json',
+                        help='serialization format: columnar, json (default), '
+                             'msgpack, pickle')
+    parser.add_argument('-t',
+                        '--type',
+                        metavar='TYPE',
+                        default='heterogeneous',
+                        help='type of mapping: heterogeneous (default)')
+
+    args = parser.parse_args()
+    pw = args.password.encode("utf-8") if args.password else None
+
+    if args.type not in MAPPINGS:
+        parser.error(f"{args.type} is not a valid mapping type.")
+
+    if args.representation not in REWRITE_TABLES:
+        parser.error(
+            f"{args.representation} is not a valid server-side " +
+            "representation of the dataset."
+        )
+
+    table = TABLES[args.representation]
+
+    if not pw:
+        pw = getpass.getpass("Password: ").encode("utf-8")
+    salt = b'\xd0\xe1\x03\xc2Z<R\xaf]\xfe\xd5\xbf\xf8u|\x8f'
+    # Generate the key
+    kdf = nacl.pwhash.argon2id.kdf
+    key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
+    box = nacl.secret.SecretBox(key)
+
+    mapping = MAPPINGS[args.type](args.input, key)
+
+    dictionary = None
+    if args.compression == "zstd-dict":
+        dictionary = zstd_dictionary.load(zstd_dictionary.path_of(args.input), box)
+
+    asyncio.run(main(args, mapping, box, dictionary, table))
@@ -16,31 +16,21 @@
 
 import argparse
 import getpass
-import json
 import os
-import pickle
-import sqlite3
-import sys
-from functools import partial
 
-import lz4.frame
-import msgpack
 import nacl.pwhash
 import nacl.secret
-import pandas as pd
-import snappy
 import sqlalchemy
 import redis
-import zstd
 
+from secure_index import dictionary as zstd_dictionary
+from secure_index import local_mapping
+from secure_index.cache import GroupCache
+from secure_index.client import QueryClient
+from secure_index.client import REWRITE_TABLES
 from secure_index.mapping.heterogeneous import HeterogeneousMapping
-from secure_index.rewriting import rewrite
-from secure_index.rewriting import rewrite_table_with_mapping
-from secure_index.rewriting import rewrite_table_with_normalization
 
 
-CHUNK_SIZE= 10000
-
 MAPPINGS = {
     "heterogeneous": HeterogeneousMapping,
 }
@@ -51,106 +41,17 @@ TABLES = {
     "normalization": "wrapped_with_normalization"
 }
 
-REWRITE_TABLES = {
-    "normal": None,
-    "mapping": rewrite_table_with_mapping,
-    "normalization": rewrite_table_with_normalization
-}
-
-DESERIALIZE = {
-    "json": lambda bytes: json.loads(bytes.decode("utf-8")),
-    "pickle": pickle.loads,
-    "msgpack": msgpack.loads
-}
-
-DECOMPRESS = {
-    "none": lambda bytes: bytes,
-    "lz4": lz4.frame.decompress,
-    "snappy": snappy.decompress,
-    "zstd": zstd.decompress
-}
-
 
 def test(query):
     print(f"\n[*] {query}")
-    result = execute(query, mapping, rewrite_table, box)
-    print("\n", result, sep="")
-
-
-def execute(query, mapping, rewrite_table, box):
-
-    # Rewrite query so that it may be run on the server
-    rewritten, table = rewrite(query,
-                               mapping,
-                               rewrite_table=rewrite_table,
-                               kv_store_mode=kvstore)
-
+    rewritten, _ = client.rewrite(query)
     print("\n", rewritten, sep="")
-
-    tuples = []
-    if not kvstore:
-        # Execute rewritten query on the server
-        result = engine.execute(rewritten)
-        rows = result.fetchall()
-
-        # Decrypt the encrypted tuples
-        for row in rows:
-            tuples.extend(decrypt(row[0]))
+    if args.stream:
+        for batch in client.stream(query, chunk_size=args.stream):
+            print("\n", batch, sep="")
     else:
-        # Execute query on the key-value store
-        kv_store_data = rewritten
-        if kv_store_data:
-            # Query key-value store
-            if "GroupId" in kv_store_data and len(kv_store_data) == 1:
-                pipe = engine.pipeline(transaction=False)
-                gids = list(kv_store_data["GroupId"])
-                for i in range(0, len(gids), CHUNK_SIZE):
-                    #pipe.mget(gids[i:i + CHUNK_SIZE])
-                    pipe.hmget(table, gids[i:i + CHUNK_SIZE])
-                rows = [row for rows in pipe.execute() for row in rows]
-                assert len(rows) == len(gids)
-            else:
-                # Forse GroupId as the first column (when present)
-                columns = ["GroupId"] if "GroupId" in kv_store_data else []
-                for column in kv_store_data:
-                    if column != "GroupId":
-                        columns.append(column)
-                # Query key-value store using indices
-                rows = script(keys=[column for column in columns],
-                              args=[
-                                  ",".join(map(str, kv_store_data[column]))
-                                  for column in columns
-                              ])
-
-            # Decrypt the encrypted tuples
-            for row in rows:
-                tuples.extend(decrypt(row))
-
-    df = pd.DataFrame(tuples, columns=mapping.schema)
-
-    with sqlite3.connect(':memory:') as conn:
-        # Store plaintext tuples in local cache
-        df.to_sql(table, conn, if_exists='replace', index=False,
-                  method='multi', chunksize=10000)
-
-        # Run original query on the local cache
-        cursor = conn.cursor()
-        cursor.execute(query)
-        columns = [description[0] for description in cursor.description]
-        return pd.DataFrame(cursor.fetchall(), columns=columns)
-
-
-def decrypt(row):
-    bstring = bytes(row) if not kvstore else row
-    try:
-        plaintext = box.decrypt(bstring)
-    except nacl.exceptions.CryptoError:
-        print("ERROR: Something has gone wrong with the decryption of the",
-                "tuples.")
-        sys.exit()
-    lpadding = int.from_bytes(plaintext[:2], byteorder='little', signed=False)
-    compressed = plaintext[2:-lpadding] if lpadding else plaintext[2:]
-    return deserialize(decompress(compressed))
+        result = client.execute(query)
+        print("\n", result, sep="")
 
 
 if __name__ == '__main__':
@@ -162,21 +63,56 @@ if __name__ == '__main__':
     parser.add_argument('url', metavar='URL',
                         help='URL of the database or the kv store where the '
                              'dataset is stored')
+    parser.add_argument('--cache',
+                        metavar='MB',
+                        type=float,
+                        help='memory budget of the client-side cache of '
+                             'decrypted groups in MB (disabled by default)')
+    parser.add_argument('--complement',
+                        metavar='SHARE',
+                        type=float,
+                        help='rewrite the conditions selecting more than the '
+                             'given share of the tokens of a column (e.g., '
+                             '0.5) to the tokens they exclude, or drop them '
+                             'when they exclude almost none (DBMS only)')
     parser.add_argument('-c',
                         '--compression',
                         metavar='ALGORITHM',
-                        choices=['none', 'lz4', 'snappy', 'zstd'],
+                        choices=['none', 'lz4', 'snappy', 'zstd', 'zstd-dict'],
                         default='zstd',
                         help='compression algorithm: none, lz4, snappy, zstd '
-                             '(default)')
+                             '(default), zstd-dict (trained dictionary)')
     parser.add_argument('-k',
                         '--kvstore',
                         dest='kvstore',
                         action='store_true',
                         help='prepare the files with the kv-store as the '
                              'target')
+    parser.add_argument('--local-mapping',
+                        action='store_true',
+                        help='resolve the conditions to GroupIds with the '
+                             'encrypted copy of the mapping table stored by '
+                             'wrap.py -m, so that the server only looks up '
+                             'the groups by GroupId (mapping representation)')
+    parser.add_argument('--partitions',
+                        type=int,
+                        default=1,
+                        help='number of partitions of a partitioned table '
+                             'queried concurrently (default: 1)')
     parser.add_argument('--password',
                         help='password necessary to read the mapping')
+    parser.add_argument('--postings',
+                        metavar='MODE',
+                        choices=['auto', 'lua', 'roaring'],
+                        default='lua',
+                        help='evaluation of the posting lists of the kv '
+                             'store: auto, lua (default, server-side script), '
+                             'roaring (client-side bitmaps)')
+    parser.add_argument('--range-cover',
+                        action='store_true',
+                        help='request the nodes of the range covers stored '
+                             'by wrap.py --range-cover instead of a label per '
+                             'generalization of the range columns')
     parser.add_argument('-r',
                         '--representation',
                         metavar='REPRESENTATION',
@@ -186,15 +122,27 @@ if __name__ == '__main__':
     parser.add_argument('-s',
                         '--serialization',
                         metavar='FORMAT',
-                        choices=['json', 'msgpack', 'pickle'],
+                        choices=['columnar', 'json', 'msgpack', 'pickle'],
                         default='json',
-                        help='serialization format: json (default), msgpack, '
-                             'pickle')
+                        help='serialization format: columnar, json (default), '
+                             'msgpack, pickle')
+    parser.add_argument('--stream',
+                        metavar='GROUPS',
+                        type=int,
+                        help='fetch, decrypt and filter the groups in chunks '
+                             'of the given size printing the result batch by '
+                             'batch (disabled by default)')
     parser.add_argument('-t',
                         '--type',
                         metavar='TYPE',
                         default='heterogeneous',
                         help='type of mapping: heterogeneous (default)')
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=1,
+                        help='number of threads decrypting, decompressing '
+                             'and deserializing the groups (default: 1)')
 
     args = parser.parse_args()
     path = args.input
@@ -203,8 +151,6 @@ if __name__ == '__main__':
     repr = args.representation
     kvstore = args.kvstore
     pw = args.password.encode("utf-8") if args.password else None
-    deserialize = DESERIALIZE[args.serialization]
-    decompress = DECOMPRESS[args.compression]
 
     if type not in MAPPINGS:
         parser.error(f"{type} is not a valid mapping type.")
@@ -215,7 +161,6 @@ if __name__ == '__main__':
         )
 
     table = TABLES[repr]
-    rewrite_table = REWRITE_TABLES[repr]
 
     if not pw:
         pw = getpass.getpass("Password: ").encode("utf-8")
@@ -227,10 +172,16 @@ if __name__ == '__main__':
 
     mapping = MAPPINGS[type](path, key)
 
+    dictionary = None
+    if args.compression == "zstd-dict":
+        dictionary = zstd_dictionary.load(zstd_dictionary.path_of(path), box)
+
     # retrieve the proper target
+    script = None
     if not kvstore:
         # Connect to database
-        engine = sqlalchemy.create_engine(url)
+        engine = sqlalchemy.create_engine(url,
+                                          pool_size=max(5, args.partitions))
     else:
         # Connect to kv store
         host, port = url.split(":")
@@ -240,6 +191,27 @@ if __name__ == '__main__':
         with open(script_path) as script_file:
             script = engine.register_script(script_file.read())
 
+    local = None
+    if args.local_mapping:
+        local = local_mapping.load(local_mapping.path_of(path), box)
+
+    cache = GroupCache(int(args.cache * 2**20)) if args.cache else None
+    client = QueryClient(mapping,
+                         box,
+                         engine,
+                         representation=repr,
+                         serialization=args.serialization,
+                         compression=args.compression,
+                         script=script,
+                         cache=cache,
+                         dictionary=dictionary,
+                         postings=args.postings,
+                         range_cover=args.range_cover,
+                         partitions=args.partitions,
+                         local_mapping=local,
+                         complement=args.complement,
+                         workers=args.workers)
+
     print("[*] Run some test query")
     test(f"SELECT * FROM {table}")
     test(f"SELECT * FROM {table} WHERE {table}.\"AGE\" = 18")
@@ -254,5 +226,19 @@ if __name__ == '__main__':
     test(f"SELECT COUNT(*) FROM {table} WHERE 20>\"AGE\"" +
             " GROUP BY \"AGE\" HAVING COUNT(*) > 10")
     test(f"SELECT COUNT(*) FROM {table} WHERE 90< \"AGE\" ORDER BY \"AGE\"")
+    test(f"SELECT * FROM {table} WHERE \"AGE\" > 18 LIMIT 10 OFFSET 5")
     # test(f"SELECT * FROM {table} WHERE \"AGE\" IN (18, 30, 95)")
     # test(f"SELECT * FROM {table} WHERE \"AGE\" BETWEEN 18 AND 20")
+    test(f"SELECT * FROM {table} WHERE \"AGE\" = 18")
+
+    client.close()
+
+    print("\n[*] Stage statistics")
+    for stage, stats in client.metrics.stats().items():
+        print(f"{stage}: {stats['items']} items in {stats['seconds']:.3f} s "
+              f"({stats['items/s']:.0f} items/s, {stats['MB/s']:.2f} MB/s)")
+
+    if cache is not None:
+        print("\n[*] Cache statistics")
+        for name, value in cache.stats().items():
+            print(f"{name}: {value}")
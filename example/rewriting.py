@@ -24,6 +24,7 @@ import nacl.secret
 from secure_index.mapping.heterogeneous import HeterogeneousMapping
 from secure_index.rewriting import rewrite
 from secure_index.rewriting import rewrite_comparisons
+from secure_index.rewriting import rewrite_table_with_joins
 from secure_index.rewriting import rewrite_table_with_mapping
 from secure_index.rewriting import rewrite_table_with_normalization
 
@@ -35,7 +36,8 @@ MAPPINGS = {
 REWRITE_TABLES = {
     "normal": None,
     "mapping": rewrite_table_with_mapping,
-    "normalization": rewrite_table_with_normalization
+    "normalization": rewrite_table_with_normalization,
+    "normalization-joins": rewrite_table_with_joins
 }
 
 
@@ -64,7 +66,9 @@ parser.add_argument('-r',
                     '--representation',
                     metavar='REPRESENTATION',
                     help='server-side representation of the dataset: normal ' +
-                         '(default), mapping, normalization')
+                         '(default), mapping, normalization, ' +
+                         'normalization-joins (joining the normalized tables ' +
+                         'before filtering them)')
 args = parser.parse_args()
 path = args.mapping
 to_enc = args.to_enc
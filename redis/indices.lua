@@ -1,79 +1,96 @@
-local split = function (s, delimiter)
-    local result = {}
-    for match in (s..delimiter):gmatch("(.-)"..delimiter) do
-        table.insert(result, match)
-    end
-    return result
-end
-
-local concat = function (t1, t2)
-    if type(t2) ~= "table" then
-        table.insert(t1, t2)
-    else
-        for k,v in ipairs(t2) do
-            table.insert(t1, v)
-        end
-    end
-    return t1
-end
+-- Retrieve the encrypted tuples of the groups matching all the columns.
+--
+-- KEYS[1]: name of the hash holding the encrypted tuples
+-- KEYS[2..]: columns to intersect (GroupId first, when present)
+-- ARGV[i]: msgpack array with the labels of the column KEYS[i + 1]
+-- ARGV[#KEYS]: msgpack array with the group ids the client already holds
+--              (optional)
+-- ARGV[#KEYS + 1]: "1" to return only the group ids (optional)
+--
+-- The script does not write any key: unions and intersections are computed
+-- in Lua tables, so concurrent invocations never interfere.
 
 local chunk_size = 7000
 
 local execute_redis_command_in_chunks = function (command, args)
     local results = {}
-    local chunk_result = {}
-    if #command == 1 then
-        for i = 1, #args, chunk_size do
-            chunk_result = redis.call(command[1],
-                                      unpack(args, i, math.min(i + chunk_size - 1, #args)))
-            results = concat(results, chunk_result)
+    for i = 1, #args, chunk_size do
+        local chunk_args = {unpack(command)}
+        for j = i, math.min(i + chunk_size - 1, #args) do
+            table.insert(chunk_args, args[j])
         end
-    elseif #command == 2 then
-        for i = 1, #args, chunk_size do
-            chunk_result = redis.call(command[1], command[2],
-                                      unpack(args, i, math.min(i + chunk_size - 1, #args)))
-            results = concat(results, chunk_result)
-        end
-    elseif #command == 3 then
-        for i = 1, #args, chunk_size do
-            chunk_result = redis.call(command[1], command[2], command[3],
-                                      unpack(args, i, math.min(i + chunk_size - 1, #args)))
-            results = concat(results, chunk_result)
+        local chunk_result = redis.call(unpack(chunk_args))
+        for _, value in ipairs(chunk_result) do
+            table.insert(results, value)
         end
     end
     return results
 end
 
-redis.call("DEL", "tmp", "other_tmp")
-for i, column in ipairs(KEYS) do
-    local labels = split(ARGV[i], ",")
-    if i == 1 then
-        -- Initialize temporary set with group ids
-        local group_ids
-        if column == "GroupId" then
-            group_ids = labels
-            execute_redis_command_in_chunks({"SADD", "tmp"}, group_ids)
-        else
-            -- Recover group ids associated with the secondary index
-            local set_keys = {}
-            for i, label in ipairs(labels) do
-                set_keys[i] = column .. ":" .. label
-            end
-            execute_redis_command_in_chunks({"SUNIONSTORE", "tmp", "tmp"}, set_keys)
-        end
+local hash = KEYS[1]
+
+-- Set of group ids matching the columns processed so far
+local group_ids = nil
+for i = 2, #KEYS do
+    local column = KEYS[i]
+    local labels = cmsgpack.unpack(ARGV[i - 1])
+    local members
+    if column == "GroupId" then
+        members = labels
     else
         -- Recover group ids associated with the secondary index
         local set_keys = {}
-        for i, label in ipairs(labels) do
-            set_keys[i] = column .. ":" .. label
+        for j, label in ipairs(labels) do
+            set_keys[j] = column .. ":" .. label
+        end
+        members = execute_redis_command_in_chunks({"SUNION"}, set_keys)
+    end
+
+    -- Keep only those group ids belonging to the intersection
+    local matching = {}
+    for _, gid in ipairs(members) do
+        if group_ids == nil or group_ids[gid] then
+            matching[gid] = true
         end
-        execute_redis_command_in_chunks({"SUNIONSTORE", "other_tmp", "other_tmp"}, set_keys)
-        -- Keep only those group ids belonging to the intersection
-        redis.call("SINTERSTORE", "tmp", "tmp", "other_tmp")
     end
+    group_ids = matching
 end
 
-local intersection = redis.call("SMEMBERS", "tmp")
-local enc_tuples = execute_redis_command_in_chunks({"HMGET", "wrapped_with_mapping"},
-                                                   intersection)
-return enc_tuples
+local intersection = {}
+for gid in pairs(group_ids or {}) do
+    table.insert(intersection, gid)
+end
+
+-- Let the client fetch the encrypted tuples (optional argument)
+if ARGV[#KEYS + 1] == "1" then
+    return {intersection, {}}
+end
+
+-- Skip group ids the client already holds (optional argument)
+local cached = {}
+if ARGV[#KEYS] ~= nil then
+    for _, gid in ipairs(cmsgpack.unpack(ARGV[#KEYS])) do
+        cached[gid] = true
+    end
+end
+
+local to_fetch = {}
+for _, gid in ipairs(intersection) do
+    if not cached[gid] then
+        table.insert(to_fetch, gid)
+    end
+end
+local fetched = execute_redis_command_in_chunks({"HMGET", hash}, to_fetch)
+
+-- Return group ids with their encrypted tuples (false when cached)
+local enc_tuples = {}
+local j = 1
+for i, gid in ipairs(intersection) do
+    if cached[gid] then
+        enc_tuples[i] = false
+    else
+        enc_tuples[i] = fetched[j]
+        j = j + 1
+    end
+end
+return {intersection, enc_tuples}
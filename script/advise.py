@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import getpass
+
+import nacl.pwhash
+import nacl.secret
+import pandas as pd
+from sqlalchemy import create_engine
+
+from secure_index import cover
+from secure_index.advisor import advise
+from secure_index.advisor import apply
+from secure_index.advisor import index_statement
+from secure_index.complement import Complement
+from secure_index.client import REWRITE_TABLES
+from secure_index.layout import report
+from secure_index.mapping.heterogeneous import HeterogeneousMapping
+from secure_index.metrics import StageMetrics
+from secure_index.rewriting import rewrite
+
+
+MAPPINGS = {
+    "heterogeneous": HeterogeneousMapping,
+}
+
+TABLES = {
+    "normal": "wrapped",
+    "mapping": "wrapped_with_mapping",
+    "normalization": "wrapped_with_normalization"
+}
+
+# Tables holding the token columns of each representation
+TUNED_TABLES = {
+    "normal": ["wrapped"],
+    "mapping": ["mapping"],
+    "normalization": ["GroupIdToColumns"],
+}
+
+
+parser = argparse.ArgumentParser(
+    description='Select the indexes of the uploaded tables minimizing the ' +
+                'latency of the given query log.'
+)
+parser.add_argument('input', metavar='INPUT', help='path to the mapping')
+parser.add_argument('url', metavar='URL',
+                    help='URL of the database where the dataset is stored')
+parser.add_argument('workload',
+                    metavar='LOG',
+                    nargs='+',
+                    help='query logs (CSV files with a query column, where '
+                         '<TABLE> stands for the wrapped table)')
+parser.add_argument('--apply',
+                    action='store_true',
+                    help='replace the secondary indexes of the tables with '
+                         'the selected ones (by default only print them)')
+parser.add_argument('--complement',
+                    metavar='SHARE',
+                    type=float,
+                    help='rewrite the conditions selecting more than the '
+                         'given share of the tokens of a column to the tokens '
+                         'they exclude, as the clients run with --complement')
+parser.add_argument('--io-report',
+                    action='store_true',
+                    help='instead of selecting indexes, report the heap pages '
+                         'the queries read compared to the groups scattered '
+                         'over the table (e.g., to measure wrap.py '
+                         '--cluster-by)')
+parser.add_argument('-j',
+                    '--jobs',
+                    metavar='JOBS',
+                    type=int,
+                    default=4,
+                    help='number of parallel connections building the '
+                         'indexes (default: 4)')
+parser.add_argument('--max-indexes',
+                    metavar='N',
+                    type=int,
+                    help='maximum number of indexes to select (no limit by '
+                         'default)')
+parser.add_argument('--password',
+                    help='password necessary to read the mapping')
+parser.add_argument('-r',
+                    '--representation',
+                    metavar='REPRESENTATION',
+                    default='normal',
+                    help='server-side representation of the dataset: '
+                         'normal (default), mapping, normalization')
+parser.add_argument('--range-cover',
+                    action='store_true',
+                    help='rewrite range queries with the range covers stored '
+                         'by wrap.py --range-cover')
+parser.add_argument('--repeat',
+                    type=int,
+                    default=1,
+                    help='times each query is replayed for every '
+                         'configuration (default: 1)')
+parser.add_argument('--sample',
+                    metavar='QUERIES',
+                    type=int,
+                    default=100,
+                    help='number of queries sampled from each log (default: '
+                         '100)')
+parser.add_argument('--tables',
+                    metavar='TABLE',
+                    nargs='+',
+                    help='tables whose indexes to select (default: those '
+                         'holding the token columns of the representation)')
+parser.add_argument('--threshold',
+                    type=float,
+                    default=0.05,
+                    help='minimum relative improvement of the latency to '
+                         'keep an index (default: 0.05)')
+parser.add_argument('-t',
+                    '--type',
+                    metavar='TYPE',
+                    default='heterogeneous',
+                    help='type of mapping: heterogeneous (default)')
+
+args = parser.parse_args()
+pw = args.password.encode("utf-8") if args.password else None
+
+if args.type not in MAPPINGS:
+    parser.error(f"{args.type} is not a valid mapping type.")
+
+if args.representation not in REWRITE_TABLES:
+    parser.error(
+        f"{args.representation} is not a valid server-side " +
+        "representation of the dataset."
+    )
+
+if not pw:
+    pw = getpass.getpass("Password: ").encode("utf-8")
+salt = b'\xd0\xe1\x03\xc2Z<R\xaf]\xfe\xd5\xbf\xf8u|\x8f'
+# Generate the key
+kdf = nacl.pwhash.argon2id.kdf
+key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
+
+mapping = MAPPINGS[args.type](args.input, key)
+covers = cover.build(mapping) if args.range_cover else None
+complement = Complement.of(mapping, args.complement) \
+    if args.complement is not None else None
+table = TABLES[args.representation]
+tables = args.tables or TUNED_TABLES[args.representation]
+
+print("[*] Rewrite the query logs")
+queries = []
+skipped = 0
+for path in args.workload:
+    df = pd.read_csv(path)
+    if len(df.index) > args.sample:
+        df = df.sample(args.sample, random_state=0)
+    for query in df["query"]:
+        try:
+            rewritten, _ = rewrite(
+                query.replace("<TABLE>", table),
+                mapping,
+                rewrite_table=REWRITE_TABLES[args.representation],
+                covers=covers,
+                complement=complement)
+        except Exception:
+            skipped += 1
+            continue
+        queries.append(rewritten)
+print(f"Rewritten queries: \t {len(queries)} ({skipped} not supported)")
+if not queries:
+    parser.error("no query of the logs can be rewritten.")
+
+
+if args.io_report:
+    print(f"[*] Count the pages of {table} the queries read")
+    engine = create_engine(args.url)
+    pages = report(engine, table, queries)
+    read = sum(query.pages for query in pages)
+    scattered = sum(query.scattered for query in pages)
+    print(f"Rows read: \t\t {sum(query.rows for query in pages)}")
+    print(f"Pages read: \t\t {read}")
+    print(f"Pages if scattered: \t {scattered:.0f}")
+    print("I/O reduction: \t\t {:10.3f}x".format(
+        scattered / max(read, 1)))
+    parser.exit()
+
+
+def log(latency, index):
+    if index is None:
+        print("Baseline latency: \t {:10.3f}ms".format(latency))
+    else:
+        print("Latency: \t\t {:10.3f}ms with {}".format(
+            latency, index_statement(index)))
+
+
+print(f"[*] Replay the queries against a scratch copy of {', '.join(tables)}")
+engine = create_engine(args.url, pool_size=args.jobs)
+indexes, baseline, latency = advise(engine,
+                                    tables,
+                                    queries,
+                                    max_indexes=args.max_indexes,
+                                    threshold=args.threshold,
+                                    repeat=args.repeat,
+                                    log=log)
+print(f"Selected indexes: \t {len(indexes)}")
+print("Speedup: \t\t {:10.3f}x".format(baseline / max(latency, 1e-9)))
+
+if not args.apply:
+    for index in indexes:
+        print(index_statement(index) + ";")
+else:
+    print(f"[*] Replace the secondary indexes of {', '.join(tables)}")
+    metrics = StageMetrics()
+    dropped = apply(engine,
+                    tables,
+                    indexes,
+                    connections=args.jobs,
+                    metrics=metrics)
+    for name in dropped:
+        print(f"Dropped: \t\t {name}")
+    for index in indexes:
+        print(f"Created: \t\t {index_statement(index)}")
+    if indexes:
+        print("Indexing: \t\t {:10.3f}s".format(
+            metrics.stats()["index"]["seconds"]))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import getpass
+import os
+
+import nacl.pwhash
+import nacl.secret
+import sqlalchemy
+import redis
+
+from secure_index import dictionary as zstd_dictionary
+from secure_index import local_mapping
+from secure_index.cache import GroupCache
+from secure_index.client import QueryClient
+from secure_index.client import REWRITE_TABLES
+from secure_index.mapping.heterogeneous import HeterogeneousMapping
+from secure_index.mapping.shared import SharedMapping
+from secure_index.service import QueryServer
+from secure_index.service import UnixQueryServer
+
+
+MAPPINGS = {
+    "heterogeneous": HeterogeneousMapping,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve plaintext queries against the database hosting ' +
+                    'the wrapped dataset, keeping the mapping, the key, the ' +
+                    'connections and the cache in memory.'
+    )
+    parser.add_argument('input', metavar='INPUT', help='path to the mapping')
+    parser.add_argument('url', metavar='URL',
+                        help='URL of the database or the kv store where the '
+                             'dataset is stored')
+    parser.add_argument('--cache',
+                        metavar='MB',
+                        type=float,
+                        help='memory budget of the client-side cache of '
+                             'decrypted groups in MB (disabled by default)')
+    parser.add_argument('--complement',
+                        metavar='SHARE',
+                        type=float,
+                        help='rewrite the conditions selecting more than the '
+                             'given share of the tokens of a column (e.g., '
+                             '0.5) to the tokens they exclude, or drop them '
+                             'when they exclude almost none (DBMS only)')
+    parser.add_argument('-c',
+                        '--compression',
+                        metavar='ALGORITHM',
+                        choices=['none', 'lz4', 'snappy', 'zstd', 'zstd-dict'],
+                        default='zstd',
+                        help='compression algorithm: none, lz4, snappy, zstd '
+                             '(default), zstd-dict (trained dictionary)')
+    parser.add_argument('--host',
+                        default='127.0.0.1',
+                        help='address the service listens on (default: '
+                             '127.0.0.1)')
+    parser.add_argument('-k',
+                        '--kvstore',
+                        dest='kvstore',
+                        action='store_true',
+                        help='prepare the files with the kv-store as the '
+                             'target')
+    parser.add_argument('--local-mapping',
+                        action='store_true',
+                        help='resolve the conditions to GroupIds with the '
+                             'encrypted copy of the mapping table stored by '
+                             'wrap.py -m, so that the server only looks up '
+                             'the groups by GroupId (mapping representation)')
+    parser.add_argument('--partitions',
+                        type=int,
+                        default=1,
+                        help='number of partitions of a partitioned table '
+                             'queried concurrently (default: 1)')
+    parser.add_argument('--password',
+                        help='password necessary to read the mapping')
+    parser.add_argument('-p',
+                        '--port',
+                        type=int,
+                        default=8000,
+                        help='port the service listens on (default: 8000)')
+    parser.add_argument('--pool-size',
+                        type=int,
+                        default=8,
+                        help='number of connections kept open to the '
+                             'database (default: 8)')
+    parser.add_argument('--postings',
+                        metavar='MODE',
+                        choices=['auto', 'lua', 'roaring'],
+                        default='lua',
+                        help='evaluation of the posting lists of the kv '
+                             'store: auto, lua (default, server-side script), '
+                             'roaring (client-side bitmaps)')
+    parser.add_argument('--range-cover',
+                        action='store_true',
+                        help='request the nodes of the range covers stored '
+                             'by wrap.py --range-cover instead of a label per '
+                             'generalization of the range columns')
+    parser.add_argument('-r',
+                        '--representation',
+                        metavar='REPRESENTATION',
+                        default='normal',
+                        help='server-side representation of the dataset: '
+                             'normal (default), mapping, normalization')
+    parser.add_argument('-s',
+                        '--serialization',
+                        metavar='FORMAT',
+                        choices=['columnar', 'json', 'msgpack', 'pickle'],
+                        default='json',
+                        help='serialization format: columnar, json (default), '
+                             'msgpack, pickle')
+    parser.add_argument('--shared-mapping',
+                        action='store_true',
+                        help='pack the mapping into one immutable buffer '
+                             'in a shared memory map: the threads of the '
+                             'service share it, and pre-fork workers forked '
+                             'afterwards would inherit it without copying '
+                             'its pages')
+    parser.add_argument('--socket',
+                        metavar='PATH',
+                        help='listen on the given Unix socket instead of TCP')
+    parser.add_argument('-t',
+                        '--type',
+                        metavar='TYPE',
+                        default='heterogeneous',
+                        help='type of mapping: heterogeneous (default)')
+    parser.add_argument('-v',
+                        '--verbose',
+                        action='store_true',
+                        help='log the requests')
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=1,
+                        help='number of threads decrypting, decompressing '
+                             'and deserializing the groups (default: 1)')
+
+    args = parser.parse_args()
+    pw = args.password.encode("utf-8") if args.password else None
+
+    if args.type not in MAPPINGS:
+        parser.error(f"{args.type} is not a valid mapping type.")
+
+    if args.representation not in REWRITE_TABLES:
+        parser.error(
+            f"{args.representation} is not a valid server-side " +
+            "representation of the dataset."
+        )
+
+    if not pw:
+        pw = getpass.getpass("Password: ").encode("utf-8")
+    salt = b'\xd0\xe1\x03\xc2Z<R\xaf]\xfe\xd5\xbf\xf8u|\x8f'
+    # Generate the key
+    kdf = nacl.pwhash.argon2id.kdf
+    key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
+    box = nacl.secret.SecretBox(key)
+
+    print("[*] Load the mapping")
+    mapping = MAPPINGS[args.type](args.input, key)
+    if args.shared_mapping:
+        mapping = SharedMapping.of(mapping)
+
+    dictionary = None
+    if args.compression == "zstd-dict":
+        dictionary = zstd_dictionary.load(zstd_dictionary.path_of(args.input), box)
+
+    # retrieve the proper target
+    script = None
+    if not args.kvstore:
+        # Connect to database
+        engine = sqlalchemy.create_engine(args.url,
+                                          pool_size=args.pool_size,
+                                          pool_pre_ping=True)
+    else:
+        # Connect to kv store
+        host, port = args.url.split(":")
+        engine = redis.Redis(host=host,
+                             port=port,
+                             max_connections=args.pool_size)
+        root = os.path.realpath(os.path.join(__file__, "..", ".."))
+        script_path = os.path.join(root, "redis", "indices.lua")
+        with open(script_path) as script_file:
+            script = engine.register_script(script_file.read())
+
+    local = None
+    if args.local_mapping:
+        local = local_mapping.load(local_mapping.path_of(args.input), box)
+
+    cache = GroupCache(int(args.cache * 2**20)) if args.cache else None
+    client = QueryClient(mapping,
+                         box,
+                         engine,
+                         representation=args.representation,
+                         serialization=args.serialization,
+                         compression=args.compression,
+                         script=script,
+                         cache=cache,
+                         dictionary=dictionary,
+                         postings=args.postings,
+                         range_cover=args.range_cover,
+                         partitions=args.partitions,
+                         local_mapping=local,
+                         complement=args.complement,
+                         workers=args.workers)
+
+    if args.socket:
+        server = UnixQueryServer(args.socket, client, verbose=args.verbose)
+        print(f"[*] Serve queries on {args.socket}")
+    else:
+        server = QueryServer((args.host, args.port),
+                             client,
+                             verbose=args.verbose)
+        print(f"[*] Serve queries on {args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        client.close()
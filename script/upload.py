@@ -16,12 +16,21 @@
 
 import argparse
 import base64
+import itertools
+import time
 
 import pandas as pd
 import redis
-import sqlalchemy
 from sqlalchemy import create_engine
 
+from secure_index import postings
+from secure_index import records
+from secure_index.bulk import chunked
+from secure_index.bulk import copy_table
+from secure_index.bulk import execute_parallel
+from secure_index.bulk import load_hash
+from secure_index.bulk import load_sets
+from secure_index.metrics import StageMetrics
 from secure_index.mapping._column_mapping.creation import is_set, get_items
 
 # TODO: Assumption to handle, the anonymized non-wrapped table always presents the INDEX and GID columns
@@ -39,6 +48,33 @@ def wrapped_id_table(engine, name, adf):
     engine.execute(command)
     adf.to_sql('wrapped_id', engine, if_exists='append', index=False)
 
+
+def sql_types(df):
+    """Use memory efficient types to store the dataset server-side."""
+    dtype = []
+    for column in df.columns:
+        if column == "EncTuples":
+            dtype.append("bytea")
+        elif df[column].dtype in ("int8", "int16"):
+            dtype.append("smallint")
+        elif df[column].dtype == "int32":
+            dtype.append("integer")
+        elif df[column].dtype == "int64":
+            dtype.append("bigint")
+        else:
+            # TODO: Consider treating hashes as bytea instead of text
+            dtype.append("text")
+    return dtype
+
+
+def is_unique(engine, name, columns):
+    """Check whether the rows of the uploaded table are unique on the given
+    columns."""
+    string = '\",\"'.join(columns)
+    query = f'SELECT COUNT(*) = COUNT(DISTINCT ("{string}")) FROM "{name}"'
+    return engine.execute(query).scalar()
+
+
 parser = argparse.ArgumentParser(
     description='Run examples against the given mapping.'
 )
@@ -63,101 +99,195 @@ parser.add_argument('-a',
                     metavar='ANONIMIZED_PATH',
                     dest="anonymized_path",
                     help='path to the non wrapped anonymized dataset')
+parser.add_argument('--indexes',
+                    metavar='INDEXES',
+                    choices=['all', 'primary'],
+                    default='all',
+                    help='indexes to create: all (default, an index on each '
+                         'token column and the multi-column one of the '
+                         'usa2019 experiments), primary (only the primary '
+                         'key, to select the others with script/advise.py)')
+parser.add_argument('-j',
+                    '--jobs',
+                    metavar='JOBS',
+                    type=int,
+                    default=4,
+                    help='number of parallel connections loading the dataset '
+                         'and building the indexes (default: 4)')
+parser.add_argument('--ordered',
+                    action='store_true',
+                    help='load the rows in the order of the dataset over a '
+                         'single connection, so that the table follows the '
+                         'order of wrap.py --cluster-by exactly (parallel '
+                         'connections keep it only within each chunk)')
+parser.add_argument('--partition-by',
+                    metavar='COLUMN',
+                    default='GroupId',
+                    help='column the table is partitioned by (default: '
+                         'GroupId)')
+parser.add_argument('--partition-method',
+                    metavar='METHOD',
+                    choices=['hash', 'range'],
+                    default='hash',
+                    help='partitioning method: hash (default), range (split '
+                         'at the quantiles of the column, csv datasets only)')
+parser.add_argument('--partitions',
+                    metavar='PARTITIONS',
+                    type=int,
+                    default=1,
+                    help='number of partitions of the table, scanned in '
+                         'parallel by the clients (default: 1, i.e., no '
+                         'partitioning)')
+parser.add_argument('--postings',
+                    metavar='LAYOUT',
+                    choices=['both', 'roaring', 'set'],
+                    default='set',
+                    help='layout of the posting lists on the kv-store: set '
+                         '(default, scanned by the Lua script), roaring '
+                         '(bitmaps evaluated client-side), both')
+parser.add_argument('--unlogged',
+                    action='store_true',
+                    help='keep the table unlogged after the load (faster, '
+                         'but truncated on crash recovery)')
 
 args = parser.parse_args()
 
 dataset = args.dataset
 url = args.url
 kvstore = args.kvstore
+jobs = args.jobs
 name = args.name if args.name is not None else "wrapped"
 anon_path = args.anonymized_path if args.anonymized_path is not None else None
+partitions = args.partitions
+partition_by = args.partition_by if partitions > 1 else None
 
-print(f"[*] Read {dataset} dataset")
-df = pd.read_csv(dataset)
+# Binary wrapped datasets are streamed in batches of rows with raw enctuples
+binary = records.is_records(dataset)
+if binary:
+    print(f"[*] Stream {dataset} dataset")
+    columns, batches = records.read(dataset)
+else:
+    print(f"[*] Read {dataset} dataset")
+    df = pd.read_csv(dataset)
+
+    # Reduce in-memory footprint of the indices columns
+    for column in df.columns:
+        if df[column].dtype == "int64":
+            df[column] = pd.to_numeric(df[column], downcast="signed")
+    columns = list(df.columns)
 
-# Reduce in-memory footprint of the indices columns
-for column in df.columns:
-    if df[column].dtype == "int64":
-        df[column] = pd.to_numeric(df[column], downcast="signed")
+if partition_by is not None and partition_by not in columns:
+    print(f"[*] {name} has no {partition_by} column, skip partitioning")
+    partition_by = None
 
 if not kvstore:
     print(f"[*] Upload {dataset} as {name} table")
-    engine = create_engine(url)
+    engine = create_engine(url, pool_size=jobs)
     engine.execute("DROP TABLE IF EXISTS wrapped_id")
 
-    # Ensure sqlalchemy treats EncTuples as bytes
-    if "EncTuples" in df.columns:
-        df["EncTuples"] = df["EncTuples"].apply(base64.b64decode)
+    if binary:
+        # NOTE: batches cannot be downcast consistently, integers are
+        #       stored as bigint
+        first = next(batches, [])
+        types = sql_types(pd.DataFrame(first, columns=columns))
+        chunks = itertools.chain([first], batches)
+    else:
+        # Ensure EncTuples are sent as bytes
+        if "EncTuples" in df.columns:
+            df["EncTuples"] = df["EncTuples"].apply(base64.b64decode)
+        types = sql_types(df)
+        chunks = chunked(df.itertuples(index=False, name=None))
 
-    # Use memory efficient types to store the dataset server-side
-    dtype = {}
-    for column in df.columns:
-        if column == "EncTuples":
-            dtype[column] = sqlalchemy.dialects.postgresql.BYTEA
-        elif str(df[column].dtype).startswith("int"):
-            if df[column].dtype in ("int8", "int16"):
-                dtype[column] = sqlalchemy.dialects.postgresql.SMALLINT
-            elif df[column].dtype == "int32":
-                dtype[column] = sqlalchemy.dialects.postgresql.INTEGER
-            elif df[column].dtype == "int64":
-                dtype[column] = sqlalchemy.dialects.postgresql.BIGINT
-        else:
-            # TODO: Consider treating hashes as bytea instead of text
-            dtype[column] = sqlalchemy.dialects.postgresql.TEXT
+    splits = None
+    if partition_by is not None and args.partition_method == "range":
+        if binary:
+            parser.error("range partitioning needs a csv dataset.")
+        # Split at the quantiles of the column (fewer partitions when the
+        # column has few distinct values)
+        quantiles = [i / partitions for i in range(1, partitions)]
+        splits = sorted(set(df[partition_by].quantile(quantiles,
+                                                      interpolation="lower")))
+        splits = [split.item() if hasattr(split, "item") else split
+                  for split in splits]
+        partitions = len(splits) + 1
+
+    if partition_by is not None:
+        print(f"[*] Partition {name} by {args.partition_method} of " +
+              f"{partition_by} into {partitions} partitions")
 
-    df.to_sql(name,
-              engine,
-              dtype=dtype,
-              if_exists='replace',
-              index=False)
+    # Load with binary COPY over parallel connections
+    metrics = StageMetrics()
+    copy_table(engine,
+               name,
+               columns,
+               types,
+               chunks,
+               connections=1 if args.ordered else jobs,
+               logged=not args.unlogged,
+               metrics=metrics,
+               partition_by=partition_by,
+               partitions=partitions,
+               method=args.partition_method,
+               splits=splits)
+    load = metrics.stats()["load"]
+    print(f"Loaded rows: \t\t {load['items']}")
+    print("Loading: \t\t {:10.3f}s".format(load["seconds"]))
+    print(f"Throughput: \t\t {load['items/s']:.0f} rows/s, "
+          f"{load['MB/s']:.2f} MB/s")
 
     # TODO: Create referential constraints on columns (make sense only when
     #       representing the dataset with a mapping and in normal form)
-    # TODO: Improve index creation considering query pattern (current one
-    #       is wrong only when representing the dataset with a mapping and in
-    #       normal form)
 
-    if "INDEX" in df.columns:
+    if "INDEX" in columns:
         primary_key = ["INDEX"]
-    elif "GroupId" in df.columns:
+    elif "GroupId" in columns:
         primary_key = ["GroupId"]
-    elif "Id" in df.columns:
+    elif "Id" in columns:
         primary_key = ["Id"]
     else:
         primary_key = [
-            column for column in df.columns if column != "EncTuples"
+            column for column in columns if column != "EncTuples"
         ]
 
-    unique = not df.duplicated(subset=primary_key).any()
+    # NOTE: unique constraints of partitioned tables include the partition
+    #       key, local indexes are then created on every partition
+    if partition_by is not None and partition_by not in primary_key:
+        primary_key.append(partition_by)
+
+    unique = is_unique(engine, name, primary_key)
     if unique:
         string = '\",\"'.join(primary_key)
         print(f"[*] Create primary key on {name} using \"{string}\" columns")
         engine.execute(f"ALTER TABLE \"{name}\" ADD PRIMARY KEY (\"{string}\")")
 
-    # Create single column index on column indices
-    # TODO: Verify the following note
-    # NOTE: our queries never use single column indexes due to the huge number
-    #       of punctual values we request (this may change on multi-column
-    #       queries)
-    for column in df.columns:
-        if column not in ("INDEX", "GroupId", "Id", "EncTuples"):
+    # Create single column index on column indices (with --indexes all)
+    # NOTE: script/advise.py selects the secondary indexes minimizing the
+    #       latency of a query log instead
+    # NOTE: indexes are built in parallel once all of them are declared
+    indexes = []
+    for column in columns:
+        if args.indexes == "all" and \
+                column not in ("INDEX", "GroupId", "Id", "EncTuples"):
             # Depending on the uniqueness of the column create a unique or a
             # normal index
-            is_unique = df[column].nunique() == len(df.index)
-            string = 'UNIQUE' if is_unique else ''
+            unique = (partition_by is None or column == partition_by) and \
+                is_unique(engine, name, [column])
+            string = 'UNIQUE' if unique else ''
             print(f"[*] Create {string} index on {name} using {column}")
-            engine.execute(f"CREATE {string} INDEX \"{name}_{column}_idx\" " +
+            indexes.append(f"CREATE {string} INDEX \"{name}_{column}_idx\" " +
                            f"ON \"{name}\" (\"{column}\")")
 
-    # Create multi column index on column indices (according to test query
-    # pattern)
+    # Create multi column index on column indices (with --indexes all,
+    # according to the query pattern of the experiments)
     multi_column_index = [
-        column for column in df.columns
+        column for column in columns
         if column not in ("INDEX", "GroupId", "Id", "EncTuples")
     ]
-    if len(multi_column_index) > 1:
-        is_unique = not df.duplicated(subset=multi_column_index).any()
-        unique_string = 'UNIQUE' if is_unique else ''
+    if len(multi_column_index) > 1 and args.indexes == "all":
+        unique = (partition_by is None or
+                  partition_by in multi_column_index) and \
+            is_unique(engine, name, multi_column_index)
+        unique_string = 'UNIQUE' if unique else ''
         # Our experimental evaluation runs query against WAGP, and WAGP+OCCP,
         # as the column order of the usa2019 dataset is ST, AGEP, OCCP and WAGP
         # we reverse it
@@ -165,28 +295,65 @@ if not kvstore:
         columns_string = '\",\"'.join(multi_column_index)
         print(f"[*] Create {unique_string} index on {name} using " +
               f"\"{columns_string}\"")
-        engine.execute(f"CREATE {string} INDEX \"{name}_multi_column_idx\" " +
+        indexes.append(f"CREATE {unique_string} INDEX " +
+                       f"\"{name}_multi_column_idx\" " +
                        f"ON \"{name}\" (\"{columns_string}\")")
 
+    start = time.time()
+    execute_parallel(engine, indexes, connections=jobs, metrics=metrics)
+    print("Indexing: \t\t {:10.3f}s".format(time.time() - start))
+
     if anon_path is not None:
         adf = pd.read_csv(anon_path)
         wrapped_id_table(engine, name, adf[["INDEX", "GID"]])
 else:
     print(f"[*] Upload {dataset} as {name} hash")
     host, port = url.split(":")
-    r = redis.Redis(host=host, port=port)
-
-    is_mapping = df['Value'].apply(is_set).all()
-    if is_mapping:
-        pipe = r.pipeline(transaction=False)
-        for key, value in zip(df['Key'], df['Value']):
-            pipe.sadd(name + ":" + str(key), *map(str.strip, get_items(value)))
-        pipe.execute()
+    r = redis.Redis(host=host, port=port, max_connections=jobs)
+
+    def progress(done):
+        print(f"Uploaded: \t\t {done}", end="\r", flush=True)
+
+    # Load bounded chunks over parallel connections
+    metrics = StageMetrics()
+    if binary:
+        load_hash(r,
+                  name,
+                  batches,
+                  connections=jobs,
+                  metrics=metrics,
+                  progress=progress)
+    elif df['Value'].apply(is_set).all():
+        def posting_lists():
+            for key, value in zip(df['Key'], df['Value']):
+                yield key, list(map(str.strip, get_items(value)))
+
+        if args.postings in ("set", "both"):
+            load_sets(r,
+                      name,
+                      chunked(posting_lists()),
+                      connections=jobs,
+                      metrics=metrics,
+                      progress=progress)
+        if args.postings in ("roaring", "both"):
+            bitmaps = ((key, postings.dumps(gids))
+                       for key, gids in posting_lists())
+            load_hash(r,
+                      postings.key_of(name),
+                      chunked(bitmaps),
+                      connections=jobs,
+                      metrics=metrics,
+                      progress=progress)
     else:
         # Ensure Redis treats EncTuples as bytes
-        df["Value"] = df["Value"].apply(base64.b64decode)
-
-        #r.mset({key: value for key, value in zip(df['Key'], df['Value'])})
-        r.hset(name,
-               mapping={key: value
-                        for key, value in zip(df['Key'], df['Value'])})
+        values = (base64.b64decode(value) for value in df['Value'])
+        load_hash(r,
+                  name,
+                  chunked(zip(df['Key'], values)),
+                  connections=jobs,
+                  metrics=metrics,
+                  progress=progress)
+    load = metrics.stats()["load"]
+    print(f"Uploaded: \t\t {load['items']}")
+    print("Loading: \t\t {:10.3f}s".format(load["seconds"]))
+    print(f"Throughput: \t\t {load['items/s']:.0f} keys/s")
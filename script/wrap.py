@@ -23,11 +23,13 @@ import multiprocessing
 import os.path
 import pickle
 import random
+import tempfile
 import time
 from collections import Counter
 from functools import partial
 
 import lz4.frame
+import numpy as np
 import pandas as pd
 import msgpack
 import nacl.pwhash
@@ -36,7 +38,17 @@ import nacl.utils
 import snappy
 import zstd
 
+from secure_index import columnar
+from secure_index import cover
+from secure_index import dictionary as zstd_dictionary
+from secure_index import local_mapping
+from secure_index.external import merge_runs
+from secure_index.external import sort_by_group
 from secure_index.mapping.heterogeneous import HeterogeneousMapping
+from secure_index.padding import padded_size
+from secure_index.padding import padding_stats
+from secure_index.padding import size_classes
+from secure_index.records import RecordWriter
 
 
 MAPPINGS = {
@@ -46,7 +58,8 @@ MAPPINGS = {
 SERIALIZE = {
     "json": lambda tuples: json.dumps(tuples).encode("utf-8"),
     "pickle": pickle.dumps,
-    "msgpack": msgpack.dumps
+    "msgpack": msgpack.dumps,
+    "columnar": columnar.dumps
 }
 
 COMPRESS = {
@@ -59,6 +72,10 @@ COMPRESS = {
 }
 
 
+# Maximum number of groups used to train the zstd dictionary
+DICTIONARY_SAMPLES = 5000
+
+
 def init_lock(l):
     global locks
     locks = l
@@ -76,11 +93,71 @@ def check_idx_correctness(mapping, generalizations_idx, tokens_idx):
             assert idx % len(tokens) == 0
 
 
-def get_blob_size(param):
-    gid, group = param
-    plain = [column for column in group.columns if column.endswith("_plain")]
-    tuples = [tuple(row) for index, row in group[plain].iterrows()]
-    return len(compress(serialize(tuples)))
+def group_arrays(jdf):
+    """Return the column arrays of the joined dataset sorted by group, the
+    offsets of the groups in the arrays and their GIDs."""
+    plain = [column for column in jdf.columns if column.endswith("_plain")]
+    plain_arrays = [jdf[column].to_numpy() for column in plain]
+    anon_arrays = [jdf[column + "_anon"].to_numpy() for column in indices]
+    sorted_gids = jdf["GID"].to_numpy()
+    offsets = np.concatenate(([0],
+                              np.flatnonzero(np.diff(sorted_gids)) + 1,
+                              [len(sorted_gids)]))
+    return plain_arrays, anon_arrays, offsets, sorted_gids[offsets[:-1]]
+
+
+def split_batch(batch, number_of_ranges):
+    """Split the column arrays of a batch into ranges of groups."""
+    plain_arrays, anon_arrays, offsets, group_ids = batch
+    for first, last in split_groups(len(group_ids), number_of_ranges):
+        start, end = offsets[first], offsets[last]
+        yield ([array[start:end] for array in plain_arrays],
+               [array[start:end] for array in anon_arrays],
+               offsets[first:last + 1] - start,
+               group_ids[first:last])
+
+
+def load_batch(batch):
+    global plain_arrays, anon_arrays, offsets, group_ids
+    plain_arrays, anon_arrays, offsets, group_ids = batch
+    return len(group_ids)
+
+
+def merged_batches(runs, rows):
+    """Yield the column arrays of the groups merged from the sorted runs."""
+    for jdf in merge_runs(runs, rows):
+        yield group_arrays(jdf)
+
+
+def get_batch_sizes(batch):
+    return get_blob_sizes((0, load_batch(batch)))
+
+
+def wrap_batch(batch, boundaries):
+    return wrap_groups((0, load_batch(batch)), boundaries)
+
+
+def split_groups(number_of_groups, number_of_ranges):
+    """Split the groups into contiguous ranges of group positions."""
+    step = max(1, -(-number_of_groups // number_of_ranges))
+    return [(first, min(first + step, number_of_groups))
+            for first in range(0, number_of_groups, step)]
+
+
+def serialize_group(i):
+    # Slice the rows of the group from the column arrays sorted by GID
+    start, end = offsets[i], offsets[i + 1]
+    if serialization == "columnar":
+        # Serialize the column arrays directly, without building the tuples
+        return columnar.dumps_columns([array[start:end]
+                                       for array in plain_arrays])
+    tuples = list(zip(*(array[start:end].tolist() for array in plain_arrays)))
+    return serialize(tuples)
+
+
+def get_blob_sizes(groups):
+    first, last = groups
+    return [len(compress(serialize_group(i))) for i in range(first, last)]
 
 
 def get_current_item(mapping, column, generalization):
@@ -93,20 +170,20 @@ def get_current_item(mapping, column, generalization):
     return items[token_idx % len(items)]
 
 
+def wrap_groups(groups, boundaries):
+    first, last = groups
+    return [wrap_group(i, boundaries) for i in range(first, last)]
+
+
 # when the GID is kept, assumes that there is a column named GID
-def wrap_dataset(param, blob_size):
-    gid, group = param
-    # Plain and anon column names
-    plain = [column for column in group.columns if column.endswith("_plain")]
-    anon = [column + "_anon" for column in indices]
+def wrap_group(i, boundaries):
+    gid = int(group_ids[i])
 
     # Retrieve group generalization
-    generalizations = group.iloc[0][anon]
-    GroupID = group.iloc[0]["GID"] if keep_GID else None
+    generalizations = [array[offsets[i]] for array in anon_arrays]
     # Use indices according to the requested wrapping representation
-    row_indices = []
-    if to_gid or compact:
-        row_indices.append(gid)
+    # NOTE: the GroupId is always kept so that clients can cache groups
+    row_indices = [gid]
     if not compact:
         # Retrive tokens of the generalizations
         for column, generalization in zip(indices, generalizations):
@@ -115,14 +192,15 @@ def wrap_dataset(param, blob_size):
     if kvstore:
         row_indices = [gid]
 
-    # Bundle tuples of each group into a list
-    tuples = [tuple(row) for _, row in group[plain].iterrows()]
+    # Bundle tuples of each group
+    compressed = compress(serialize_group(i))
 
-    compressed = compress(serialize(tuples))
-
-    # Ensure every blob has the same length by padding it
-    lpadding = blob_size - len(compressed) if blob_size else 0
-    padding = nacl.utils.random(lpadding) if blob_size else b''
+    # Ensure blobs only reveal their size class by padding them
+    if boundaries:
+        lpadding = padded_size(len(compressed), boundaries) - len(compressed)
+    else:
+        lpadding = 0
+    padding = nacl.utils.random(lpadding) if boundaries else b''
     try:
         lpadding = lpadding.to_bytes(2, byteorder='little', signed=False)
     except OverflowError:
@@ -133,7 +211,9 @@ def wrap_dataset(param, blob_size):
     nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
     enc_tuple = box.encrypt(blob, nonce)
 
-    return (*row_indices, base64.b64encode(enc_tuple).decode("ascii")) if not keep_GID else (GroupID, *row_indices, base64.b64encode(enc_tuple).decode("ascii"))
+    if binary:
+        return (*row_indices, bytes(enc_tuple))
+    return (*row_indices, base64.b64encode(enc_tuple).decode("ascii"))
 
 
 parser = argparse.ArgumentParser(
@@ -151,18 +231,32 @@ parser.add_argument('mapping',
 parser.add_argument('output',
                     metavar='OUPUT',
                     help='where to store the dataset to upload')
+parser.add_argument('--cluster-by',
+                    metavar='COLUMN',
+                    help='write the groups sorted by the ranges the given '
+                         'range column generalizes (GroupIds are left '
+                         'untouched), so that groups matching a range query '
+                         'are stored close to each other once uploaded')
 parser.add_argument('-c',
                     '--compression',
                     metavar='ALGORITHM',
-                    choices=['none', 'lz4', 'snappy', 'zstd'],
+                    choices=['none', 'lz4', 'snappy', 'zstd', 'zstd-dict'],
                     default='zstd',
                     help='compression algorithm: none, lz4, snappy, zstd '
-                         '(default)')
+                         '(default), zstd-dict (trained dictionary)')
+parser.add_argument('-f',
+                    '--format',
+                    metavar='FORMAT',
+                    choices=['binary', 'csv'],
+                    default='csv',
+                    help='format of the wrapped dataset: binary '
+                         '(length-prefixed records with raw enctuples), csv '
+                         '(default, base64 enctuples)')
 parser.add_argument('-g',
                     '--GID-keep',
                     action='store_true',
                     dest="keep_GID",
-                    help='flag that indicates if the GID columns is kept')
+                    help='deprecated, the GroupId column is always kept')
 parser.add_argument('-j',
                     '--jobs',
                     metavar='JOBS',
@@ -172,6 +266,13 @@ parser.add_argument('-k',
                     dest='kvstore',
                     action='store_true',
                     help='prepare the files with the kv-store as the target')
+parser.add_argument('--memory',
+                    metavar='MB',
+                    type=float,
+                    help='wrap out of core, reading the datasets in chunks '
+                         'and sorting them by group on the local disk, with '
+                         'about MB megabytes of tuples in memory (by '
+                         'default the datasets are loaded in memory)')
 parser.add_argument('-m',
                     '--mapping-table',
                     dest='table',
@@ -186,15 +287,33 @@ parser.add_argument('-p',
                     '--pad',
                     action='store_true',
                     help='pad enctuples to achive absolute flattening')
+parser.add_argument('--pad-classes',
+                    metavar='CLASSES',
+                    type=int,
+                    default=1,
+                    help='number of size classes enctuples are padded to, '
+                         'chosen to minimize the total padding; the size of '
+                         'an enctuple reveals at most log2(CLASSES) bits '
+                         '(default: 1, i.e., pad to the maximum size)')
 parser.add_argument('--password',
                     help='password necessary to read the mapping')
+parser.add_argument('--range-cover',
+                    action='store_true',
+                    help='store the dyadic range covers of the range columns '
+                         'alongside the dataset, so that range queries '
+                         'request O(log n) nodes instead of a label per '
+                         'generalization')
 parser.add_argument('-s',
                     '--serialization',
                     metavar='FORMAT',
-                    choices=['json', 'msgpack', 'pickle'],
+                    choices=['columnar', 'json', 'msgpack', 'pickle'],
                     default='json',
-                    help='serialization format: json (default), msgpack, '
-                         'pickle')
+                    help='serialization format: columnar, json (default), '
+                         'msgpack, pickle')
+parser.add_argument('--temp-dir',
+                    metavar='DIR',
+                    help='where to store the sorted runs of the out of core '
+                         'wrapping (default: system temporary directory)')
 parser.add_argument('-t',
                     '--type',
                     metavar='TYPE',
@@ -213,10 +332,16 @@ jobs = min(args.jobs if args.jobs else float("+inf"),
 mapping_table = args.table
 kvstore = args.kvstore
 normal = args.normal
-serialize = SERIALIZE[args.serialization]
-compress = COMPRESS[args.compression]
+serialization = args.serialization
+serialize = SERIALIZE[serialization]
+compression = args.compression
+compress = COMPRESS.get(compression)
 pad = args.pad
-keep_GID = args.keep_GID
+pad_classes = args.pad_classes
+memory = int(args.memory * 2**20) if args.memory else None
+binary = args.format == "binary"
+range_cover = args.range_cover
+cluster_by = args.cluster_by
 pw = args.password.encode("utf-8") if args.password else None
 
 compact = mapping_table + normal
@@ -227,31 +352,50 @@ if compact > 1:
 if mapping_type not in MAPPINGS:
     parser.error(f"{mapping_type} is not a valid mapping type.")
 
-print("[*] Read plain dataset")
-start = time.time()
-df = pd.read_csv(dataset, index_col="INDEX")
-print("Read plain dataset:\t {:10.3f}s".format(time.time() - start))
-
-# Reduce in-memory footprint of the plain dataset
-for column in df.columns:
-    if df[column].dtype == "int64":
-        if df[column].min() >= 0:
-            df[column] = pd.to_numeric(df[column], downcast="unsigned")
-        else:
-            df[column] = pd.to_numeric(df[column], downcast="signed")
-    elif df[column].dtype == "float64":
-        df[column] = pd.to_numeric(df[column], downcast="float")
+if cluster_by and kvstore:
+    parser.error("the kv-store has no physical order to cluster by.")
 
-print("[*] Read anonymized dataset")
-start = time.time()
-dtype = {column:str for column in df.columns}
-adf = pd.read_csv(anonymized, index_col="INDEX", dtype=dtype)
-print("Read anonymized dataset: {:10.3f}s".format(time.time() - start))
+if cluster_by and memory:
+    parser.error("--cluster-by is not supported out of core.")
+
+if memory:
+    # Join the datasets and sort them by group on the local disk, keeping
+    # only the generalizations of the groups in memory
+    print("[*] Sort datasets by group out of core")
+    start = time.time()
+    temp_dir = tempfile.TemporaryDirectory(dir=args.temp_dir)
+    runs, adf, batch_rows = sort_by_group(dataset,
+                                          anonymized,
+                                          memory,
+                                          temp_dir.name)
+    print("Sort datasets: \t\t {:10.3f}s".format(time.time() - start))
+    print(f"Sorted runs: \t\t {len(runs)}")
+else:
+    print("[*] Read plain dataset")
+    start = time.time()
+    df = pd.read_csv(dataset, index_col="INDEX")
+    print("Read plain dataset:\t {:10.3f}s".format(time.time() - start))
+
+    # Reduce in-memory footprint of the plain dataset
+    for column in df.columns:
+        if df[column].dtype == "int64":
+            if df[column].min() >= 0:
+                df[column] = pd.to_numeric(df[column], downcast="unsigned")
+            else:
+                df[column] = pd.to_numeric(df[column], downcast="signed")
+        elif df[column].dtype == "float64":
+            df[column] = pd.to_numeric(df[column], downcast="float")
 
-# Reduce in-memory footprint of the anonymized dataset
-# NOTE: Do not use categorical as this has a huge performance hit
-if "GID" in adf.columns:
-    adf["GID"] = pd.to_numeric(adf["GID"], downcast="unsigned")
+    print("[*] Read anonymized dataset")
+    start = time.time()
+    dtype = {column:str for column in df.columns}
+    adf = pd.read_csv(anonymized, index_col="INDEX", dtype=dtype)
+    print("Read anonymized dataset: {:10.3f}s".format(time.time() - start))
+
+    # Reduce in-memory footprint of the anonymized dataset
+    # NOTE: Do not use categorical as this has a huge performance hit
+    if "GID" in adf.columns:
+        adf["GID"] = pd.to_numeric(adf["GID"], downcast="unsigned")
 
 if not pw:
     try:
@@ -265,6 +409,13 @@ key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
 box = nacl.secret.SecretBox(key)
 
 mapping = MAPPINGS[mapping_type](path, key)
+covers = cover.build(mapping) if range_cover else {}
+
+if cluster_by:
+    if cluster_by not in mapping.mappings or \
+            mapping.types[cluster_by] not in cover.RANGE_TYPES:
+        parser.error(f"{cluster_by} is not a range column of the mapping.")
+    cluster_ranks = cover.ranks(mapping, cluster_by)
 
 # Retrieve all those column not using a mapping to gid and promote them to
 # column indices
@@ -327,6 +478,13 @@ if mapping_table and not kvstore:
     parent = os.path.dirname(output)
     table.to_csv(os.path.join(parent, "mapping.csv"), index=False)
 
+    # Clients may resolve the conditions to GroupIds with their own copy
+    print(f"[*] Write encrypted copy of the mapping table")
+    local_mapping.save(local_mapping.path_of(path),
+                       columns,
+                       table.values.tolist(),
+                       box)
+
     print("[*] Checking correctness of the indexes (mapping)")
     check_idx_correctness(t_mapping, generalizations_idx, next_tokens_idx)
 
@@ -345,10 +503,31 @@ if mapping and kvstore:
                 tuples.extend((token, {gid})
                               for token, gid in zip(tokens, gids))
 
+        if column in covers:
+            # Posting list of each node is the union of those of its tokens
+            to_gids = dict(tuples)
+            for node, tokens in covers[column].nodes():
+                gids = set().union(*(to_gids.get(token, set())
+                                     for token in tokens))
+                if gids:
+                    tuples.append((node, gids))
+
         column_hash = pd.DataFrame(tuples, columns=["Key", "Value"])
         print(f"[*] Write {column} mapping")
         column_hash.to_csv(os.path.join(parent, column + ".csv"), index=False)
 
+if covers and not kvstore:
+    print("[*] Create range cover tables")
+    parent = os.path.dirname(output)
+    for column, column_cover in covers.items():
+        tuples = [(node, token)
+                  for node, tokens in column_cover.nodes()
+                  for token in tokens]
+        table = pd.DataFrame(tuples, columns=["Node", column])
+        print(f"[*] Write {cover.table_of(column)} table")
+        table.to_csv(os.path.join(parent, cover.table_of(column) + ".csv"),
+                     index=False)
+
 if normal:
     # assume no columns go by the name of Id
     # assume no columns go by the name of Group
@@ -403,45 +582,134 @@ if normal:
 
 print("Auxiliary stuff:\t {:10.3f}s".format(time.time() - start))
 
-# Whether we have some column mapping to gid or not
-to_gid = (len(mapping.schema) != len(indices))
-
-jdf = df.join(adf, lsuffix='_plain', rsuffix='_anon')
-
-max_size = None
+if not memory:
+    print("[*] Sort dataset by group")
+    start = time.time()
+    jdf = df.join(adf, lsuffix='_plain', rsuffix='_anon')
+    if cluster_by:
+        # Sort the groups by the position of their generalization, the GIDs
+        # still separate the groups sharing it
+        # NOTE: the server learns the order of the groups on the column
+        jdf["RANK"] = jdf[cluster_by + "_anon"].map(cluster_ranks)
+        jdf.sort_values(["RANK", "GID"], kind="stable", inplace=True)
+        jdf.drop(columns="RANK", inplace=True)
+    else:
+        jdf.sort_values("GID", kind="stable", inplace=True)
+
+    # Workers inherit the column arrays and receive ranges of groups, where
+    # the rows of the i-th group are at positions offsets[i]:offsets[i + 1]
+    plain_arrays, anon_arrays, offsets, group_ids = group_arrays(jdf)
+    ranges = split_groups(len(group_ids), jobs * 4)
+    del jdf
+    print("Sort dataset: \t\t {:10.3f}s".format(time.time() - start))
+
+if compression == "zstd-dict":
+    print(f"[*] Train zstd dictionary")
+    start = time.time()
+    if memory:
+        # Reservoir sample the groups while merging the runs
+        samples = []
+        seen = 0
+        for batch in merged_batches(runs, batch_rows):
+            for i in range(load_batch(batch)):
+                if len(samples) < DICTIONARY_SAMPLES:
+                    samples.append(serialize_group(i))
+                else:
+                    j = random.randrange(seen + 1)
+                    if j < DICTIONARY_SAMPLES:
+                        samples[j] = serialize_group(i)
+                seen += 1
+    else:
+        sample = random.sample(range(len(group_ids)),
+                               min(DICTIONARY_SAMPLES, len(group_ids)))
+        samples = [serialize_group(i) for i in sample]
+    dictionary = zstd_dictionary.train(samples)
+    zstd_dictionary.save(zstd_dictionary.path_of(path), dictionary, box)
+    compress = zstd_dictionary.compressor(dictionary)
+    print("Train dictionary: \t {:10.3f}s".format(time.time() - start))
+    print(f"Dictionary size: \t\t {len(dictionary)}")
+
+boundaries = None
 if pad:
     start = time.time()
     with multiprocessing.Pool(jobs) as pool:
-        print(f"[*] Compute maximum size of the serialization")
-        sizes = pool.map(get_blob_size, jdf.groupby("GID"))
-        max_size = max(sizes)
-    print("Maximum size: \t\t {:10.3f}s".format(time.time() - start))
-    print(f"Maximum blob size: \t\t {max_size}")
+        print(f"[*] Compute size classes of the serialization")
+        if memory:
+            sizes = [size
+                     for batch in merged_batches(runs, batch_rows)
+                     for chunk in pool.map(get_batch_sizes,
+                                           split_batch(batch, jobs * 4))
+                     for size in chunk]
+        else:
+            sizes = [size
+                     for chunk in pool.map(get_blob_sizes, ranges)
+                     for size in chunk]
+        boundaries = size_classes(sizes, pad_classes)
+    print("Size classes: \t\t {:10.3f}s".format(time.time() - start))
+    print(f"Blob size classes: \t\t {boundaries}")
+
+if not kvstore:
+    columns = ["GroupId"]
+    if not compact:
+        columns.extend(indices)
+    columns.append("EncTuples")
+else:
+    columns = ["Key", "Value"]
 
 print(f"[*] Wrap dataset")
 start = time.time()
 locks = {column: multiprocessing.Lock() for column in indices}
 with multiprocessing.Pool(jobs, initializer=init_lock, initargs=(locks,)) as pool:
-    enc = pool.map(functools.partial(wrap_dataset, blob_size=max_size),
-                   jdf.groupby("GID"))
+    if memory:
+        # Append the groups to the output as soon as they are wrapped
+        if binary:
+            writer = RecordWriter(output, columns)
+        else:
+            pd.DataFrame(columns=columns).to_csv(output, index=False)
+        for batch in merged_batches(runs, batch_rows):
+            enc = [row
+                   for chunk in pool.map(
+                       functools.partial(wrap_batch, boundaries=boundaries),
+                       split_batch(batch, jobs * 4))
+                   for row in chunk]
+            if binary:
+                writer.write(enc)
+            else:
+                pd.DataFrame(enc, columns=columns).to_csv(output,
+                                                          mode="a",
+                                                          header=False,
+                                                          index=False)
+        if binary:
+            writer.close()
+    else:
+        enc = [row
+               for chunk in pool.map(functools.partial(wrap_groups,
+                                                       boundaries=boundaries),
+                                     ranges)
+               for row in chunk]
 print("Wrapping:\t\t {:10.3f}s".format(time.time() - start))
 
+if pad:
+    stats = padding_stats(sizes, boundaries)
+    print(f"Size classes: \t\t {stats['classes']}")
+    print(f"Leakage bound: \t\t {stats['leakage bits']:.2f} bits per blob")
+    print(f"Mean padding: \t\t {stats['mean waste']:.1f} bytes")
+    print(f"Max padding: \t\t {stats['max waste']} bytes")
+    print(f"Unpadded blobs: \t {stats['unpadded bytes']} bytes")
+    print(f"Padded blobs: \t\t {stats['total bytes']} bytes")
+
 print("[*] Checking correctness of the indexes (wrapping)")
 check_idx_correctness(t_mapping, generalizations_idx, next_tokens_idx)
 
-if not kvstore:
-    columns = []
-    if to_gid or compact or keep_GID:
-        columns.append("GroupId")
-    if not compact:
-        columns.extend(indices)
-    columns.append("EncTuples")
+if memory:
+    temp_dir.cleanup()
 else:
-    columns = ["Key", "Value"]
-
-df = pd.DataFrame(enc, columns=columns)
-
-print("[*] Write dataset")
-start = time.time()
-df.to_csv(output, index=False)
-print("Writing:\t\t {:10.3f}s".format(time.time() - start))
+    print("[*] Write dataset")
+    start = time.time()
+    if binary:
+        with RecordWriter(output, columns) as writer:
+            writer.write(enc)
+    else:
+        df = pd.DataFrame(enc, columns=columns)
+        df.to_csv(output, index=False)
+    print("Writing:\t\t {:10.3f}s".format(time.time() - start))
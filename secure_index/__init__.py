@@ -13,13 +13,49 @@
 # limitations under the License.
 
 # Make all the files available as submodules.
+from . import advisor
+from . import async_client
+from . import bulk
+from . import cache
+from . import client
+from . import columnar
+from . import complement
+from . import cover
+from . import dictionary
+from . import external
+from . import filtering
+from . import layout
+from . import local_mapping
 from . import mapping
+from . import metrics
+from . import padding
+from . import postings
+from . import records
 from . import rewriting
+from . import service
 from . import sqlparser
 
 # Allow 'from secure_index import *' syntax.
 __all__ = [
+    "advisor",
+    "async_client",
+    "bulk",
+    "cache",
+    "client",
+    "columnar",
+    "complement",
+    "cover",
+    "dictionary",
+    "external",
+    "filtering",
+    "layout",
+    "local_mapping",
     "mapping",
+    "metrics",
+    "padding",
+    "postings",
+    "records",
     "rewriting",
+    "service",
     "sqlparser",
 ]
@@ -0,0 +1,250 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Workload-aware selection of the indexes of the uploaded tables.
+
+The rewritten queries of a workload are replayed with EXPLAIN ANALYZE against
+a scratch copy of the tables, stored in a dedicated schema that shadows the
+public one. Starting from the primary keys only, the advisor greedily keeps
+the candidate index (B-tree, hash, BRIN or covering B-tree on the columns the
+queries filter on) lowering the total measured latency the most, until no
+candidate improves it by at least the given ratio.
+"""
+
+import collections
+import hashlib
+import json
+import re
+
+if __package__:
+    from .bulk import _quote
+    from .bulk import execute_parallel
+else:
+    from secure_index.bulk import _quote
+    from secure_index.bulk import execute_parallel
+
+
+SCHEMA = "advisor"
+
+# Minimum relative improvement of the latency to keep an index
+THRESHOLD = 0.05
+
+# Times each query is replayed for every configuration
+REPEAT = 1
+
+# Maximum length of PostgreSQL identifiers
+MAX_NAME = 63
+
+Index = collections.namedtuple("Index",
+                               ["table", "method", "columns", "include"])
+
+# Columns filtered by the rewritten queries (e.g., "AGE" IN (VALUES ...), or
+# "AGE" NOT IN (VALUES ...) when rewritten to the complement of the labels)
+FILTERED = re.compile(r'"((?:[^"]|"")+)" (?:NOT )?IN \(')
+
+
+def index_name(index):
+    """Return a deterministic name of the index."""
+    parts = [index.table, index.method, *index.columns]
+    if index.include:
+        parts.append("covering")
+    name = "_".join(parts + ["idx"])
+    if len(name) > MAX_NAME:
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+        name = name[:MAX_NAME - len(digest) - 1] + "_" + digest
+    return name
+
+
+def index_statement(index, schema="public"):
+    """Return the statement creating the index."""
+    statement = f"CREATE INDEX {_quote(index_name(index))} " + \
+                f"ON {_quote(schema)}.{_quote(index.table)} " + \
+                f"USING {index.method} " + \
+                f"({', '.join(map(_quote, index.columns))})"
+    if index.include:
+        statement += f" INCLUDE ({', '.join(map(_quote, index.include))})"
+    return statement
+
+
+def filtered_columns(query):
+    """Return the set of columns the rewritten query filters on (with IN or,
+    for the complemented conditions, NOT IN)."""
+    return {match.replace('""', '"') for match in FILTERED.findall(query)}
+
+
+def candidates(columns, queries):
+    """Enumerate the indexes that may speed up the queries.
+
+    :columns: Dictionary from a table to the list of its columns.
+    :queries: List of rewritten queries.
+    :return: List of candidate indexes.
+    """
+    result = []
+    for table, table_columns in columns.items():
+        include = ("GroupId",) if "GroupId" in table_columns else ()
+        used = set()
+        for query in queries:
+            filtered = [column for column in table_columns
+                        if column in filtered_columns(query)]
+            used.update(filtered)
+            # Multi-column B-trees in both orders of each pair of columns
+            for first in filtered:
+                for second in filtered:
+                    index = Index(table, "btree", (first, second), ())
+                    if first != second and index not in result:
+                        result.append(index)
+        for column in sorted(used):
+            result.append(Index(table, "btree", (column,), ()))
+            result.append(Index(table, "hash", (column,), ()))
+            result.append(Index(table, "brin", (column,), ()))
+            if include and column not in include:
+                result.append(Index(table, "btree", (column,), include))
+    return result
+
+
+def _columns_of(connection, table):
+    rows = connection.execute(
+        "SELECT column_name FROM information_schema.columns " +
+        "WHERE table_schema = 'public' AND table_name = %s " +
+        "ORDER BY ordinal_position", (table,)).fetchall()
+    return [row[0] for row in rows if row[0] != "EncTuples"]
+
+
+def _primary_key(connection, table, schema="public"):
+    rows = connection.execute(
+        "SELECT a.attname FROM pg_index i JOIN pg_attribute a " +
+        "ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) " +
+        "WHERE i.indrelid = %s::regclass AND i.indisprimary",
+        (f"{_quote(schema)}.{_quote(table)}",)).fetchall()
+    return [row[0] for row in rows]
+
+
+def _secondary_indexes(connection, table, schema="public"):
+    rows = connection.execute(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c " +
+        "ON c.oid = i.indexrelid " +
+        "WHERE i.indrelid = %s::regclass AND NOT i.indisprimary",
+        (f"{_quote(schema)}.{_quote(table)}",)).fetchall()
+    return [row[0] for row in rows]
+
+
+def _latency(connection, queries, repeat):
+    total = 0
+    for query in queries:
+        for _ in range(repeat):
+            plan = connection.execute(
+                "EXPLAIN (ANALYZE, FORMAT JSON) " + query).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            total += plan[0]["Execution Time"]
+    return total / repeat
+
+
+def advise(engine,
+           tables,
+           queries,
+           max_indexes=None,
+           threshold=THRESHOLD,
+           repeat=REPEAT,
+           log=None):
+    """Select the indexes minimizing the latency of the queries.
+
+    :engine: SQLAlchemy engine of the PostgreSQL database.
+    :tables: List of tables whose indexes to select.
+    :queries: List of rewritten queries of the workload.
+    :max_indexes: Maximum number of indexes to select. Defaults to None (no
+        limit).
+    :threshold: Minimum relative improvement of the latency to keep an
+        index. Defaults to 0.05.
+    :repeat: Times each query is replayed for every configuration. Defaults
+        to 1.
+    :log: Optional function called with the latency in ms of each
+        configuration and the index it adds (None for the baseline).
+    :return: List of the selected indexes and the latency in ms of the
+        workload with and without them.
+    """
+    log = log if log is not None else lambda latency, index: None
+    with engine.connect() as connection:
+        connection.execute(f"DROP SCHEMA IF EXISTS {_quote(SCHEMA)} CASCADE")
+        connection.execute(f"CREATE SCHEMA {_quote(SCHEMA)}")
+        try:
+            # Scratch copy of the tables keeping only their primary keys
+            columns = {}
+            for table in tables:
+                scratch = f"{_quote(SCHEMA)}.{_quote(table)}"
+                connection.execute(f"CREATE TABLE {scratch} AS TABLE " +
+                                   f"public.{_quote(table)}")
+                primary_key = _primary_key(connection, table)
+                if primary_key:
+                    connection.execute(
+                        f"ALTER TABLE {scratch} ADD PRIMARY KEY " +
+                        f"({', '.join(map(_quote, primary_key))})")
+                connection.execute(f"ANALYZE {scratch}")
+                columns[table] = _columns_of(connection, table)
+
+            # Unqualified names resolve to the scratch tables first
+            connection.execute(f"SET search_path TO {_quote(SCHEMA)}, public")
+            pool = candidates(columns, queries)
+
+            # Warm up the buffers before measuring the baseline
+            _latency(connection, queries, 1)
+            baseline = best = _latency(connection, queries, repeat)
+            log(baseline, None)
+
+            selected = []
+            while pool and (max_indexes is None or
+                            len(selected) < max_indexes):
+                trials = []
+                for index in pool:
+                    connection.execute(index_statement(index, SCHEMA))
+                    trials.append((_latency(connection, queries, repeat),
+                                   index))
+                    connection.execute(f"DROP INDEX {_quote(SCHEMA)}." +
+                                       _quote(index_name(index)))
+                latency, index = min(trials, key=lambda trial: trial[0])
+                if latency > best * (1 - threshold):
+                    break
+                connection.execute(index_statement(index, SCHEMA))
+                selected.append(index)
+                pool.remove(index)
+                best = latency
+                log(latency, index)
+            return selected, baseline, best
+        finally:
+            connection.execute("SET search_path TO DEFAULT")
+            connection.execute(f"DROP SCHEMA {_quote(SCHEMA)} CASCADE")
+
+
+def apply(engine, tables, indexes, connections=4, metrics=None):
+    """Replace the secondary indexes of the tables with the given ones.
+
+    :engine: SQLAlchemy engine of the PostgreSQL database.
+    :tables: List of tables whose indexes to replace.
+    :indexes: List of indexes to create.
+    :connections: Number of parallel connections building the indexes.
+        Defaults to 4.
+    :metrics: Optional StageMetrics recording the time of each index.
+    :return: List of the names of the dropped indexes.
+    """
+    dropped = []
+    with engine.connect() as connection:
+        for table in tables:
+            for name in _secondary_indexes(connection, table):
+                connection.execute(f"DROP INDEX public.{_quote(name)}")
+                dropped.append(name)
+    execute_parallel(engine,
+                     [index_statement(index) for index in indexes],
+                     connections=connections,
+                     metrics=metrics)
+    return dropped
@@ -0,0 +1,442 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from functools import partial
+
+import redis.asyncio
+
+if __package__:
+    from . import postings
+    from .client import CACHED_LIMIT
+    from .client import CHUNK_SIZE
+    from .client import LIMIT_CHUNK_SIZE
+    from .client import PARTITIONS_QUERY as PG_PARTITIONS_QUERY
+    from .client import QueryClient
+    from .client import _Stream
+    from .client import _concat
+    from .client import _row_wise
+    from .client import _size
+    from .filtering import compile_filter
+    from .filtering import filter_tuples
+    from .rewriting import rename_table
+    from .rewriting import to_string
+    from .sqlparser import parse
+else:
+    from secure_index import postings
+    from secure_index.client import CACHED_LIMIT
+    from secure_index.client import CHUNK_SIZE
+    from secure_index.client import LIMIT_CHUNK_SIZE
+    from secure_index.client import PARTITIONS_QUERY as PG_PARTITIONS_QUERY
+    from secure_index.client import QueryClient
+    from secure_index.client import _Stream
+    from secure_index.client import _concat
+    from secure_index.client import _row_wise
+    from secure_index.client import _size
+    from secure_index.filtering import compile_filter
+    from secure_index.filtering import filter_tuples
+    from secure_index.rewriting import rename_table
+    from secure_index.rewriting import to_string
+    from secure_index.sqlparser import parse
+
+
+# asyncpg uses numbered placeholders
+PARTITIONS_QUERY = PG_PARTITIONS_QUERY.replace("%s", "$1")
+
+
+class AsyncQueryClient(QueryClient):
+    """Asyncio client running many plaintext queries concurrently against the
+    wrapped dataset on a single event loop.
+
+    Queries are rewritten on the event loop while the other ones wait for the
+    server, decryption and filtering are offloaded to an executor. The
+    methods running queries on the server (fetch, fetch_chunks,
+    decrypt_chunks, stream, retrieve and execute) are coroutines, or
+    asynchronous generators for the streaming ones.
+
+    :mapping: Mapping used to rewrite the queries.
+    :box: Secret box used to decrypt the encrypted tuples.
+    :engine: asyncpg connection pool of the database or redis.asyncio client
+        of the key-value store hosting the wrapped dataset.
+    :representation: Server-side representation of the dataset: normal,
+        mapping or normalization.
+    :deserialize: Function deserializing the plaintext tuples of a group.
+    :decompress: Function decompressing the serialized tuples of a group.
+    :script: Lua script registered on the redis.asyncio client.
+    :cache: Optional cache of the decrypted groups.
+    :dictionary: Trained zstd dictionary, required by the zstd-dict
+        compression.
+    :executor: Executor decrypting and filtering the tuples. Defaults to the
+        default executor of the event loop.
+    :postings: How the key-value store evaluates the posting lists: lua
+        (server-side, default), roaring (client-side bitmap algebra) or auto
+        (chosen per query).
+    :range_cover: Whether to request the nodes of the range covers instead
+        of a label per generalization of the range columns. Defaults to
+        False.
+    :partitions: Number of partitions of a partitioned table queried
+        concurrently. Defaults to 1 (the table is queried as a whole).
+    :local_mapping: Optional LocalMapping copy of the mapping table,
+        resolving the conditions to GroupIds client-side.
+    :complement: Share of the tokens of a column above which the labels of
+        a condition are rewritten to the tokens they exclude. Defaults to
+        None.
+    :cached_limit: Maximum number of cached GroupIds the server is asked not
+        to return. Defaults to CACHED_LIMIT.
+    """
+
+    def __init__(self,
+                 mapping,
+                 box,
+                 engine,
+                 representation="normal",
+                 serialization="json",
+                 compression="zstd",
+                 script=None,
+                 cache=None,
+                 dictionary=None,
+                 executor=None,
+                 postings="lua",
+                 range_cover=False,
+                 partitions=1,
+                 local_mapping=None,
+                 complement=None,
+                 cached_limit=CACHED_LIMIT):
+        super().__init__(mapping,
+                         box,
+                         engine,
+                         representation=representation,
+                         serialization=serialization,
+                         compression=compression,
+                         script=script,
+                         cache=cache,
+                         dictionary=dictionary,
+                         postings=postings,
+                         range_cover=range_cover,
+                         local_mapping=local_mapping,
+                         complement=complement,
+                         cached_limit=cached_limit)
+        self.partitions = partitions
+        self.kvstore = isinstance(engine, redis.asyncio.Redis)
+        self.executor = executor
+
+    async def fetch(self, rewritten, table):
+        """Run the rewritten query on the server.
+
+        :rewritten: Rewritten query (or keys to request to the key-value
+            store).
+        :table: Name of the table the query refers to.
+        :return: List of (GroupId, encrypted tuples) pairs. The GroupId is None
+            when the cache is disabled, the encrypted tuples are None when
+            the group is cached.
+        """
+        if not self.kvstore:
+            rows = await self._execute(rewritten, table)
+            if self.cache is None:
+                return [(None, row[0]) for row in rows]
+            return [(row[0], row[1]) for row in rows]
+
+        kv_store_data = rewritten
+        if not kv_store_data:
+            return []
+
+        if "GroupId" in kv_store_data and len(kv_store_data) == 1:
+            gids = list(kv_store_data["GroupId"])
+        elif postings.use_bitmaps(kv_store_data, self.postings):
+            gids = await self._run_bitmaps(kv_store_data)
+        else:
+            keys, args = self._script_args(kv_store_data, table)
+            gids, enc_tuples = await self.script(keys=keys, args=args)
+            return list(zip(map(int, gids), enc_tuples))
+
+        to_fetch = [gid for gid in gids
+                    if self.cache is None or gid not in self.cache]
+        enc_tuples = dict(zip(to_fetch, await self._hmget(table, to_fetch)))
+        return [(gid, enc_tuples.get(gid)) for gid in gids]
+
+    async def fetch_chunks(self, rewritten, table, chunk_size=CHUNK_SIZE):
+        """Run the rewritten query on the server retrieving its result in
+        chunks (see QueryClient.fetch_chunks).
+
+        :rewritten: Rewritten query (or keys to request to the key-value
+            store).
+        :table: Name of the table the query refers to.
+        :chunk_size: Maximum number of groups per chunk.
+        :return: Asynchronous generator of lists of (GroupId, encrypted
+            tuples) pairs, as returned by fetch.
+        """
+        if not self.kvstore:
+            chunks = self._stream(rewritten, table, chunk_size)
+            try:
+                async for rows in chunks:
+                    if self.cache is None:
+                        yield [(None, row[0]) for row in rows]
+                    else:
+                        yield [(row[0], row[1]) for row in rows]
+            finally:
+                await chunks.aclose()
+            return
+
+        kv_store_data = rewritten
+        if not kv_store_data:
+            return
+
+        if "GroupId" in kv_store_data and len(kv_store_data) == 1:
+            gids = list(kv_store_data["GroupId"])
+        elif postings.use_bitmaps(kv_store_data, self.postings):
+            gids = await self._run_bitmaps(kv_store_data)
+        else:
+            keys, args = self._script_args(kv_store_data, table,
+                                           gids_only=True)
+            gids, _ = await self.script(keys=keys, args=args)
+            gids = list(map(int, gids))
+
+        for i in range(0, len(gids), chunk_size):
+            chunk = gids[i:i + chunk_size]
+            to_fetch = [gid for gid in chunk
+                        if self.cache is None or gid not in self.cache]
+            enc_tuples = dict(zip(to_fetch,
+                                  await self.engine.hmget(table, to_fetch)
+                                  if to_fetch else []))
+            yield [(gid, enc_tuples.get(gid)) for gid in chunk]
+
+    async def _stream(self, rewritten, table, chunk_size):
+        """Run the rewritten query yielding its rows in chunks, partition
+        by partition as soon as each subquery completes when partitioned."""
+        partitions = await self._partitions(table)
+        if not partitions:
+            async with self.engine.acquire() as connection:
+                # asyncpg cursors live within a transaction
+                async with connection.transaction():
+                    cursor = await connection.cursor(rewritten)
+                    while True:
+                        rows = await cursor.fetch(chunk_size)
+                        if not rows:
+                            break
+                        yield rows
+            return
+
+        semaphore = asyncio.Semaphore(self.partitions)
+
+        async def fetch(partition):
+            async with semaphore:
+                return await self.engine.fetch(
+                    rename_table(rewritten, table, partition))
+
+        tasks = [asyncio.ensure_future(fetch(partition))
+                 for partition in partitions]
+        try:
+            for task in asyncio.as_completed(tasks):
+                rows = await task
+                for i in range(0, len(rows), chunk_size):
+                    yield rows[i:i + chunk_size]
+        finally:
+            # Stop the subqueries when the caller stops early
+            for task in tasks:
+                task.cancel()
+
+    async def _partitions(self, table):
+        """Return the partitions of the table (none when not partitioned
+        or when partitions are not queried concurrently)."""
+        if self.partitions <= 1:
+            return []
+        if table not in self.partitions_of:
+            rows = await self.engine.fetch(PARTITIONS_QUERY, f"\"{table}\"")
+            self.partitions_of[table] = [row[0] for row in rows]
+        return self.partitions_of[table]
+
+    async def _execute(self, rewritten, table):
+        """Run the rewritten query, as concurrent subqueries on the
+        partitions of the table when partitioned."""
+        partitions = await self._partitions(table)
+        if not partitions:
+            return await self.engine.fetch(rewritten)
+        # Bound the subqueries in flight to the number of partitions
+        semaphore = asyncio.Semaphore(self.partitions)
+
+        async def fetch(partition):
+            async with semaphore:
+                return await self.engine.fetch(
+                    rename_table(rewritten, table, partition))
+
+        results = await asyncio.gather(*map(fetch, partitions))
+        return [row for rows in results for row in rows]
+
+    async def _run_bitmaps(self, kv_store_data):
+        """Retrieve the roaring posting lists of the labels and intersect
+        them client-side."""
+        chunks = postings.requests(kv_store_data, CHUNK_SIZE)
+        pipe = self.engine.pipeline(transaction=False)
+        for column, labels in chunks:
+            pipe.hmget(postings.key_of(column), labels)
+        replies = await pipe.execute() if chunks else []
+        with self.metrics.measure("postings", items=len(chunks)):
+            return postings.evaluate(kv_store_data, chunks, replies)
+
+    async def _hmget(self, table, gids):
+        pipe = self.engine.pipeline(transaction=False)
+        for i in range(0, len(gids), CHUNK_SIZE):
+            pipe.hmget(table, gids[i:i + CHUNK_SIZE])
+        return [row for rows in await pipe.execute() for row in rows]
+
+    async def _fetch_by_gid(self, table, gids):
+        """Retrieve encrypted tuples of the given groups by GroupId."""
+        if self.kvstore:
+            return list(zip(gids, await self._hmget(table, gids)))
+        query = f"SELECT \"GroupId\", \"EncTuples\" FROM \"{table}\" " + \
+                f"WHERE \"GroupId\" IN (VALUES ({to_string(gids)}))"
+        return [(row[0], row[1]) for row in await self.engine.fetch(query)]
+
+    def _decode(self, to_decrypt):
+        """Decrypt, decompress and deserialize the tuples of the groups."""
+        return [self.decrypt(enc_tuples) for _, enc_tuples in to_decrypt]
+
+    async def retrieve(self, query):
+        """Retrieve the plaintext tuples of the groups matching the query.
+
+        :query: Plaintext query.
+        :return: List of plaintext tuples (including spurious ones) and the
+            name of the table the query refers to.
+        """
+        rewritten, table = self.rewrite(query)
+
+        start = time.perf_counter()
+        rows = await self.fetch(rewritten, table)
+        self.metrics.record("fetch", time.perf_counter() - start,
+                            _size(rows), len(rows))
+        return await self.decrypt_rows(rows, table), table
+
+    async def decrypt_rows(self, rows, table):
+        """Decrypt the groups retrieved from the server (see
+        QueryClient.decrypt_rows)."""
+        tuples, to_decrypt, evicted = self._lookup(rows)
+
+        # Retrieve groups evicted since the query was rewritten
+        if evicted:
+            to_decrypt.extend(await self._fetch_by_gid(table, evicted))
+
+        loop = asyncio.get_running_loop()
+        groups = await loop.run_in_executor(self.executor,
+                                            self._decode,
+                                            to_decrypt)
+        return self._collect((tuples, to_decrypt, groups))
+
+    async def decrypt_chunks(self, rewritten, table, chunk_size=CHUNK_SIZE):
+        """Fetch and decrypt the groups matching the query chunk by chunk.
+
+        :rewritten: Rewritten query (or keys to request to the key-value
+            store).
+        :table: Name of the table the query refers to.
+        :chunk_size: Maximum number of groups per chunk.
+        :return: Asynchronous generator of lists of plaintext tuples.
+        """
+        chunks = self.fetch_chunks(rewritten, table, chunk_size)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    rows = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return
+                self.metrics.record("fetch", time.perf_counter() - start,
+                                    _size(rows), len(rows))
+                yield await self.decrypt_rows(rows, table)
+        finally:
+            # Release the server-side cursor when the caller stops early
+            await chunks.aclose()
+
+    async def stream(self, query, chunk_size=CHUNK_SIZE):
+        """Run the plaintext query against the wrapped dataset chunk by chunk
+        (see QueryClient.stream).
+
+        :query: Plaintext query.
+        :chunk_size: Maximum number of groups per chunk.
+        :return: Asynchronous generator of DataFrames with batches of the
+            query result.
+        """
+        rewritten, table = self.rewrite(query)
+        results = _Stream(query, self.mapping.schema, table, self.metrics)
+        loop = asyncio.get_running_loop()
+
+        if not results.done:
+            chunks = self.decrypt_chunks(rewritten, table, chunk_size)
+            try:
+                async for tuples in chunks:
+                    result = await loop.run_in_executor(self.executor,
+                                                        results.feed,
+                                                        tuples)
+                    if result is not None:
+                        yield result
+                    if results.done:
+                        break
+            finally:
+                await chunks.aclose()
+
+        result = await loop.run_in_executor(self.executor, results.finish)
+        if result is not None:
+            yield result
+
+    async def _execute_columnar(self, query):
+        """Run the plaintext query decoding only the columns it refers to
+        (see QueryClient._execute_columnar)."""
+        evaluator, indices = self._columns_of(query)
+
+        rewritten, table = self.rewrite(query)
+        start = time.perf_counter()
+        rows = await self.fetch(rewritten, table)
+        self.metrics.record("fetch", time.perf_counter() - start,
+                            _size(rows), len(rows))
+
+        loop = asyncio.get_running_loop()
+        decode = partial(self.decrypt_columns, indices=indices)
+        groups = await loop.run_in_executor(
+            self.executor,
+            lambda: [decode(enc_tuples) for _, enc_tuples in rows])
+        return await loop.run_in_executor(self.executor,
+                                          self._filter_columns,
+                                          query,
+                                          evaluator,
+                                          indices,
+                                          groups,
+                                          table)
+
+    async def execute(self, query):
+        """Run the plaintext query against the wrapped dataset.
+
+        :query: Plaintext query.
+        :return: DataFrame with the result of the query.
+        """
+        state = parse(query)
+        if state.limit is not None and _row_wise(compile_filter(state)):
+            # Stop fetching the groups once the LIMIT is reached
+            return _concat([result async for result
+                            in self.stream(query, LIMIT_CHUNK_SIZE)])
+
+        if self.columnar and self.cache is None:
+            return await self._execute_columnar(query)
+
+        tuples, table = await self.retrieve(query)
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        result = await loop.run_in_executor(self.executor,
+                                            filter_tuples,
+                                            query,
+                                            tuples,
+                                            self.mapping.schema,
+                                            table)
+        self.metrics.record("filter", time.perf_counter() - start,
+                            items=len(tuples))
+        return result
@@ -0,0 +1,440 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bulk loading of the wrapped dataset into the server.
+
+PostgreSQL tables are loaded with binary COPY FROM STDIN into an unlogged
+staging table, one chunk of rows at a time over several connections. The
+staging table replaces the target table once loaded, then its indexes are
+built in parallel. Partitioned tables are loaded the same way, the parent
+routing the rows to its partitions.
+
+Redis hashes and posting lists are loaded in bounded chunks, each sent as a
+pipeline over one of several connections. Commands are idempotent (HSET,
+SADD), so chunks failing for transient errors are retried as a whole.
+"""
+
+import io
+import math
+import queue
+import struct
+import threading
+import time
+
+import redis
+
+if __package__:
+    from .metrics import StageMetrics
+else:
+    from secure_index.metrics import StageMetrics
+
+
+# Number of rows sent by a single COPY or pipeline
+CHUNK_SIZE = 10000
+
+# Number of fields set by a single HSET
+HSET_SIZE = 1000
+
+# Number of attempts of a failing chunk and delay before the first retry
+RETRIES = 3
+BACKOFF = 0.5
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+
+PGCOPY_TRAILER = struct.pack(">h", -1)
+
+NULL = struct.pack(">i", -1)
+
+INTEGERS = {
+    "smallint": struct.Struct(">ih"),
+    "integer": struct.Struct(">ii"),
+    "bigint": struct.Struct(">iq"),
+}
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _encoder(type):
+    if type in INTEGERS:
+        packer = INTEGERS[type]
+        size = packer.size - 4
+        return lambda value: packer.pack(size, int(value))
+    if type == "bytea":
+        return lambda value: struct.pack(">i", len(value)) + bytes(value)
+    if type == "text":
+        def encode(value):
+            data = str(value).encode("utf-8")
+            return struct.pack(">i", len(data)) + data
+        return encode
+    raise Exception(f"Cannot COPY columns of type {type}.")
+
+
+def encode_copy(rows, types):
+    """Encode the rows in the binary COPY format of PostgreSQL.
+
+    :rows: Iterable of rows, one value per column.
+    :types: List of the PostgreSQL types of the columns: smallint, integer,
+        bigint, text or bytea.
+    :return: Bytes to send to COPY FROM STDIN WITH (FORMAT binary).
+    """
+    encoders = [_encoder(type) for type in types]
+    count = struct.pack(">h", len(types))
+    chunks = [PGCOPY_HEADER]
+    for row in rows:
+        chunks.append(count)
+        for encode, value in zip(encoders, row):
+            chunks.append(NULL if _is_null(value) else encode(value))
+    chunks.append(PGCOPY_TRAILER)
+    return b"".join(chunks)
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def partition_bounds(method, partitions, splits=None):
+    """Return the FOR VALUES clauses of the partitions of a table.
+
+    :method: Partitioning method: hash or range.
+    :partitions: Number of partitions.
+    :splits: Sorted list of the partitions - 1 values separating the ranges
+        of consecutive partitions (range partitioning only).
+    :return: List of the clauses, one per partition.
+    """
+    if method == "hash":
+        return [f"WITH (MODULUS {partitions}, REMAINDER {i})"
+                for i in range(partitions)]
+    if method == "range":
+        if splits is None or len(splits) != partitions - 1:
+            raise Exception(f"{partitions} range partitions need " +
+                            f"{partitions - 1} split values.")
+        extremes = ["MINVALUE"] + list(map(_literal, splits)) + ["MAXVALUE"]
+        return [f"FROM ({extremes[i]}) TO ({extremes[i + 1]})"
+                for i in range(partitions)]
+    raise Exception(f"{method} is not a valid partitioning method.")
+
+
+def partition_name(name, i):
+    """Return the name of the i-th partition of a table."""
+    return f"{name}_p{i}"
+
+
+def copy_table(engine,
+               name,
+               columns,
+               types,
+               chunks,
+               connections=4,
+               logged=True,
+               metrics=None,
+               partition_by=None,
+               partitions=1,
+               method="hash",
+               splits=None):
+    """Replace the table with the given rows using binary COPY.
+
+    Rows are loaded into an unlogged staging table by parallel connections,
+    each copying a chunk of rows at a time. Once loaded, the staging table is
+    made logged (when requested) and renamed to the given name.
+
+    When partitioned, the staging table is the parent of unlogged partitions
+    the rows are routed to, and the partitions are renamed alongside it.
+
+    :engine: SQLAlchemy engine of the PostgreSQL database.
+    :name: Name of the table.
+    :columns: List of column names.
+    :types: List of PostgreSQL types of the columns.
+    :chunks: Iterable of lists of rows.
+    :connections: Number of parallel connections. Defaults to 4.
+    :logged: Whether to make the table logged after the load. Defaults to
+        True, otherwise the table is truncated on crash recovery.
+    :metrics: Optional StageMetrics recording the encode and copy stages.
+    :partition_by: Column to partition the table by. Defaults to None (no
+        partitioning).
+    :partitions: Number of partitions. Defaults to 1.
+    :method: Partitioning method: hash (default) or range.
+    :splits: Values separating the range partitions (see partition_bounds).
+    :return: Number of rows and of bytes copied.
+    """
+    metrics = metrics if metrics is not None else StageMetrics()
+    staging = name + "_staging"
+    definition = ", ".join(f"{_quote(column)} {type}"
+                           for column, type in zip(columns, types))
+    engine.execute(f"DROP TABLE IF EXISTS {_quote(staging)}")
+    if partition_by is None:
+        tables = [staging]
+        engine.execute(f"CREATE UNLOGGED TABLE {_quote(staging)} " +
+                       f"({definition})")
+    else:
+        # Partitioned tables have no storage, only partitions are unlogged
+        tables = [partition_name(staging, i) for i in range(partitions)]
+        engine.execute(f"CREATE TABLE {_quote(staging)} ({definition}) " +
+                       f"PARTITION BY {method.upper()} " +
+                       f"({_quote(partition_by)})")
+        bounds = partition_bounds(method, partitions, splits)
+        for table, bound in zip(tables, bounds):
+            engine.execute(f"CREATE UNLOGGED TABLE {_quote(table)} " +
+                           f"PARTITION OF {_quote(staging)} " +
+                           f"FOR VALUES {bound}")
+    statement = f"COPY {_quote(staging)} " + \
+                f"({', '.join(map(_quote, columns))}) " + \
+                "FROM STDIN WITH (FORMAT binary)"
+
+    # Bound the chunks waiting for a connection to bound the memory
+    pending = queue.Queue(maxsize=2 * connections)
+    totals = {"rows": 0, "bytes": 0}
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        connection = None
+        try:
+            connection = engine.raw_connection()
+            cursor = connection.cursor()
+        except Exception as e:
+            errors.append(e)
+        try:
+            # Drain the queue until the sentinel, even without a connection,
+            # so that the producer never blocks
+            while True:
+                rows = pending.get()
+                if rows is None:
+                    break
+                if errors:
+                    continue
+                try:
+                    with metrics.measure("encode", items=len(rows)):
+                        data = encode_copy(rows, types)
+                    with metrics.measure("copy", len(data), len(rows)):
+                        cursor.copy_expert(statement, io.BytesIO(data))
+                        connection.commit()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                with lock:
+                    totals["rows"] += len(rows)
+                    totals["bytes"] += len(data)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    try:
+        for rows in chunks:
+            if errors:
+                break
+            if rows:
+                pending.put(list(rows))
+    finally:
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise Exception(f"Cannot COPY into {staging}: {errors[0]}")
+    metrics.record("load", time.perf_counter() - start, totals["bytes"],
+                   totals["rows"])
+
+    with metrics.measure("swap"):
+        if logged:
+            for table in tables:
+                engine.execute(f"ALTER TABLE {_quote(table)} SET LOGGED")
+        engine.execute(f"DROP TABLE IF EXISTS {_quote(name)}")
+        engine.execute(f"ALTER TABLE {_quote(staging)} "
+                       f"RENAME TO {_quote(name)}")
+        if partition_by is not None:
+            for i, table in enumerate(tables):
+                engine.execute("DROP TABLE IF EXISTS " +
+                               f"{_quote(partition_name(name, i))}")
+                engine.execute(f"ALTER TABLE {_quote(table)} RENAME TO " +
+                               f"{_quote(partition_name(name, i))}")
+    return totals["rows"], totals["bytes"]
+
+
+def execute_parallel(engine, statements, connections=4, metrics=None):
+    """Run independent statements (e.g., CREATE INDEX) in parallel.
+
+    :engine: SQLAlchemy engine of the PostgreSQL database.
+    :statements: List of SQL statements.
+    :connections: Number of parallel connections. Defaults to 4.
+    :metrics: Optional StageMetrics recording the time of each statement.
+    """
+    metrics = metrics if metrics is not None else StageMetrics()
+    pending = queue.Queue()
+    for statement in statements:
+        pending.put(statement)
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                statement = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                with metrics.measure("index"):
+                    engine.execute(statement)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(connections, len(statements)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception(f"Cannot build the indexes: {errors[0]}")
+
+
+def _send_chunk(engine, chunk, send, retries, metrics):
+    for attempt in range(retries):
+        try:
+            with metrics.measure("send", items=len(chunk)):
+                pipe = engine.pipeline(transaction=False)
+                send(pipe, chunk)
+                pipe.execute()
+            return
+        except (redis.exceptions.ConnectionError,
+                redis.exceptions.TimeoutError,
+                redis.exceptions.BusyLoadingError):
+            if attempt == retries - 1:
+                raise
+            # Commands are idempotent, resend the whole chunk
+            time.sleep(BACKOFF * 2**attempt)
+
+
+def _load_redis(engine, chunks, send, connections, retries, metrics,
+                progress):
+    # Bound the chunks waiting for a connection to bound the memory
+    pending = queue.Queue(maxsize=2 * connections)
+    totals = {"items": 0}
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            chunk = pending.get()
+            if chunk is None:
+                return
+            if errors:
+                continue
+            try:
+                _send_chunk(engine, chunk, send, retries, metrics)
+            except Exception as e:
+                errors.append(e)
+                continue
+            with lock:
+                totals["items"] += len(chunk)
+                done = totals["items"]
+            if progress is not None:
+                progress(done)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    try:
+        for chunk in chunks:
+            if errors:
+                break
+            if chunk:
+                pending.put(list(chunk))
+    finally:
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise Exception(f"Cannot load the chunks into redis: {errors[0]}")
+    metrics.record("load", time.perf_counter() - start,
+                   items=totals["items"])
+    return totals["items"]
+
+
+def load_hash(engine,
+              name,
+              chunks,
+              connections=4,
+              retries=RETRIES,
+              metrics=None,
+              progress=None):
+    """Set the fields of a Redis hash in parallel chunks.
+
+    :engine: Redis client.
+    :name: Name of the hash.
+    :chunks: Iterable of lists of (field, value) pairs.
+    :connections: Number of parallel connections. Defaults to 4.
+    :retries: Number of attempts of each chunk. Defaults to 3.
+    :metrics: Optional StageMetrics recording the send and load stages.
+    :progress: Optional function called with the number of fields loaded.
+    :return: Number of fields loaded.
+    """
+    def send(pipe, chunk):
+        for i in range(0, len(chunk), HSET_SIZE):
+            pipe.hset(name, mapping=dict(chunk[i:i + HSET_SIZE]))
+
+    metrics = metrics if metrics is not None else StageMetrics()
+    return _load_redis(engine, chunks, send, connections, retries, metrics,
+                       progress)
+
+
+def load_sets(engine,
+              name,
+              chunks,
+              connections=4,
+              retries=RETRIES,
+              metrics=None,
+              progress=None):
+    """Add the members of the Redis sets (name:key) in parallel chunks.
+
+    :engine: Redis client.
+    :name: Prefix of the names of the sets.
+    :chunks: Iterable of lists of (key, members) pairs.
+    :connections: Number of parallel connections. Defaults to 4.
+    :retries: Number of attempts of each chunk. Defaults to 3.
+    :metrics: Optional StageMetrics recording the send and load stages.
+    :progress: Optional function called with the number of sets loaded.
+    :return: Number of sets loaded.
+    """
+    def send(pipe, chunk):
+        for key, members in chunk:
+            pipe.sadd(name + ":" + str(key), *members)
+
+    metrics = metrics if metrics is not None else StageMetrics()
+    return _load_redis(engine, chunks, send, connections, retries, metrics,
+                       progress)
+
+
+def chunked(rows, size=CHUNK_SIZE):
+    """Split an iterable of rows into lists of at most size rows."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,143 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+from collections import OrderedDict
+
+
+def sizeof(tuples):
+    """Estimate the memory occupation of a list of plaintext tuples.
+
+    :tuples: List of plaintext tuples of a group.
+    :return: Approximate size in bytes.
+    """
+    size = sys.getsizeof(tuples)
+    for values in tuples:
+        size += sys.getsizeof(values)
+        size += sum(sys.getsizeof(value) for value in values)
+    return size
+
+
+class GroupCache:
+    """Bounded LRU cache of decrypted groups keyed by GroupId.
+
+    :budget: Maximum memory occupation of the cached groups in bytes.
+    :groups: Ordered dictionary mapping GroupIds to the plaintext tuples of
+        the group, their estimated size and the size of their encrypted
+        representation. The last item is the most recently used.
+    :size: Current memory occupation of the cached groups in bytes.
+    :hits: Number of groups retrieved from the cache.
+    :misses: Number of groups looked up but not found in the cache.
+    :bytes_saved: Number of encrypted bytes not transferred thanks to the
+        cache.
+
+    NOTE: the GroupIds of the cached groups are listed in every rewritten
+          query (or Lua script call), so that the server does not return
+          them. The query text grows with the number of cached groups, hence
+          the client only lists the most recently used ones (its
+          cached_limit): the other cached groups are transferred again, but
+          still not decrypted, and count as hits without saving bytes.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.groups = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, gid):
+        return gid in self.groups
+
+    def __len__(self):
+        return len(self.groups)
+
+    def keys(self, limit=None):
+        """Return the GroupIds of the cached groups.
+
+        :limit: Maximum number of GroupIds to return, the most recently used
+            ones. Defaults to None (all of them).
+        """
+        with self.lock:
+            if limit is None or limit >= len(self.groups):
+                return list(self.groups.keys())
+            keys = []
+            for gid in reversed(self.groups):
+                if len(keys) == limit:
+                    break
+                keys.append(gid)
+            return keys
+
+    def get(self, gid, transferred=False):
+        """Return the plaintext tuples of the group, None when not cached.
+
+        :gid: GroupId of the group.
+        :transferred: Whether the server returned the group anyway, so that
+            only its decryption is saved. Defaults to False.
+        """
+        with self.lock:
+            entry = self.groups.get(gid)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.groups.move_to_end(gid)
+            self.hits += 1
+            tuples, _, enc_size = entry
+            if not transferred:
+                self.bytes_saved += enc_size
+            return tuples
+
+    def put(self, gid, tuples, enc_size, size=None):
+        """Store the plaintext tuples of the group.
+
+        Least recently used groups are evicted to respect the budget. Groups
+        larger than the whole budget are not cached.
+
+        :gid: GroupId of the group.
+        :tuples: Plaintext tuples of the group.
+        :enc_size: Size of the encrypted representation of the group in bytes.
+        :size: Memory occupation of the tuples in bytes. Estimated when None.
+        """
+        if size is None:
+            size = sizeof(tuples)
+        if size > self.budget:
+            return
+        with self.lock:
+            if gid in self.groups:
+                self.size -= self.groups.pop(gid)[1]
+            while self.groups and self.size + size > self.budget:
+                _, (_, evicted, _) = self.groups.popitem(last=False)
+                self.size -= evicted
+            self.groups[gid] = (tuples, size, enc_size)
+            self.size += size
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """Return metrics about the cache usage."""
+        return {
+            "groups": len(self.groups),
+            "size": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "bytes_saved": self.bytes_saved,
+        }
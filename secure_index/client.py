@@ -0,0 +1,881 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import lz4.frame
+import msgpack
+import nacl.exceptions
+import redis
+import snappy
+import zstd
+
+if __package__:
+    from . import columnar
+    from . import cover
+    from .complement import Complement
+    from . import dictionary as zstd_dictionary
+    from . import postings
+    from .filtering import Unsupported
+    from .filtering import compile_filter
+    from .filtering import filter_tuples
+    from .filtering import sqlite_filter
+    from .filtering import to_columns
+    from .metrics import StageMetrics
+    from .rewriting import lookup
+    from .rewriting import rename_table
+    from .rewriting import rewrite
+    from .rewriting import rewrite_table_with_mapping
+    from .rewriting import rewrite_table_with_normalization
+    from .rewriting import to_string
+    from .sqlparser import parse
+    from .sqlparser import without_limit
+else:
+    from secure_index import columnar
+    from secure_index import cover
+    from secure_index.complement import Complement
+    from secure_index import dictionary as zstd_dictionary
+    from secure_index import postings
+    from secure_index.filtering import Unsupported
+    from secure_index.filtering import compile_filter
+    from secure_index.filtering import filter_tuples
+    from secure_index.filtering import sqlite_filter
+    from secure_index.filtering import to_columns
+    from secure_index.metrics import StageMetrics
+    from secure_index.rewriting import lookup
+    from secure_index.rewriting import rename_table
+    from secure_index.rewriting import rewrite
+    from secure_index.rewriting import rewrite_table_with_mapping
+    from secure_index.rewriting import rewrite_table_with_normalization
+    from secure_index.rewriting import to_string
+    from secure_index.sqlparser import parse
+    from secure_index.sqlparser import without_limit
+
+
+CHUNK_SIZE = 10000
+
+# Most recently used cached GroupIds the server is asked not to return (the
+# list is sent with every query, see GroupCache)
+CACHED_LIMIT = 1000
+
+# Groups fetched at a time by queries stopping at their LIMIT
+LIMIT_CHUNK_SIZE = 100
+
+# Partitions of a partitioned table, sorted by name
+PARTITIONS_QUERY = "SELECT c.relname FROM pg_inherits i JOIN pg_class c " + \
+                   "ON c.oid = i.inhrelid " + \
+                   "WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname"
+
+POSTINGS_MODES = postings.MODES
+
+REWRITE_TABLES = {
+    "normal": None,
+    "mapping": rewrite_table_with_mapping,
+    "normalization": rewrite_table_with_normalization
+}
+
+DESERIALIZE = {
+    "json": lambda bytes: json.loads(bytes.decode("utf-8")),
+    "pickle": pickle.loads,
+    "msgpack": msgpack.loads,
+    "columnar": columnar.loads_tuples
+}
+
+DECOMPRESS = {
+    "none": lambda bytes: bytes,
+    "lz4": lz4.frame.decompress,
+    "snappy": snappy.decompress,
+    "zstd": zstd.decompress
+}
+
+
+class QueryClient:
+    """Client running plaintext queries against the wrapped dataset.
+
+    :mapping: Mapping used to rewrite the queries.
+    :box: Secret box used to decrypt the encrypted tuples.
+    :engine: SQLAlchemy engine of the database or Redis client of the
+        key-value store hosting the wrapped dataset.
+    :representation: Server-side representation of the dataset: normal,
+        mapping or normalization.
+    :deserialize: Function deserializing the plaintext tuples of a group.
+    :decompress: Function decompressing the serialized tuples of a group.
+    :script: Lua script querying the key-value store using its indices.
+    :cache: Optional cache of the decrypted groups.
+    :dictionary: Trained zstd dictionary, required by the zstd-dict
+        compression.
+    :workers: Number of threads decrypting, decompressing and deserializing
+        the groups while the following ones are fetched. Decryption and
+        decompression release the GIL. Defaults to 1 (no decode threads).
+    :postings: How the key-value store evaluates the posting lists: lua
+        (server-side, default), roaring (client-side bitmap algebra) or auto
+        (chosen per query).
+    :range_cover: Whether to request the nodes of the range covers uploaded
+        alongside the dataset instead of a label per generalization of the
+        range columns. Defaults to False.
+    :partitions: Number of concurrent subqueries scanning the partitions of
+        a partitioned table, each on its own connection. Defaults to 1 (the
+        table is queried as a whole).
+    :local_mapping: Optional LocalMapping copy of the mapping table of the
+        mapping representation, resolving the conditions to GroupIds
+        client-side so that the server only looks them up by primary key.
+    :complement: Share of the tokens of a column above which the labels of
+        a condition are rewritten to the tokens they exclude with NOT IN, or
+        the condition is dropped when they exclude almost none. Defaults to
+        None (the labels are always requested as they are).
+    :cached_limit: Maximum number of cached GroupIds the server is asked not
+        to return. Defaults to CACHED_LIMIT.
+    :metrics: Time spent and bytes consumed by each stage of the pipeline.
+    """
+
+    def __init__(self,
+                 mapping,
+                 box,
+                 engine,
+                 representation="normal",
+                 serialization="json",
+                 compression="zstd",
+                 script=None,
+                 cache=None,
+                 dictionary=None,
+                 workers=1,
+                 postings="lua",
+                 range_cover=False,
+                 partitions=1,
+                 local_mapping=None,
+                 complement=None,
+                 cached_limit=CACHED_LIMIT):
+        if representation not in REWRITE_TABLES:
+            raise Exception(
+                f"{representation} is not a valid server-side " +
+                "representation of the dataset."
+            )
+        if local_mapping is not None and representation != "mapping":
+            raise Exception("The local mapping table requires the mapping " +
+                            "representation.")
+        self.mapping = mapping
+        self.box = box
+        self.engine = engine
+        self.representation = representation
+        self.deserialize = DESERIALIZE[serialization]
+        self.columnar = serialization == "columnar"
+        if compression == "zstd-dict":
+            if dictionary is None:
+                raise Exception("The zstd-dict compression requires the " +
+                                "trained dictionary.")
+            self.decompress = zstd_dictionary.decompressor(dictionary)
+        else:
+            self.decompress = DECOMPRESS[compression]
+        if postings not in POSTINGS_MODES:
+            raise Exception(f"{postings} is not a valid evaluation mode " +
+                            "of the posting lists.")
+        self.script = script
+        self.cache = cache
+        self.cached_limit = cached_limit
+        self.postings = postings
+        self.covers = cover.build(mapping) if range_cover else None
+        self.complement = Complement.of(mapping, complement) \
+            if complement is not None else None
+        self.kvstore = isinstance(engine, redis.Redis)
+        self.pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.partitions = partitions
+        self.partition_pool = ThreadPoolExecutor(partitions) \
+            if partitions > 1 else None
+        self.partitions_of = {}
+        self.local_mapping = local_mapping
+        self.metrics = StageMetrics()
+
+    def close(self):
+        """Stop the decode and the partition threads."""
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.partition_pool is not None:
+            self.partition_pool.shutdown()
+
+    def rewrite(self, query):
+        """Rewrite the query so that it may be run on the server.
+
+        :query: Plaintext query.
+        :return: The rewritten query (or the keys to request to the key-value
+            store) and the name of the table the query refers to.
+        """
+        cached = self.cache.keys(self.cached_limit) \
+            if self.cache is not None else None
+        if self.local_mapping is not None and not self.kvstore:
+            return self._rewrite_locally(query, cached)
+        with self.metrics.measure("rewrite"):
+            return rewrite(query,
+                           self.mapping,
+                           rewrite_table=REWRITE_TABLES[self.representation],
+                           kv_store_mode=self.kvstore,
+                           with_gid=self.cache is not None,
+                           cached=cached if not self.kvstore else None,
+                           covers=self.covers,
+                           complement=self.complement)
+
+    def _rewrite_locally(self, query, cached):
+        """Resolve the query to GroupIds with the local mapping table and
+        rewrite it to a primary key lookup of their encrypted tuples."""
+        with self.metrics.measure("rewrite"):
+            rewritten, table = rewrite(query,
+                                       self.mapping,
+                                       with_gid=True,
+                                       complement=self.complement)
+        with self.metrics.measure("resolve"):
+            gids = self.local_mapping.resolve(rewritten, table)
+        return lookup(table,
+                      gids,
+                      with_gid=self.cache is not None,
+                      cached=cached), table
+
+    def fetch(self, rewritten, table):
+        """Run the rewritten query on the server.
+
+        :rewritten: Rewritten query (or keys to request to the key-value
+            store).
+        :table: Name of the table the query refers to.
+        :return: List of (GroupId, encrypted tuples) pairs. The GroupId is None
+            when the cache is disabled, the encrypted tuples are None when
+            the group is cached.
+        """
+        if not self.kvstore:
+            rows = self._execute(rewritten, table)
+            if self.cache is None:
+                return [(None, row[0]) for row in rows]
+            return [(gid, enc_tuples) for gid, enc_tuples in rows]
+
+        kv_store_data = rewritten
+        if not kv_store_data:
+            return []
+
+        if "GroupId" in kv_store_data and len(kv_store_data) == 1:
+            gids = list(kv_store_data["GroupId"])
+        elif postings.use_bitmaps(kv_store_data, self.postings):
+            gids = self._run_bitmaps(kv_store_data)
+        else:
+            gids, enc_tuples = self._run_script(kv_store_data, table)
+            return list(zip(gids, enc_tuples))
+
+        to_fetch = [gid for gid in gids
+                    if self.cache is None or gid not in self.cache]
+        enc_tuples = dict(zip(to_fetch, self._hmget(table, to_fetch)))
+        return [(gid, enc_tuples.get(gid)) for gid in gids]
+
+    def _run_bitmaps(self, kv_store_data):
+        """Query the key-value store retrieving the roaring posting lists
+        of the labels and intersecting them client-side.
+
+        :kv_store_data: Dictionary holding for each column the keys to
+            request to the key-value store.
+        :return: List of matching GroupIds.
+        """
+        chunks = postings.requests(kv_store_data, CHUNK_SIZE)
+        pipe = self.engine.pipeline(transaction=False)
+        for column, labels in chunks:
+            pipe.hmget(postings.key_of(column), labels)
+        replies = pipe.execute() if chunks else []
+        with self.metrics.measure("postings", items=len(chunks)):
+            return postings.evaluate(kv_store_data, chunks, replies)
+
+    def _run_script(self, kv_store_data, table, gids_only=False):
+        """Query the key-value store using its indices.
+
+        :kv_store_data: Dictionary holding for each column the keys to
+            request to the key-value store.
+        :table: Name of the hash holding the encrypted tuples.
+        :gids_only: Whether to retrieve only the matching GroupIds. Defaults
+            to False.
+        :return: List of matching GroupIds and list of their encrypted tuples
+            (None when cached).
+        """
+        keys, args = self._script_args(kv_store_data, table, gids_only)
+        gids, enc_tuples = self.script(keys=keys, args=args)
+        return list(map(int, gids)), enc_tuples
+
+    def _script_args(self, kv_store_data, table, gids_only=False):
+        """Return the keys and the arguments of the Lua script."""
+        # Force GroupId as the first column (when present)
+        columns = ["GroupId"] if "GroupId" in kv_store_data else []
+        for column in kv_store_data:
+            if column != "GroupId":
+                columns.append(column)
+        # Labels are packed with msgpack as strings
+        args = [msgpack.packb(list(map(str, kv_store_data[column])))
+                for column in columns]
+        cached = self.cache.keys(self.cached_limit) \
+            if self.cache is not None else []
+        args.append(msgpack.packb(list(map(str, cached))))
+        args.append("1" if gids_only else "0")
+        return [table] + columns, args
+
+    def fetch_chunks(self, rewritten, table, chunk_size=CHUNK_SIZE):
+        """Run the rewritten query on the server retrieving its result in
+        chunks.
+
+        The database uses a server-side cursor, while the key-value store
+        is queried with an HMGET per chunk of GroupIds.
+
+        :rewritten: Rewritten query (or keys to request to the key-value
+            store).
+        :table: Name of the table the query refers to.
+        :chunk_size: Maximum number of groups per chunk.
+        :return: Generator of lists of (GroupId, encrypted tuples) pairs, as
+            returned by fetch.
+        """
+        if not self.kvstore:
+            for rows in self._stream(rewritten, table, chunk_size):
+                if self.cache is None:
+                    yield [(None, row[0]) for row in rows]
+                else:
+                    yield [(gid, enc_tuples) for gid, enc_tuples in rows]
+            return
+
+        kv_store_data = rewritten
+        if not kv_store_data:
+            return
+
+        if "GroupId" in kv_store_data and len(kv_store_data) == 1:
+            gids = list(kv_store_data["GroupId"])
+        elif postings.use_bitmaps(kv_store_data, self.postings):
+            gids = self._run_bitmaps(kv_store_data)
+        else:
+            gids, _ = self._run_script(kv_store_data, table, gids_only=True)
+
+        for i in range(0, len(gids), chunk_size):
+            chunk = gids[i:i + chunk_size]
+            to_fetch = [gid for gid in chunk
+                        if self.cache is None or gid not in self.cache]
+            enc_tuples = dict(zip(to_fetch,
+                                  self.engine.hmget(table, to_fetch)
+                                  if to_fetch else []))
+            yield [(gid, enc_tuples.get(gid)) for gid in chunk]
+
+    def _partitions(self, table):
+        """Return the partitions of the table (none when not partitioned
+        or when partitions are not queried concurrently)."""
+        if self.partition_pool is None:
+            return []
+        if table not in self.partitions_of:
+            rows = self.engine.execute(PARTITIONS_QUERY,
+                                       (f"\"{table}\"",)).fetchall()
+            self.partitions_of[table] = [row[0] for row in rows]
+        return self.partitions_of[table]
+
+    def _execute(self, rewritten, table):
+        """Run the rewritten query, as concurrent subqueries on the
+        partitions of the table when partitioned."""
+        partitions = self._partitions(table)
+        if not partitions:
+            return self.engine.execute(rewritten).fetchall()
+        queries = [rename_table(rewritten, table, partition)
+                   for partition in partitions]
+        results = self.partition_pool.map(
+            lambda query: self.engine.execute(query).fetchall(), queries)
+        return [row for rows in results for row in rows]
+
+    def _stream(self, rewritten, table, chunk_size):
+        """Run the rewritten query yielding its rows in chunks, partition
+        by partition as soon as each subquery completes when partitioned."""
+        partitions = self._partitions(table)
+        if not partitions:
+            with self.engine.connect() as conn:
+                result = conn.execution_options(stream_results=True) \
+                             .execute(rewritten)
+                while True:
+                    rows = result.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+            return
+
+        futures = [
+            self.partition_pool.submit(
+                lambda query: self.engine.execute(query).fetchall(),
+                rename_table(rewritten, table, partition))
+            for partition in partitions
+        ]
+        for future in as_completed(futures):
+            rows = future.result()
+            for i in range(0, len(rows), chunk_size):
+                yield rows[i:i + chunk_size]
+
+    def _hmget(self, table, gids):
+        pipe = self.engine.pipeline(transaction=False)
+        for i in range(0, len(gids), CHUNK_SIZE):
+            pipe.hmget(table, gids[i:i + CHUNK_SIZE])
+        return [row for rows in pipe.execute() for row in rows]
+
+    def _fetch_by_gid(self, table, gids):
+        """Retrieve encrypted tuples of the given groups by GroupId."""
+        if self.kvstore:
+            return list(zip(gids, self._hmget(table, gids)))
+        query = f"SELECT \"GroupId\", \"EncTuples\" FROM \"{table}\" " + \
+                f"WHERE \"GroupId\" IN (VALUES ({to_string(gids)}))"
+        return self.engine.execute(query).fetchall()
+
+    def decrypt(self, enc_tuples):
+        """Decrypt, decompress and deserialize the tuples of a group.
+
+        :enc_tuples: Encrypted tuples of a group.
+        :return: List of plaintext tuples.
+        """
+        serialized = self._open(enc_tuples)
+        with self.metrics.measure("deserialize", len(serialized)):
+            return self.deserialize(serialized)
+
+    def decrypt_columns(self, enc_tuples, indices=None):
+        """Decrypt, decompress and deserialize the columns of a group stored
+        with the columnar serialization.
+
+        :enc_tuples: Encrypted tuples of a group.
+        :indices: Positions of the columns to decode. Defaults to all of them.
+        :return: Dictionary mapping the positions of the decoded columns to
+            NumPy arrays.
+        """
+        serialized = self._open(enc_tuples)
+        with self.metrics.measure("deserialize", len(serialized)):
+            return columnar.loads(serialized, indices)[1]
+
+    def _open(self, enc_tuples):
+        """Decrypt the tuples of a group, strip the padding and decompress
+        them."""
+        start = time.perf_counter()
+        try:
+            plaintext = self.box.decrypt(bytes(enc_tuples))
+        except nacl.exceptions.CryptoError:
+            raise Exception(
+                "Something has gone wrong with the decryption of the tuples."
+            )
+        lpadding = int.from_bytes(plaintext[:2], byteorder='little',
+                                  signed=False)
+        compressed = plaintext[2:-lpadding] if lpadding else plaintext[2:]
+        decrypted = time.perf_counter()
+        serialized = self.decompress(compressed)
+        decompressed = time.perf_counter()
+
+        self.metrics.record("decrypt", decrypted - start, len(enc_tuples))
+        self.metrics.record("decompress", decompressed - decrypted,
+                            len(compressed))
+        return serialized
+
+    def retrieve(self, query):
+        """Retrieve the plaintext tuples of the groups matching the query.
+
+        :query: Plaintext query.
+        :return: List of plaintext tuples (including spurious ones) and the
+            name of the table the query refers to.
+        """
+        rewritten, table = self.rewrite(query)
+        if self.pool is not None:
+            # Overlap decoding with the fetch of the following chunks
+            chunks = self.decrypt_chunks(rewritten, table)
+            return [values for tuples in chunks for values in tuples], table
+
+        start = time.perf_counter()
+        rows = self.fetch(rewritten, table)
+        self.metrics.record("fetch", time.perf_counter() - start,
+                            _size(rows), len(rows))
+        return self.decrypt_rows(rows, table), table
+
+    def decrypt_rows(self, rows, table):
+        """Decrypt the groups retrieved from the server.
+
+        Groups the server did not return as they are cached are taken from
+        the cache (or retrieved again when evicted in the meantime).
+
+        :rows: List of (GroupId, encrypted tuples) pairs, as returned by fetch.
+        :table: Name of the table the query refers to.
+        :return: List of plaintext tuples.
+        """
+        return self._collect(self._schedule(rows, table))
+
+    def decrypt_chunks(self, rewritten, table, chunk_size=CHUNK_SIZE):
+        """Fetch and decrypt the groups matching the query chunk by chunk.
+
+        With decode threads, a chunk is decrypted while the following one is
+        fetched.
+
+        :rewritten: Rewritten query (or keys to request to the key-value
+            store).
+        :table: Name of the table the query refers to.
+        :chunk_size: Maximum number of groups per chunk.
+        :return: Generator of lists of plaintext tuples.
+        """
+        chunks = self.fetch_chunks(rewritten, table, chunk_size)
+        scheduled = None
+        try:
+            while True:
+                start = time.perf_counter()
+                rows = next(chunks, None)
+                if rows is not None:
+                    self.metrics.record("fetch", time.perf_counter() - start,
+                                        _size(rows), len(rows))
+                following = None if rows is None \
+                    else self._schedule(rows, table)
+                if scheduled is not None:
+                    yield self._collect(scheduled)
+                if following is None:
+                    return
+                scheduled = following
+        finally:
+            # Release the server-side cursor when the caller stops early
+            chunks.close()
+
+    def _schedule(self, rows, table):
+        """Start decoding the groups retrieved from the server.
+
+        Cached groups are collected before caching new ones may evict them.
+
+        :rows: List of (GroupId, encrypted tuples) pairs, as returned by fetch.
+        :table: Name of the table the query refers to.
+        :return: Plaintext tuples of the cached groups, the (GroupId, encrypted
+            tuples) pairs to decode and their decoded groups (or futures).
+        """
+        tuples, to_decrypt, evicted = self._lookup(rows)
+
+        # Retrieve groups evicted since the query was rewritten
+        if evicted:
+            to_decrypt.extend(self._fetch_by_gid(table, evicted))
+
+        if self.pool is None:
+            groups = [self.decrypt(enc_tuples) for _, enc_tuples in to_decrypt]
+        else:
+            groups = [self.pool.submit(self.decrypt, enc_tuples)
+                      for _, enc_tuples in to_decrypt]
+        return tuples, to_decrypt, groups
+
+    def _lookup(self, rows):
+        """Split the groups retrieved from the server into cached ones and
+        ones to decode.
+
+        Groups returned although cached (those beyond the cached GroupIds
+        listed in the query) are taken from the cache as well.
+
+        :rows: List of (GroupId, encrypted tuples) pairs, as returned by fetch.
+        :return: Plaintext tuples of the cached groups, the (GroupId, encrypted
+            tuples) pairs to decode and the GroupIds of the groups evicted
+            from the cache since the query was rewritten.
+        """
+        tuples = []
+        to_decrypt = []
+        evicted = []
+        for gid, enc_tuples in rows:
+            if self.cache is None:
+                to_decrypt.append((gid, enc_tuples))
+                continue
+            group = self.cache.get(gid, transferred=enc_tuples is not None)
+            if group is not None:
+                tuples.extend(group)
+            elif enc_tuples is None:
+                evicted.append(gid)
+            else:
+                to_decrypt.append((gid, enc_tuples))
+        return tuples, to_decrypt, evicted
+
+    def _collect(self, scheduled):
+        """Wait for the groups to be decoded and cache them.
+
+        :scheduled: Result of _schedule.
+        :return: List of plaintext tuples.
+        """
+        tuples, to_decrypt, groups = scheduled
+        for (gid, enc_tuples), group in zip(to_decrypt, groups):
+            if self.pool is not None:
+                group = group.result()
+            if self.cache is not None:
+                # Already counted as a miss by the lookup
+                self.cache.put(gid, group, len(enc_tuples))
+            tuples.extend(group)
+        return tuples
+
+    def execute(self, query):
+        """Run the plaintext query against the wrapped dataset.
+
+        :query: Plaintext query.
+        :return: DataFrame with the result of the query.
+        """
+        state = parse(query)
+        if state.limit is not None and _row_wise(compile_filter(state)):
+            # Stop fetching the groups once the LIMIT is reached
+            return _concat(list(self.stream(query, LIMIT_CHUNK_SIZE)))
+
+        if self.columnar and self.cache is None:
+            return self._execute_columnar(query)
+
+        tuples, table = self.retrieve(query)
+        with self.metrics.measure("filter", items=len(tuples)):
+            return filter_tuples(query, tuples, self.mapping.schema, table)
+
+    def _execute_columnar(self, query):
+        """Run the plaintext query decoding only the columns it refers to
+        straight into NumPy arrays.
+
+        :query: Plaintext query.
+        :return: DataFrame with the result of the query.
+        """
+        evaluator, indices = self._columns_of(query)
+
+        rewritten, table = self.rewrite(query)
+        start = time.perf_counter()
+        rows = self.fetch(rewritten, table)
+        self.metrics.record("fetch", time.perf_counter() - start,
+                            _size(rows), len(rows))
+
+        enc_groups = [enc_tuples for _, enc_tuples in rows]
+        decode = partial(self.decrypt_columns, indices=indices)
+        if self.pool is None:
+            groups = [decode(enc_tuples) for enc_tuples in enc_groups]
+        else:
+            groups = list(self.pool.map(decode, enc_groups))
+        return self._filter_columns(query, evaluator, indices, groups, table)
+
+    def _columns_of(self, query):
+        """Compile the query and return its evaluator (None when not
+        supported) and the positions of the columns it refers to."""
+        schema = self.mapping.schema
+        evaluator = compile_filter(parse(query))
+        indices = _indices(schema, evaluator.references
+                                   if evaluator is not None else None)
+        return evaluator, indices
+
+    def _filter_columns(self, query, evaluator, indices, groups, table):
+        """Run the query on the columns decoded from the groups.
+
+        :query: Plaintext query.
+        :evaluator: Compiled query, None when not supported.
+        :indices: Positions of the decoded columns.
+        :groups: List of dictionaries mapping the positions of the decoded
+            columns to NumPy arrays, one for each group.
+        :table: Name of the table the query refers to.
+        :return: DataFrame with the result of the query.
+        """
+        names = [self.mapping.schema[i] for i in indices]
+        start = time.perf_counter()
+        if groups:
+            columns = {
+                name: np.concatenate([group[i] for group in groups])
+                for i, name in zip(indices, names)
+            }
+        else:
+            columns = to_columns([], names)
+        result = evaluator(columns) if evaluator is not None else None
+        if result is None:
+            result = sqlite_filter(query, _to_tuples([columns]), names, table)
+        self.metrics.record("filter", time.perf_counter() - start,
+                            items=_length(columns))
+        return result
+
+    def stream(self, query, chunk_size=CHUNK_SIZE):
+        """Run the plaintext query against the wrapped dataset chunk by chunk.
+
+        Groups are fetched, decrypted and filtered one chunk at a time, so
+        that memory usage is bounded by the chunk size (plus the rows
+        satisfying the WHERE clause when the query needs all of them, e.g.,
+        aggregates and ORDER BY). Queries working row by row stop fetching
+        the groups as soon as they have produced the rows their LIMIT and
+        OFFSET require.
+
+        :query: Plaintext query.
+        :chunk_size: Maximum number of groups per chunk.
+        :return: Generator of DataFrames with batches of the query result.
+        """
+        rewritten, table = self.rewrite(query)
+        results = _Stream(query, self.mapping.schema, table, self.metrics)
+
+        if not results.done:
+            chunks = self.decrypt_chunks(rewritten, table, chunk_size)
+            for tuples in chunks:
+                result = results.feed(tuples)
+                if result is not None:
+                    yield result
+                if results.done:
+                    break
+            chunks.close()
+
+        result = results.finish()
+        if result is not None:
+            yield result
+
+
+class _Stream:
+    """Client-side filtering of the result of a query chunk by chunk (see
+    QueryClient.stream).
+
+    :query: Plaintext query.
+    :schema: List of column names of the plaintext tuples.
+    :table: Name of the table the query refers to.
+    :metrics: Metrics recording the time spent filtering.
+    """
+
+    def __init__(self, query, schema, table, metrics):
+        state = parse(query)
+        self.query = query
+        self.schema = schema
+        self.table = table
+        self.metrics = metrics
+        self.evaluator = compile_filter(state)
+        # Queries working row by row produce their results chunk by chunk
+        self.row_wise = _row_wise(self.evaluator)
+        # and apply LIMIT and OFFSET across the chunks
+        self.unlimited = without_limit(state)
+        self.skip = state.offset or 0
+        self.remaining = state.limit
+        # Rows satisfying the WHERE clause, as column arrays
+        self.selected = []
+        # Plaintext tuples waiting to be filtered by SQLite
+        self.pending = [] if self.evaluator is None else None
+        self.produced = False
+
+    @property
+    def done(self):
+        """Whether the LIMIT is reached, so that no more groups are needed."""
+        return self.row_wise and self.remaining == 0
+
+    def feed(self, tuples):
+        """Filter a chunk of plaintext tuples.
+
+        :tuples: List of plaintext tuples.
+        :return: DataFrame with the result rows of the chunk, None when the
+            query needs every row before producing its result.
+        """
+        if not tuples:
+            return None
+        start = time.perf_counter()
+
+        if self.row_wise:
+            result = self.evaluator(to_columns(tuples, self.schema),
+                                    limit=False)
+            if result is None:
+                result = sqlite_filter(self.unlimited, tuples, self.schema,
+                                       self.table)
+            if self.skip:
+                skipped = min(self.skip, len(result.index))
+                result = result.iloc[skipped:].reset_index(drop=True)
+                self.skip -= skipped
+            if self.remaining is not None:
+                result = result.iloc[:self.remaining]
+                self.remaining -= len(result.index)
+            self.metrics.record("filter", time.perf_counter() - start,
+                                items=len(tuples))
+            self.produced = True
+            return result
+
+        if self.pending is not None:
+            self.pending.extend(tuples)
+        else:
+            try:
+                self.selected.append(self.evaluator.select(
+                    to_columns(tuples, self.schema)))
+            except Unsupported:
+                self.pending = _to_tuples(self.selected) + tuples
+                self.selected = None
+        self.metrics.record("filter", time.perf_counter() - start,
+                            items=len(tuples))
+        return None
+
+    def finish(self):
+        """Return the DataFrame with the rest of the result, None when every
+        row has already been returned."""
+        if self.row_wise:
+            if self.produced:
+                return None
+            return filter_tuples(self.query, [], self.schema, self.table)
+
+        start = time.perf_counter()
+        result = None
+        if self.pending is None:
+            try:
+                result = self.evaluator.finalize(
+                    _concatenate(self.selected, self.schema))
+            except Unsupported:
+                self.pending = _to_tuples(self.selected)
+        if result is None:
+            result = sqlite_filter(self.query, self.pending, self.schema,
+                                   self.table)
+        self.metrics.record("filter", time.perf_counter() - start, items=0)
+        return result
+
+
+def _row_wise(evaluator):
+    """Return whether the compiled query produces its result rows tuple by
+    tuple (no aggregation nor ordering)."""
+    return evaluator is not None and \
+           not evaluator.is_aggregate and not evaluator.order_by
+
+
+def _concat(results):
+    """Concatenate the DataFrames of a streamed result."""
+    if len(results) == 1:
+        return results[0]
+    return pd.concat(results, ignore_index=True)
+
+
+def _size(rows):
+    """Return the number of encrypted bytes retrieved from the server."""
+    return sum(len(enc_tuples) for _, enc_tuples in rows
+               if enc_tuples is not None)
+
+
+def _indices(schema, references):
+    """Return the positions of the columns a query refers to.
+
+    :schema: List of column names of the plaintext tuples.
+    :references: Names of the columns the query refers to, None for all.
+    :return: Sorted list of positions, holding at least one column so that
+        the number of rows is known.
+    """
+    if references is None:
+        return list(range(len(schema)))
+    lowered = [column.lower() for column in schema]
+    indices = set()
+    for name in references:
+        if name in schema:
+            indices.add(schema.index(name))
+        elif lowered.count(name.lower()) == 1:
+            indices.add(lowered.index(name.lower()))
+        else:
+            # Let the evaluation report the unknown column
+            return list(range(len(schema)))
+    return sorted(indices) if indices else [0]
+
+
+def _length(columns):
+    return len(next(iter(columns.values()))) if columns else 0
+
+
+def _concatenate(chunks, schema):
+    """Concatenate chunks of column arrays."""
+    if not chunks:
+        return to_columns([], schema)
+    return {
+        column: np.concatenate([chunk[column] for chunk in chunks])
+        for column in chunks[0]
+    }
+
+
+def _to_tuples(chunks):
+    """Transform chunks of column arrays back to plaintext tuples."""
+    return [
+        values
+        for chunk in chunks
+        for values in zip(*(array.tolist() for array in chunk.values()))
+    ]
@@ -0,0 +1,204 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Columnar serialization of the plaintext tuples of a group.
+
+A group is stored as:
+
+    header length (4 bytes, little endian) | header | column payloads
+
+where the header is a MessagePack list holding the number of rows and, for
+each column, its kind and the length of its payload, so that columns can be
+skipped without decoding them. Column kinds are:
+
+    i   integers, zigzag varints of the deltas between consecutive values
+    f   floats, little endian float64 values
+    s   strings, dictionary (MessagePack list) followed by fixed-width codes
+    o   anything else (e.g., NULL values), MessagePack list of the values
+
+Typed columns are decoded straight into NumPy arrays.
+"""
+
+import numpy as np
+import msgpack
+
+
+HEADER_SIZE = 4
+
+
+def dumps(tuples):
+    """Serialize the plaintext tuples of a group.
+
+    :tuples: List of plaintext tuples.
+    :return: Columnar representation of the tuples.
+    """
+    return dumps_columns([np.array(values) for values in zip(*tuples)],
+                         len(tuples))
+
+
+def dumps_columns(arrays, length=None):
+    """Serialize the column arrays of a group.
+
+    :arrays: List of arrays (or lists) of the same length.
+    :length: Number of rows. Defaults to the length of the first array.
+    :return: Columnar representation of the columns.
+    """
+    if length is None:
+        length = len(arrays[0]) if arrays else 0
+
+    kinds = []
+    payloads = []
+    for array in arrays:
+        kind, payload = _encode(np.asarray(array))
+        kinds.append((kind, len(payload)))
+        payloads.append(payload)
+
+    header = msgpack.dumps([length, kinds])
+    size = len(header).to_bytes(HEADER_SIZE, byteorder='little', signed=False)
+    return b''.join([size, header, *payloads])
+
+
+def loads(data, indices=None):
+    """Deserialize the columns of a group.
+
+    :data: Columnar representation of the tuples.
+    :indices: Positions of the columns to decode. Defaults to all of them.
+    :return: Number of rows and dictionary mapping the positions of the
+        decoded columns to NumPy arrays.
+    """
+    data = memoryview(data)
+    size = int.from_bytes(data[:HEADER_SIZE], byteorder='little',
+                          signed=False)
+    length, kinds = msgpack.loads(data[HEADER_SIZE:HEADER_SIZE + size])
+    wanted = range(len(kinds)) if indices is None else set(indices)
+
+    columns = {}
+    offset = HEADER_SIZE + size
+    for i, (kind, nbytes) in enumerate(kinds):
+        if i in wanted:
+            payload = data[offset:offset + nbytes]
+            columns[i] = _decode(kind, payload, length)
+        offset += nbytes
+    return length, columns
+
+
+def loads_tuples(data):
+    """Deserialize the plaintext tuples of a group.
+
+    :data: Columnar representation of the tuples.
+    :return: List of plaintext tuples.
+    """
+    _, columns = loads(data)
+    return list(zip(*(array.tolist() for array in columns.values())))
+
+
+def _encode(array):
+    if array.dtype.kind == "O":
+        array = _infer(array)
+
+    if array.dtype.kind in "biu":
+        values = array.astype(np.int64)
+        deltas = np.diff(values, prepend=np.int64(0))
+        return "i", _varint_encode(_zigzag_encode(deltas))
+    if array.dtype.kind == "f":
+        return "f", array.astype("<f8").tobytes()
+    if array.dtype.kind in "SU":
+        dictionary, codes = np.unique(array.astype(str), return_inverse=True)
+        encoded = msgpack.dumps(dictionary.tolist())
+        size = len(encoded).to_bytes(HEADER_SIZE, byteorder='little',
+                                     signed=False)
+        width = _code_type(len(dictionary))
+        return "s", size + encoded + codes.astype(width).tobytes()
+    return "o", msgpack.dumps(array.tolist())
+
+
+def _decode(kind, payload, length):
+    if kind == "i":
+        deltas = _zigzag_decode(_varint_decode(payload))
+        return np.cumsum(deltas, dtype=np.int64)
+    if kind == "f":
+        return np.frombuffer(payload, dtype="<f8", count=length)
+    if kind == "s":
+        size = int.from_bytes(payload[:HEADER_SIZE], byteorder='little',
+                              signed=False)
+        dictionary = msgpack.loads(payload[HEADER_SIZE:HEADER_SIZE + size])
+        codes = np.frombuffer(payload[HEADER_SIZE + size:],
+                              dtype=_code_type(len(dictionary)),
+                              count=length)
+        return np.array(dictionary, dtype=str)[codes]
+    values = msgpack.loads(payload)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _infer(array):
+    """Find a typed representation of an array of Python objects."""
+    values = array.tolist()
+    if all(isinstance(value, str) for value in values):
+        return np.array(values, dtype=str)
+    if all(isinstance(value, int) for value in values):
+        try:
+            return np.array(values, dtype=np.int64)
+        except OverflowError:
+            return array
+    if all(isinstance(value, (int, float)) for value in values):
+        return np.array(values, dtype=np.float64)
+    return array
+
+
+def _code_type(size):
+    if size <= 2**8:
+        return "<u1"
+    if size <= 2**16:
+        return "<u2"
+    return "<u4"
+
+
+def _zigzag_encode(values):
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _zigzag_decode(values):
+    return ((values >> np.uint64(1)).view(np.int64) ^
+            -(values & np.uint64(1)).view(np.int64))
+
+
+def _varint_encode(values):
+    """Encode unsigned integers as little endian base 128 varints."""
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        lengths += values >= np.uint64(1) << np.uint64(7 * k)
+    offsets = np.cumsum(lengths) - lengths
+
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max()) if len(values) else 0):
+        mask = lengths > k
+        groups = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (lengths[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[offsets[mask] + k] = groups | more
+    return out.tobytes()
+
+
+def _varint_decode(payload):
+    """Decode little endian base 128 varints."""
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    groups = (data & 0x7f).astype(np.uint64) << \
+        (7 * positions).astype(np.uint64)
+    return np.bitwise_or.reduceat(groups, starts)
@@ -0,0 +1,90 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Complement of the labels selecting most of the domain of a column.
+
+Conditions such as "AGE" <> 18 or "WAGP" >= 0 select nearly every label of
+their column, which would be inlined in the rewritten query. When the labels
+cover more than a share of the tokens of the column, the condition is
+rewritten to the few tokens it excludes with NOT IN. When the tokens excluded
+are so few that the spurious tuples they carry cost less than shipping and
+probing the list, or there are none at all, the condition is dropped and the
+server scans the table, leaving the client to filter the spurious tuples.
+
+NOTE: only the queries run on the DBMS are rewritten, on the key-value store
+      the labels are the keys of the posting lists to request.
+
+NOTE: the shares are shares of the tokens, not of the groups they label, as
+      the mapping does not record how many groups carry each token. The
+      choice assumes the tokens label similar numbers of groups: when the
+      few tokens excluded label many groups, dropping the condition ships
+      more spurious tuples than DEFAULT_SCAN suggests.
+"""
+
+
+# Share of the domain above which the labels are rewritten to their complement
+DEFAULT_SHARE = 0.5
+
+# Share of the tokens of the domain below which the tokens excluded are not
+# requested (a fixed proxy for the share of the groups they label)
+DEFAULT_SCAN = 0.01
+
+
+class Complement:
+    """Domains of the columns, choosing how to rewrite wide conditions.
+
+    :domains: Dictionary from a column to the set of its tokens.
+    :share: Share of the tokens of a column above which the labels are
+        rewritten to the tokens they exclude. Defaults to DEFAULT_SHARE.
+    :scan: Share of the tokens of a column up to which the tokens excluded
+        are not requested, dropping the condition. Defaults to DEFAULT_SCAN.
+    """
+
+    def __init__(self, domains, share=DEFAULT_SHARE, scan=DEFAULT_SCAN):
+        if not 0 <= scan <= share <= 1:
+            raise Exception("The shares of the domain must satisfy " +
+                            "0 <= scan <= share <= 1.")
+        self.domains = domains
+        self.share = share
+        self.scan = scan
+
+    @classmethod
+    def of(cls, mapping, share=DEFAULT_SHARE, scan=DEFAULT_SCAN):
+        """Collect the domains of the columns of the mapping."""
+        domains = {column: frozenset(token
+                                     for tokens in mapping.get_tokens(column)
+                                     for token in tokens)
+                   for column in mapping.schema}
+        return cls(domains, share, scan)
+
+    def excluded(self, column, labels):
+        """Return the tokens of the column the labels exclude.
+
+        :column: Column name.
+        :labels: Set of labels of the column selected by a condition.
+        :return: None when the labels are to be requested as they are,
+            otherwise the set of tokens to exclude with NOT IN (empty when the
+            condition is to be dropped).
+
+        Every token is counted once, whatever the number of groups it labels.
+        """
+        domain = self.domains.get(column)
+        if not domain:
+            return None
+        excluded = domain.difference(labels)
+        if len(domain) - len(excluded) <= self.share * len(domain):
+            return None
+        if len(excluded) <= self.scan * len(domain):
+            return set()
+        return excluded
@@ -0,0 +1,151 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dyadic range covers of the tokens of range columns.
+
+The tokens of a range column are sorted by the ranges they generalize and
+grouped by a segment tree: the node (level, index) stands for the tokens at
+positions [index * 2^level, (index + 1) * 2^level). Each node is stored
+server-side with the union of its tokens, as the posting list column:node on
+the key-value store or as the rows of the column_cover table on the DBMS.
+
+A range query selects runs of consecutive tokens, and each run is covered
+exactly by O(log n) nodes, so the query requests a few nodes instead of a
+token per generalization.
+
+NOTE: nodes reveal to the server which tokens are adjacent in the order of
+      the ranges they generalize.
+"""
+
+if __package__:
+    from .mapping._column_mapping.creation import extract_ranges
+else:
+    from secure_index.mapping._column_mapping.creation import extract_ranges
+
+
+RANGE_TYPES = ["interval-tree", "range"]
+
+SUFFIX = "_cover"
+
+
+def node_label(level, index):
+    """Return the label of a node (never conflicting with a token)."""
+    return f"~{level}:{index}"
+
+
+def table_of(column):
+    """Return the name of the table holding the nodes of a column."""
+    return column + SUFFIX
+
+
+def columns_of(mapping):
+    """Return the columns mapped as ranges and promoted to indices."""
+    return [column for column in mapping.mappings
+            if mapping.types[column] in RANGE_TYPES
+            and not mapping.is_gid(column)]
+
+
+class RangeCover:
+    """Segment tree over the tokens of a range column.
+
+    :tokens: List of tokens sorted by the ranges they generalize.
+    :position: Dictionary from a token to its position.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self.position = {token: i for i, token in enumerate(self.tokens)}
+
+    @classmethod
+    def of(cls, mapping, column):
+        """Build the cover of a column of the mapping."""
+        ranges = extract_ranges(mapping.get_generalizations(column))
+        tokens = mapping.get_tokens(column)
+        order = sorted(range(len(ranges)), key=lambda i: ranges[i])
+        return cls(token for i in order for token in tokens[i])
+
+    def nodes(self):
+        """Yield the label and the tokens of each node (leaves excluded)."""
+        n = len(self.tokens)
+        level = 1
+        while 1 << (level - 1) < n:
+            width = 1 << level
+            for start in range(0, n - 1, width):
+                yield (node_label(level, start >> level),
+                       self.tokens[start:start + width])
+            level += 1
+
+    def cover(self, labels):
+        """Cover the labels with the smallest number of nodes.
+
+        :labels: Collection of tokens of the column.
+        :return: Set of node labels and set of the tokens left, whose union
+            is the labels.
+        """
+        n = len(self.tokens)
+        nodes = set()
+        tokens = set()
+        positions = []
+        for label in labels:
+            if label in self.position:
+                positions.append(self.position[label])
+            else:
+                tokens.add(label)
+        positions.sort()
+
+        i = 0
+        while i < len(positions):
+            # Find the run of consecutive positions starting at i
+            j = i
+            while j + 1 < len(positions) and \
+                    positions[j + 1] == positions[j] + 1:
+                j += 1
+            start, end = positions[i], positions[j]
+            while start <= end:
+                # Climb while the parent starts here and ends within the run
+                level = 0
+                while start % (2 << level) == 0 and start + (1 << level) < n \
+                        and min(start + (2 << level), n) - 1 <= end:
+                    level += 1
+                if level == 0:
+                    tokens.add(self.tokens[start])
+                else:
+                    nodes.add(node_label(level, start >> level))
+                start += 1 << level
+            i = j + 1
+        return nodes, tokens
+
+
+def ranks(mapping, column):
+    """Return the position of each generalization of a range column in the
+    order of the ranges they generalize.
+
+    :mapping: Multidimensional mapping of the dataset.
+    :column: Column mapped as ranges.
+    :return: Dictionary from a generalization to its position.
+    """
+    generalizations = mapping.get_generalizations(column)
+    ranges = extract_ranges(generalizations)
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i])
+    return {generalizations[i]: rank for rank, i in enumerate(order)}
+
+
+def build(mapping):
+    """Build the covers of the range columns of the mapping.
+
+    :mapping: Multidimensional mapping of the dataset.
+    :return: Dictionary from a column to its RangeCover.
+    """
+    return {column: RangeCover.of(mapping, column)
+            for column in columns_of(mapping)}
@@ -0,0 +1,107 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trained zstd dictionaries for the compression of small group blobs.
+
+Groups hold only K tuples, too few for zstd to learn their redundancy. A
+dictionary trained on a sample of serialized groups provides it upfront. The
+dictionary reveals the content of the sampled groups, so it is stored
+encrypted next to the mapping, exactly as the mapping itself.
+"""
+
+import base64
+import threading
+
+import nacl.exceptions
+import zstandard
+
+
+DICTIONARY_SIZE = 16 * 2**10
+
+LEVEL = 3
+
+
+def path_of(mapping_path):
+    """Return the path of the dictionary stored alongside the mapping."""
+    return mapping_path + ".dict"
+
+
+def train(samples, size=DICTIONARY_SIZE):
+    """Train a zstd dictionary on a sample of serialized groups.
+
+    :samples: List of serialized groups.
+    :size: Maximum size of the dictionary in bytes.
+    :return: Content of the dictionary.
+    """
+    try:
+        dictionary = zstandard.train_dictionary(size, samples, level=LEVEL)
+    except zstandard.ZstdError as e:
+        raise Exception(f"Cannot train the zstd dictionary: {e}")
+    return dictionary.as_bytes()
+
+
+def save(path, dictionary, box):
+    """Store the dictionary encrypted.
+
+    :path: Destination of the encrypted dictionary.
+    :dictionary: Content of the dictionary.
+    :box: Secret box used to encrypt the dictionary.
+    """
+    with open(path, 'w') as f:
+        f.write(base64.b64encode(box.encrypt(dictionary)).decode("ascii"))
+
+
+def load(path, box):
+    """Read the encrypted dictionary.
+
+    :path: Path of the encrypted dictionary.
+    :box: Secret box used to decrypt the dictionary.
+    :return: Content of the dictionary.
+    """
+    with open(path, 'r') as f:
+        encrypted = base64.b64decode(f.read())
+    try:
+        return box.decrypt(encrypted)
+    except nacl.exceptions.CryptoError:
+        raise Exception("Something has gone wrong with the decryption of " +
+                        "the dictionary.")
+
+
+def compressor(dictionary, level=LEVEL):
+    """Return a function compressing bytes with the dictionary."""
+    data = zstandard.ZstdCompressionDict(dictionary)
+    local = threading.local()
+
+    def compress(bytes):
+        # zstd contexts cannot be shared among threads
+        if not hasattr(local, "context"):
+            local.context = zstandard.ZstdCompressor(level=level,
+                                                     dict_data=data)
+        return local.context.compress(bytes)
+
+    return compress
+
+
+def decompressor(dictionary):
+    """Return a function decompressing bytes with the dictionary."""
+    data = zstandard.ZstdCompressionDict(dictionary)
+    local = threading.local()
+
+    def decompress(bytes):
+        # zstd contexts cannot be shared among threads
+        if not hasattr(local, "context"):
+            local.context = zstandard.ZstdDecompressor(dict_data=data)
+        return local.context.decompress(bytes)
+
+    return decompress
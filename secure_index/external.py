@@ -0,0 +1,253 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Out-of-core join of the plain and anonymized datasets sorted by GID.
+
+Datasets larger than the memory are read in chunks and hash partitioned by
+INDEX on the local disk. Each partition fits the memory budget, so it is
+joined and sorted by GID into a run. Merging the runs yields the joined
+tuples sorted by GID in batches of complete groups.
+
+Runs are files of pickled DataFrame blocks.
+
+The types of the plain columns are inferred in a first pass over the whole
+dataset, as each chunk would otherwise infer its own (e.g., integers in a
+chunk and floats or strings in another), and are downcast as the in-memory
+wrapping does, so that both serialize the same values.
+"""
+
+import math
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+
+# Number of tuples used to estimate the size of a tuple
+SAMPLE_SIZE = 1000
+
+# Copies of a tuple held in memory while partitioning, joining and sorting
+OVERHEAD = 4
+
+
+def _read_blocks(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _partition_of(index, partitions):
+    return pd.util.hash_array(np.asarray(index)) % partitions
+
+
+def _sorted(blocks):
+    batch = pd.concat(blocks)
+    batch.sort_values("GID", kind="stable", inplace=True)
+    return batch
+
+
+def column_dtypes(dataset, rows):
+    """Infer the types of the columns of the plain dataset chunk by chunk.
+
+    The types match those inferred reading the whole dataset at once and
+    downcast to the smallest integer or float type holding the values.
+
+    :dataset: Path to the plain dataset.
+    :rows: Number of tuples read at once.
+    :return: Dictionary from a column to the type it is read as and
+        dictionary from a column to the type it is downcast to.
+    """
+    kinds = {}
+    extremes = {}
+    single = {}
+    for chunk in pd.read_csv(dataset, index_col="INDEX", chunksize=rows):
+        for column in chunk.columns:
+            values = chunk[column]
+            kinds.setdefault(column, set()).add(values.dtype.kind)
+            if values.dtype.kind in "iu" and len(values):
+                low, high = extremes.get(column, (values.min(), values.max()))
+                extremes[column] = (min(low, values.min()),
+                                    max(high, values.max()))
+            if values.dtype.kind in "iuf":
+                # Floats are downcast when every value fits a single float
+                downcast = pd.to_numeric(values.astype(np.float64),
+                                         downcast="float")
+                single[column] = single.get(column, True) and \
+                    downcast.dtype == np.float32
+
+    read, downcast = {}, {}
+    for column, kind in kinds.items():
+        if kind <= set("iu"):
+            read[column] = np.int64
+            low, high = extremes.get(column, (0, 0))
+            downcast[column] = pd.to_numeric(
+                pd.Series([low, high], dtype=np.int64),
+                downcast="unsigned" if low >= 0 else "signed").dtype
+        elif kind <= set("iuf"):
+            read[column] = np.float64
+            downcast[column] = np.float32 if single[column] else np.float64
+        elif kind == {"b"}:
+            read[column] = downcast[column] = bool
+        else:
+            read[column] = downcast[column] = str
+    return read, downcast
+
+
+def plan(dataset, anonymized, budget):
+    """Size the chunks and the partitions according to the memory budget.
+
+    :dataset: Path to the plain dataset.
+    :anonymized: Path to the anonymized dataset.
+    :budget: Memory budget in bytes.
+    :return: Number of tuples read at once and number of partitions.
+    """
+    plain = pd.read_csv(dataset, index_col="INDEX", nrows=SAMPLE_SIZE)
+    dtype = {column: str for column in plain.columns}
+    anon = pd.read_csv(anonymized, index_col="INDEX", dtype=dtype,
+                       nrows=SAMPLE_SIZE)
+    if plain.empty or anon.empty:
+        return SAMPLE_SIZE, 1
+
+    # Size of a joined tuple in memory and on disk
+    memory = plain.memory_usage(deep=True).sum() / len(plain) + \
+        anon.memory_usage(deep=True).sum() / len(anon)
+    text = len(plain.to_csv()) / len(plain) + len(anon.to_csv()) / len(anon)
+
+    rows = max(1, int(budget / (OVERHEAD * memory)))
+    size = os.path.getsize(dataset) + os.path.getsize(anonymized)
+    partitions = max(1, math.ceil(size / text / rows))
+    return rows, partitions
+
+
+def sort_by_group(dataset, anonymized, budget, directory):
+    """Join the datasets and sort them by GID out of core.
+
+    :dataset: Path to the plain dataset.
+    :anonymized: Path to the anonymized dataset.
+    :budget: Memory budget in bytes.
+    :directory: Directory storing the partitions and the runs.
+    :return: List of paths to the runs, DataFrame with the GID and the
+        generalizations of each group and number of tuples to merge at once.
+    """
+    rows, partitions = plan(dataset, anonymized, budget)
+    columns = pd.read_csv(dataset, index_col="INDEX", nrows=0).columns
+    dtype = {column: str for column in columns}
+    read, downcast = column_dtypes(dataset, rows)
+
+    # Hash partition both datasets by INDEX
+    paths = {}
+    for name, chunks in (
+            ("plain", pd.read_csv(dataset,
+                                  index_col="INDEX",
+                                  dtype=read,
+                                  chunksize=rows)),
+            ("anon", pd.read_csv(anonymized,
+                                 index_col="INDEX",
+                                 dtype=dtype,
+                                 chunksize=rows))):
+        paths[name] = [os.path.join(directory, f"{name}-{i}.pkl")
+                       for i in range(partitions)]
+        files = [open(path, "wb") for path in paths[name]]
+        try:
+            for chunk in chunks:
+                if name == "plain":
+                    chunk = chunk.astype(downcast)
+                else:
+                    chunk["GID"] = pd.to_numeric(chunk["GID"],
+                                                 downcast="unsigned")
+                partition = _partition_of(chunk.index, partitions)
+                for i, block in chunk.groupby(partition):
+                    pickle.dump(block, files[i],
+                                protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            for f in files:
+                f.close()
+
+    # Join and sort each partition into a run of blocks
+    block_rows = max(1, rows // partitions)
+    runs = []
+    groups = []
+    for i in range(partitions):
+        plain = [block for block in _read_blocks(paths["plain"][i])]
+        anon = [block for block in _read_blocks(paths["anon"][i])]
+        os.remove(paths["plain"][i])
+        os.remove(paths["anon"][i])
+        if not plain or not anon:
+            continue
+        jdf = pd.concat(plain).join(pd.concat(anon),
+                                    how="inner",
+                                    lsuffix='_plain',
+                                    rsuffix='_anon')
+        del plain, anon
+        jdf.sort_values("GID", kind="stable", inplace=True)
+
+        # Keep the generalizations of the groups for the auxiliary tables
+        anon = [column + "_anon" for column in columns]
+        first = jdf.drop_duplicates("GID")[["GID", *anon]]
+        groups.append(first.rename(columns=dict(zip(anon, columns))))
+
+        run = os.path.join(directory, f"run-{i}.pkl")
+        with open(run, "wb") as f:
+            for start in range(0, len(jdf), block_rows):
+                pickle.dump(jdf.iloc[start:start + block_rows], f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        runs.append(run)
+        del jdf
+
+    groups = pd.concat(groups).drop_duplicates("GID") if groups else \
+        pd.DataFrame(columns=["GID", *columns])
+    return runs, groups.reset_index(drop=True), rows
+
+
+def merge_runs(runs, rows=1):
+    """Merge the runs sorted by GID.
+
+    :runs: List of paths to the runs.
+    :rows: Minimum number of tuples of a batch, but the last one.
+    :return: Generator of DataFrames of complete groups sorted by GID.
+    """
+    batch = []
+    readers = [_read_blocks(run) for run in runs]
+    blocks = [next(reader, None) for reader in readers]
+    while any(block is not None for block in blocks):
+        # Groups up to the smallest last GID of the blocks are complete once
+        # the blocks ending with it are extended with the following ones
+        bound = min(block["GID"].iat[-1]
+                    for block in blocks if block is not None)
+        for i, reader in enumerate(readers):
+            while blocks[i] is not None and blocks[i]["GID"].iat[-1] == bound:
+                following = next(reader, None)
+                if following is None:
+                    break
+                blocks[i] = pd.concat((blocks[i], following))
+
+        for i, block in enumerate(blocks):
+            if block is None:
+                continue
+            end = np.searchsorted(block["GID"].to_numpy(), bound,
+                                  side="right")
+            batch.append(block.iloc[:end])
+            blocks[i] = block.iloc[end:] if end < len(block) else \
+                next(readers[i], None)
+
+        if sum(len(block) for block in batch) >= rows:
+            yield _sorted(batch)
+            batch = []
+
+    if batch:
+        yield _sorted(batch)
@@ -0,0 +1,638 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client-side filtering of the decrypted tuples.
+
+The original query is compiled into a vectorized evaluator running directly
+on NumPy column arrays. Only a subset of SQL is supported:
+
+    SELECT [ALL] (* | column | COUNT(*) | COUNT|SUM|AVG|MIN|MAX(column))+
+    FROM table
+    [WHERE predicate]
+    [GROUP BY column+]
+    [ORDER BY ((column | aggregate | position) [ASC|DESC])+]
+    [LIMIT count [OFFSET skip]]
+
+where predicates are made of comparisons among columns and numeric or string
+literals, IN and BETWEEN operators (optionally negated), NOT, AND and OR.
+Whenever the query (or the data it runs on) is not supported, the query is
+run in a temporary SQLite database as before.
+"""
+
+import operator
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import sqlparse.tokens as T
+
+if __package__:
+    from .sqlparser import parse
+else:
+    from secure_index.sqlparser import parse
+
+
+AGGREGATES = ["COUNT", "SUM", "AVG", "MIN", "MAX"]
+
+# Operators rather than ufuncs, which lack string loops on older NumPy
+COMPARISONS = {
+    "=": operator.eq, "==": operator.eq, "<>": operator.ne, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge
+}
+
+
+class Unsupported(Exception):
+    """Raised when the vectorized evaluator cannot handle the query."""
+    pass
+
+
+class Column:
+    """Reference to a column of the plaintext dataset."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, columns):
+        return _resolve(columns, self.name)
+
+
+class Literal:
+    """Numeric or string literal."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, columns):
+        return self.value
+
+
+class Aggregate:
+    """Aggregate function applied to a column (None stands for *)."""
+
+    def __init__(self, function, column, text):
+        self.function = function
+        self.column = column
+        self.text = text
+
+
+class Filter:
+    """Vectorized evaluator of a query over plaintext column arrays.
+
+    :projection: List of (name, item) pairs, where item is either a Column,
+        an Aggregate or None for the * wildcard.
+    :where: Function returning the boolean mask of the selected rows, None
+        when the query has no WHERE clause.
+    :group_by: List of column names to group by.
+    :order_by: List of (key, descending) pairs, where key is either a Column,
+        an Aggregate or the position of a projection item.
+    :references: Names of the columns the query refers to, None when it
+        projects all of them.
+    :limit: Maximum number of result rows, None when unlimited.
+    :offset: Number of result rows to skip.
+    """
+
+    def __init__(self,
+                 projection,
+                 where,
+                 group_by,
+                 order_by,
+                 references=None,
+                 limit=None,
+                 offset=0):
+        self.projection = projection
+        self.where = where
+        self.group_by = group_by
+        self.order_by = order_by
+        self.references = references
+        self.limit = limit
+        self.offset = offset
+        self.is_aggregate = bool(group_by) or any(
+            isinstance(item, Aggregate) for _, item in projection)
+
+    def __call__(self, columns, limit=True):
+        """Run the query on the given columns.
+
+        :columns: Dictionary mapping column names to NumPy arrays of the
+            same length.
+        :limit: Whether to apply the LIMIT clause. Defaults to True.
+        :return: DataFrame with the result of the query, None when the data
+            types prevent the vectorized evaluation.
+        """
+        try:
+            selected = self.select(columns)
+            return self.finalize(selected, limit)
+        except Unsupported:
+            return None
+
+    def select(self, columns):
+        """Keep only the rows satisfying the WHERE clause."""
+        for array in columns.values():
+            _check_type(array)
+        if self.where is None:
+            return columns
+        mask = self.where(columns)
+        if np.ndim(mask) == 0:
+            mask = np.full(_length(columns), bool(mask))
+        return {name: array[mask] for name, array in columns.items()}
+
+    def finalize(self, columns, limit=True):
+        """Compute projection, grouping, ordering and (unless limit is False)
+        the LIMIT clause on selected rows."""
+        if self.is_aggregate:
+            names, arrays = self._aggregate(columns)
+            ordered = dict(zip(range(len(names)), arrays))
+        else:
+            ordered = columns
+        order = self._order(ordered, names if self.is_aggregate else None)
+
+        if not self.is_aggregate:
+            names, arrays = self._project(columns)
+        if order is not None:
+            arrays = [array[order] for array in arrays]
+        if limit and (self.limit is not None or self.offset):
+            end = self.offset + self.limit if self.limit is not None else None
+            arrays = [array[self.offset:end] for array in arrays]
+
+        df = pd.DataFrame({i: array for i, array in enumerate(arrays)})
+        df.columns = names
+        return df
+
+    def _project(self, columns):
+        names, arrays = [], []
+        for name, item in self.projection:
+            if item is None:
+                names.extend(columns.keys())
+                arrays.extend(columns.values())
+            else:
+                names.append(_name(columns, item.name)
+                             if isinstance(item, Column) else name)
+                arrays.append(item(columns))
+        return names, arrays
+
+    def _aggregate(self, columns):
+        length = _length(columns)
+        keys = [_resolve(columns, column) for column in self.group_by]
+
+        # Sort rows by group and find where each group starts
+        if keys:
+            order = np.lexsort(keys[::-1]) if length else np.arange(0)
+            starts = np.flatnonzero(np.concatenate([[True], np.any(
+                [key[order][1:] != key[order][:-1] for key in keys],
+                axis=0)])) if length > 1 else np.arange(length)
+        else:
+            order = np.arange(length)
+            starts = np.zeros(1, dtype=np.int64)
+        counts = np.diff(np.append(starts, length))
+
+        names, arrays = [], []
+        for name, item in self.projection:
+            if item is None:
+                raise Unsupported("* in aggregate query")
+            if isinstance(item, Column):
+                if item.name not in self.group_by:
+                    raise Unsupported("bare column in aggregate query")
+                names.append(_name(columns, item.name))
+                arrays.append(item(columns)[order][starts])
+                continue
+            names.append(name)
+            arrays.append(_reduce(item, columns, order, starts, counts))
+        return names, arrays
+
+    def _order(self, columns, names):
+        if not self.order_by:
+            return None
+        keys = []
+        for key, descending in self.order_by:
+            if isinstance(key, int):
+                if not 1 <= key <= len(self.projection):
+                    raise Unsupported("ORDER BY position out of range")
+                if self.projection[key - 1][1] is None:
+                    raise Unsupported("ORDER BY position on *")
+                key = self.projection[key - 1][1]
+            if names is None:
+                if isinstance(key, Aggregate):
+                    raise Unsupported("aggregate in non-aggregate ORDER BY")
+                array = key(columns)
+            else:
+                array = self._output(columns, key)
+            _, rank = np.unique(array, return_inverse=True)
+            keys.append(-rank if descending else rank)
+        return np.lexsort(keys[::-1])
+
+    def _output(self, columns, key):
+        """Retrieve an ORDER BY key among the results of an aggregation."""
+        for i, (_, item) in enumerate(self.projection):
+            if isinstance(key, Column) and isinstance(item, Column) and \
+                    key.name == item.name:
+                return columns[i]
+            if isinstance(key, Aggregate) and isinstance(item, Aggregate) and \
+                    (key.function, key.column) == (item.function, item.column):
+                return columns[i]
+        raise Unsupported("ORDER BY key not in the projection")
+
+
+def _length(columns):
+    return len(next(iter(columns.values()))) if columns else 0
+
+
+def _check_type(array):
+    if array.dtype.kind not in "biufU":
+        raise Unsupported(f"{array.dtype} columns")
+    if array.dtype.kind == "f" and np.isnan(array).any():
+        raise Unsupported("NULL values")
+
+
+def _name(columns, name):
+    """Return the name of the column in the schema, as SQLite labels it."""
+    if name in columns:
+        return name
+    # SQLite identifiers are case insensitive
+    matches = [column for column in columns if column.lower() == name.lower()]
+    if len(matches) != 1:
+        raise Unsupported(f"unknown column {name}")
+    return matches[0]
+
+
+def _resolve(columns, name):
+    return columns[_name(columns, name)]
+
+
+def _reduce(aggregate, columns, order, starts, counts):
+    length = len(order)
+    if aggregate.function == "COUNT":
+        return counts
+
+    values = _resolve(columns, aggregate.column)
+    if values.dtype.kind not in "biuf":
+        raise Unsupported(f"{aggregate.function} on strings")
+    values = values[order]
+    if values.dtype.kind in "bu":
+        values = values.astype(np.int64)
+
+    if not length:
+        # Aggregating an empty set yields NULL
+        return np.array([None] * len(starts), dtype=object)
+
+    if aggregate.function == "SUM":
+        return np.add.reduceat(values, starts)
+    if aggregate.function == "AVG":
+        return np.add.reduceat(values, starts) / counts
+    if aggregate.function == "MIN":
+        return np.minimum.reduceat(values, starts)
+    return np.maximum.reduceat(values, starts)
+
+
+def _compare(op, left, right):
+    def comparison(columns):
+        a, b = left(columns), right(columns)
+        _check_comparable(a, b)
+        # Comparing two literals yields a bool, which ~ would not negate
+        return np.asarray(COMPARISONS[op](a, b))
+    return comparison
+
+
+def _check_comparable(a, b):
+    kinds = {
+        "s" if isinstance(value, str) or (
+            isinstance(value, np.ndarray) and value.dtype.kind == "U")
+        else "n" for value in (a, b)
+    }
+    if len(kinds) != 1:
+        # SQLite applies column affinity on mixed comparisons
+        raise Unsupported("comparison between strings and numbers")
+
+
+def _in(operand, values, negated):
+    def membership(columns):
+        array = operand(columns)
+        items = [value(columns) for value in values]
+        for item in items:
+            _check_comparable(array, item)
+        mask = np.isin(array, items)
+        return ~mask if negated else mask
+    return membership
+
+
+def _between(operand, low, high, negated):
+    left = _compare(">=", operand, low)
+    right = _compare("<=", operand, high)
+    def between(columns):
+        mask = left(columns) & right(columns)
+        return ~mask if negated else mask
+    return between
+
+
+def _and(left, right):
+    return lambda columns: left(columns) & right(columns)
+
+
+def _or(left, right):
+    return lambda columns: left(columns) | right(columns)
+
+
+def _not(operand):
+    return lambda columns: ~operand(columns)
+
+
+class _Parser:
+    """Recursive descent parser over the flattened tokens of a query."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        # Positions of the tokens not being whitespaces or comments
+        self.positions = [
+            i for i, tok in enumerate(tokens)
+            if not (tok.is_whitespace or tok.ttype in T.Comment)
+        ]
+        self.i = 0
+        self.references = []
+
+    def peek(self, offset=0):
+        i = self.i + offset
+        if i < len(self.positions):
+            return self.tokens[self.positions[i]]
+        return None
+
+    def next(self):
+        tok = self.peek()
+        if tok is None:
+            raise Unsupported("unexpected end of query")
+        self.i += 1
+        return tok
+
+    def match(self, ttype, values=None):
+        tok = self.peek()
+        if tok is not None and tok.match(ttype, values):
+            self.i += 1
+            return True
+        return False
+
+    def expect(self, ttype, values=None):
+        if not self.match(ttype, values):
+            raise Unsupported(f"unexpected token {self.peek()}")
+
+    def query(self):
+        self.expect(T.Keyword.DML, "SELECT")
+        if self.match(T.Keyword, "DISTINCT"):
+            raise Unsupported("DISTINCT")
+        self.match(T.Keyword, "ALL")
+        projection = self.comma_separated(self.projection_item)
+
+        self.expect(T.Keyword, "FROM")
+        self.identifier()
+
+        where = None
+        if self.match(T.Keyword, "WHERE"):
+            where = self.disjunction()
+
+        group_by = []
+        if self.match(T.Keyword, "GROUP BY"):
+            group_by = [column.name
+                        for column in self.comma_separated(self.column)]
+
+        order_by = []
+        if self.match(T.Keyword, "ORDER BY"):
+            order_by = self.comma_separated(self.order_item)
+
+        limit, offset = None, 0
+        if self.match(T.Keyword, "LIMIT"):
+            limit = self.count()
+            if self.match(T.Keyword, "OFFSET"):
+                offset = self.count()
+
+        self.match(T.Punctuation, ";")
+        if self.peek() is not None:
+            raise Unsupported(f"unexpected token {self.peek()}")
+        wildcard = any(item is None for _, item in projection)
+        references = None if wildcard else self.references
+        return Filter(projection, where, group_by, order_by, references,
+                      limit, offset)
+
+    def comma_separated(self, item):
+        items = [item()]
+        while self.match(T.Punctuation, ","):
+            items.append(item())
+        return items
+
+    def projection_item(self):
+        if self.match(T.Wildcard, "*"):
+            return None, None
+        start = self.i
+        item = self.aggregate() if self.is_function() else self.column()
+        if self.peek() is not None and (self.peek().match(T.Keyword, "AS") or
+                                        self.peek().ttype in T.Name):
+            raise Unsupported("aliases")
+        if isinstance(item, Column):
+            return item.name, item
+        item.text = self.text(start)
+        return item.text, item
+
+    def order_item(self):
+        tok = self.peek()
+        if tok is not None and tok.ttype is T.Literal.Number.Integer:
+            key = int(self.next().value)
+        elif self.is_function():
+            key = self.aggregate()
+        else:
+            key = self.column()
+        descending = False
+        if self.peek() is not None and self.peek().ttype is T.Keyword.Order:
+            descending = self.next().normalized == "DESC"
+        if self.peek() is not None and self.peek().match(T.Keyword, "NULLS"):
+            raise Unsupported("NULLS FIRST/LAST")
+        return key, descending
+
+    def count(self):
+        tok = self.next()
+        if tok.ttype is not T.Literal.Number.Integer:
+            raise Unsupported(f"unexpected token {tok}")
+        return int(tok.value)
+
+    def is_function(self):
+        nxt = self.peek(1)
+        return nxt is not None and nxt.match(T.Punctuation, "(")
+
+    def aggregate(self):
+        function = self.next().value.upper()
+        if function not in AGGREGATES:
+            raise Unsupported(f"{function} function")
+        self.expect(T.Punctuation, "(")
+        if self.match(T.Keyword, "DISTINCT"):
+            raise Unsupported("DISTINCT aggregates")
+        column = None
+        if self.match(T.Wildcard, "*"):
+            if function != "COUNT":
+                raise Unsupported(f"{function}(*)")
+        else:
+            column = self.column().name
+        self.expect(T.Punctuation, ")")
+        return Aggregate(function, column, None)
+
+    def identifier(self):
+        tok = self.next()
+        if tok.ttype is T.Literal.String.Symbol:
+            return tok.value[1:-1].replace('""', '"')
+        if tok.ttype in T.Name or tok.is_keyword:
+            return tok.value
+        raise Unsupported(f"unexpected token {tok}")
+
+    def column(self):
+        name = self.identifier()
+        if self.match(T.Punctuation, "."):
+            # Drop table name
+            name = self.identifier()
+        if name not in self.references:
+            self.references.append(name)
+        return Column(name)
+
+    def disjunction(self):
+        left = self.conjunction()
+        while self.match(T.Keyword, "OR"):
+            left = _or(left, self.conjunction())
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.match(T.Keyword, "AND"):
+            left = _and(left, self.negation())
+        return left
+
+    def negation(self):
+        if self.match(T.Keyword, "NOT"):
+            return _not(self.negation())
+        return self.predicate()
+
+    def predicate(self):
+        if self.match(T.Punctuation, "("):
+            if self.peek() is not None and \
+                    self.peek().match(T.Keyword.DML, "SELECT"):
+                raise Unsupported("subqueries")
+            expression = self.disjunction()
+            self.expect(T.Punctuation, ")")
+            return expression
+
+        left = self.operand()
+        negated = self.match(T.Keyword, "NOT")
+        if self.match(T.Keyword, "IN"):
+            self.expect(T.Punctuation, "(")
+            values = self.comma_separated(self.operand)
+            self.expect(T.Punctuation, ")")
+            return _in(left, values, negated)
+        if self.match(T.Keyword, "BETWEEN"):
+            low = self.operand()
+            self.expect(T.Keyword, "AND")
+            high = self.operand()
+            return _between(left, low, high, negated)
+        if negated:
+            raise Unsupported(f"unexpected token {self.peek()}")
+
+        tok = self.next()
+        if tok.ttype is not T.Operator.Comparison or \
+                tok.value not in COMPARISONS:
+            raise Unsupported(f"{tok} operator")
+        return _compare(tok.value, left, self.operand())
+
+    def operand(self):
+        tok = self.peek()
+        if tok is None:
+            raise Unsupported("unexpected end of query")
+        if tok.ttype in T.Literal.Number:
+            self.next()
+            if tok.ttype in T.Literal.Number.Integer:
+                return Literal(int(tok.value))
+            return Literal(float(tok.value))
+        if tok.ttype is T.Literal.String.Single:
+            self.next()
+            return Literal(tok.value[1:-1].replace("''", "'"))
+        if tok.ttype is T.Literal.String.Symbol or tok.ttype in T.Name:
+            return self.column()
+        raise Unsupported(f"unexpected token {tok}")
+
+    def text(self, start):
+        """Return the original text from the start position to the current
+        one, as SQLite uses it to name result columns."""
+        first, last = self.positions[start], self.positions[self.i - 1]
+        return "".join(tok.value for tok in self.tokens[first:last + 1])
+
+
+def compile_filter(state):
+    """Compile the parsed query into a vectorized evaluator.
+
+    :state: Information about the query to run client-side, as returned by
+        the SQL parser (before any rewriting).
+    :return: A Filter evaluating the query on column arrays, None when the
+        query is not supported.
+    """
+    tokens = [tok for token in state.tokens for tok in token.flatten()]
+    try:
+        return _Parser(tokens).query()
+    except Unsupported:
+        return None
+
+
+def to_columns(tuples, schema):
+    """Transform the list of plaintext tuples to column arrays.
+
+    :tuples: List of plaintext tuples.
+    :schema: List of column names of the plaintext tuples.
+    :return: Dictionary mapping column names to NumPy arrays.
+    """
+    if not tuples:
+        return {column: np.array([]) for column in schema}
+    return {
+        column: np.array(values)
+        for column, values in zip(schema, zip(*tuples))
+    }
+
+
+def sqlite_filter(query, tuples, schema, table):
+    """Run the query on the plaintext tuples using a temporary SQLite table.
+
+    :query: Original query to run.
+    :tuples: List of plaintext tuples.
+    :schema: List of column names of the plaintext tuples.
+    :table: Name of the table the query refers to.
+    :return: DataFrame with the result of the query.
+    """
+    df = pd.DataFrame(tuples, columns=schema)
+    with sqlite3.connect(':memory:') as conn:
+        # Store plaintext tuples in local cache
+        df.to_sql(table, conn, if_exists='replace', index=False,
+                  method='multi', chunksize=10000)
+
+        # Run original query on the local cache
+        cursor = conn.cursor()
+        cursor.execute(query)
+        columns = [description[0] for description in cursor.description]
+        return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+
+def filter_tuples(query, tuples, schema, table, state=None):
+    """Filter spurious tuples by running the original query client-side.
+
+    :query: Original query to run.
+    :tuples: List of plaintext tuples.
+    :schema: List of column names of the plaintext tuples.
+    :table: Name of the table the query refers to.
+    :state: Optional parsed representation of the query. Defaults to None.
+    :return: DataFrame with the result of the query.
+    """
+    if state is None:
+        state = parse(query)
+    evaluator = compile_filter(state)
+    if evaluator is not None:
+        result = evaluator(to_columns(tuples, schema))
+        if result is not None:
+            return result
+    return sqlite_filter(query, tuples, schema, table)
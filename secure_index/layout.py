@@ -0,0 +1,88 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Heap pages read by the rewritten queries.
+
+The pages holding the encrypted tuples a query returns are counted from the
+ctid of the rows, and compared with the pages the same number of rows would
+touch if the groups were scattered uniformly over the heap (Cardenas), as
+they are when the wrapped dataset is stored in the order of its random GIDs.
+
+NOTE: only the heap of the table is measured, the TOAST table holding the
+      largest encrypted tuples follows the same order.
+"""
+
+import collections
+
+if __package__:
+    from .bulk import _quote
+else:
+    from secure_index.bulk import _quote
+
+
+Pages = collections.namedtuple("Pages", ["rows", "pages", "scattered"])
+
+# Page of a row (partitions have their own pages)
+PAGE = "({table}.tableoid, ({table}.ctid::text::point)[0])"
+
+
+def scattered_pages(rows, pages):
+    """Return the expected number of pages holding rows placed uniformly.
+
+    :rows: Number of rows read.
+    :pages: Number of pages of the table.
+    :return: Expected number of distinct pages.
+    """
+    if not pages:
+        return 0
+    return pages * (1 - (1 - 1 / pages) ** rows)
+
+
+def table_pages(connection, table):
+    """Return the number of rows and of non-empty pages of the table."""
+    page = PAGE.format(table=_quote(table))
+    return tuple(connection.execute(
+        f"SELECT COUNT(*), COUNT(DISTINCT {page}) FROM {_quote(table)}"
+    ).fetchone())
+
+
+def query_pages(connection, query, table):
+    """Return the number of rows and of pages the rewritten query reads.
+
+    :connection: Connection to the PostgreSQL database.
+    :query: Rewritten query, projecting the encrypted tuples.
+    :table: Table holding the encrypted tuples.
+    """
+    page = PAGE.format(table=_quote(table))
+    counted = query.replace("\"EncTuples\"", f"{page} AS \"Page\"", 1)
+    return tuple(connection.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT \"Page\") " +
+        f"FROM ({counted}) AS \"Pages\"").fetchone())
+
+
+def report(engine, table, queries):
+    """Measure the pages read by each query.
+
+    :engine: SQLAlchemy engine of the PostgreSQL database.
+    :table: Table holding the encrypted tuples.
+    :queries: List of rewritten queries.
+    :return: List of Pages, one for each query.
+    """
+    with engine.connect() as connection:
+        _, pages = table_pages(connection, table)
+        result = []
+        for query in queries:
+            rows, read = query_pages(connection, query, table)
+            result.append(Pages(rows, read, scattered_pages(rows, pages)))
+        return result
@@ -0,0 +1,127 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client-side copy of the mapping table of the hybrid representation.
+
+The mapping table associates each GroupId with the tokens of its group and
+is small compared to the encrypted tuples. Keeping a copy of it, the client
+resolves the conditions on the tokens to the matching GroupIds locally, in
+an in-memory SQLite database, and the server only looks up the encrypted
+tuples by their primary key instead of joining them with the mapping table
+on every query.
+
+The copy is stored encrypted next to the mapping, as the zstd dictionary.
+"""
+
+import base64
+import sqlite3
+import threading
+
+import msgpack
+import nacl.exceptions
+import zstd
+
+
+def path_of(mapping_path):
+    """Return the path of the mapping table stored alongside the mapping."""
+    return mapping_path + ".table"
+
+
+def save(path, columns, rows, box):
+    """Store the mapping table encrypted.
+
+    :path: Destination of the encrypted mapping table.
+    :columns: List of column names (GroupId and the token columns).
+    :rows: List of rows of the mapping table.
+    :box: Secret box used to encrypt the mapping table.
+    """
+    packed = msgpack.packb({"columns": list(columns), "rows": list(rows)})
+    encrypted = box.encrypt(zstd.compress(packed, 3, 1))
+    with open(path, 'w') as f:
+        f.write(base64.b64encode(encrypted).decode("ascii"))
+
+
+def load(path, box):
+    """Read the encrypted mapping table.
+
+    :path: Path of the encrypted mapping table.
+    :box: Secret box used to decrypt the mapping table.
+    :return: LocalMapping holding the mapping table.
+    """
+    with open(path, 'r') as f:
+        encrypted = base64.b64decode(f.read())
+    try:
+        packed = zstd.decompress(box.decrypt(encrypted))
+    except nacl.exceptions.CryptoError:
+        raise Exception("Something has gone wrong with the decryption of " +
+                        "the mapping table.")
+    table = msgpack.unpackb(packed)
+    return LocalMapping(table["columns"], table["rows"])
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+class LocalMapping:
+    """Mapping table resolving token conditions to GroupIds.
+
+    The rows are stored in an in-memory SQLite table, while a view named
+    after each queried table stands for its join with the mapping table, so
+    that the rewritten queries run unchanged.
+
+    :columns: List of column names (GroupId and the token columns).
+    :rows: List of rows of the mapping table.
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = list(columns)
+        if "GroupId" not in self.columns:
+            raise Exception("The mapping table has no GroupId column.")
+        self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.lock = threading.Lock()
+        self.views = set()
+        definition = ", ".join(
+            _quote(column) + (" PRIMARY KEY" if column == "GroupId" else "")
+            for column in self.columns)
+        self.connection.execute(f"CREATE TABLE mapping ({definition})")
+        self.connection.executemany(
+            f"INSERT INTO mapping VALUES " +
+            f"({', '.join('?' for _ in self.columns)})", rows)
+        for column in self.columns:
+            if column != "GroupId":
+                self.connection.execute(
+                    f"CREATE INDEX {_quote(column + '_idx')} " +
+                    f"ON mapping ({_quote(column)})")
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM mapping").fetchone()[0]
+
+    def resolve(self, rewritten, table):
+        """Return the GroupIds of the groups matching the rewritten query.
+
+        :rewritten: Query rewritten for the mapping table, retrieving the
+            GroupId first (e.g., rewritten with_gid).
+        :table: Name of the table the query refers to.
+        :return: List of matching GroupIds.
+        """
+        with self.lock:
+            if table not in self.views:
+                self.connection.execute(
+                    f"CREATE VIEW {_quote(table)} AS " +
+                    "SELECT *, NULL AS \"EncTuples\" FROM mapping")
+                self.views.add(table)
+            return [row[0]
+                    for row in self.connection.execute(rewritten).fetchall()]
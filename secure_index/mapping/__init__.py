@@ -17,11 +17,13 @@ from . import _column_mapping
 from . import creation
 from . import interface
 from . import heterogeneous
+from . import shared
 
 # Allow 'from secure_index import *' syntax.
 __all__ = [
     "_column_mapping",
     "creation",
     "heterogeneous",
-    "interface"
+    "interface",
+    "shared"
 ]
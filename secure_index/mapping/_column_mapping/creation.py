@@ -25,7 +25,7 @@ import pyroaring
 from intervaltree import Interval, IntervalTree
 
 if __package__:
-    from ._column_mapping.interval_tree import DELTA
+    from .interval_tree import DELTA
 else:
     from secure_index.mapping._column_mapping.interval_tree import DELTA
 
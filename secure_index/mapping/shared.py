@@ -0,0 +1,458 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Multidimensional mapping stored in a single immutable buffer.
+
+The unpickled mapping is a graph of Python objects: every read updates their
+reference counts, dirtying the copy-on-write pages a forked worker shares
+with its parent, so each worker ends up with its own copy of the mapping.
+
+The shared mapping packs the generalizations and the tokens of each column
+into flat NumPy arrays laid out in one contiguous buffer, which is either an
+anonymous shared memory map (inherited by the workers forked after its
+creation) or a file mapped read-only (shared by unrelated processes mapping
+it). Only a few small objects refer to the buffer, whose pages are never
+written after packing.
+
+Layout of the buffer: the MAGIC string, the length of the JSON header as an
+unsigned 64-bit little-endian integer, the header describing the schema and
+the offset, type and length of every array, and the arrays aligned to
+ALIGNMENT bytes.
+
+NOTE: the shared mapping is never written after creation, so it is safe to
+      read from any number of threads and forked processes at once.
+"""
+
+import bisect
+import json
+import mmap
+import struct
+import os
+
+import numpy as np
+
+if __package__:
+    from .interface import MultidimensionalMapping
+    from ._column_mapping.bitmap import BitmapMapping
+    from ._column_mapping.interval_tree import DELTA
+    from ._column_mapping.interval_tree import IntervalTreeMapping
+    from ._column_mapping.range import RangeMapping
+    from ._column_mapping.set import SetMapping
+else:
+    from secure_index.mapping.interface import MultidimensionalMapping
+    from secure_index.mapping._column_mapping.bitmap import BitmapMapping
+    from secure_index.mapping._column_mapping.interval_tree import DELTA
+    from secure_index.mapping._column_mapping.interval_tree import IntervalTreeMapping
+    from secure_index.mapping._column_mapping.range import RangeMapping
+    from secure_index.mapping._column_mapping.set import SetMapping
+
+
+MAGIC = b"SIMAP\x00\x00\x01"
+
+ALIGNMENT = 8
+
+# Kind of the packed representation of each mapping type
+KINDS = {
+    "bitmap": "set",
+    "interval-tree": "interval",
+    "range": "range",
+    "roaring": "set",
+    "set": "set",
+}
+
+CATEGORICAL = {
+    "bitmap": BitmapMapping,
+    "roaring": SetMapping,
+    "set": SetMapping,
+}
+
+
+def _strings(values):
+    """Pack a list of strings as offsets and UTF-8 bytes."""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return {"offsets": offsets,
+            "bytes": np.frombuffer(b"".join(encoded), dtype=np.uint8)}
+
+
+def _tokens(tokens):
+    """Pack the tokens of each generalization as a flat array."""
+    tokens = [list(token) if isinstance(token, (list, tuple, set))
+              else [token] for token in tokens]
+    flat = [token for generalization in tokens for token in generalization]
+    arrays = {"generalization": np.repeat(
+        np.arange(len(tokens), dtype=np.int64),
+        [len(generalization) for generalization in tokens])}
+    if all(isinstance(token, int) for token in flat):
+        arrays["values"] = np.array(flat, dtype=np.int64)
+    elif all(isinstance(token, str) for token in flat):
+        strings = _strings(flat)
+        arrays["offsets"] = strings["offsets"]
+        arrays["bytes"] = strings["bytes"]
+    else:
+        raise Exception("Tokens must be either all integers or all strings.")
+    return arrays
+
+
+def _pack_column(mapping, column):
+    """Return the generalizations, the tokens and the query structures of a
+    column as a dictionary of arrays."""
+    mapping_type = mapping.types[column]
+    data = mapping.mappings[column]
+    if mapping_type not in KINDS:
+        raise Exception(f"{mapping_type} is not a valid mapping type.")
+
+    arrays = {}
+    if mapping_type == "range":
+        column_mapping = RangeMapping(data)
+        generalizations = column_mapping.get_generalizations()
+        tokens = column_mapping.get_tokens()
+        arrays["starts"] = np.array([r[0] for r in column_mapping.ranges],
+                                    dtype=np.float64)
+        arrays["ends"] = np.array([r[1] for r in column_mapping.ranges],
+                                  dtype=np.float64)
+    elif mapping_type == "interval-tree":
+        # Iterate the intervals once to keep them aligned with the tokens
+        column_mapping = IntervalTreeMapping(data)
+        intervals = list(column_mapping.interval_tree[:])
+        generalizations = [
+            f"[{begin}-{end - DELTA}]" if begin != end - DELTA else str(begin)
+            for begin, end, _ in intervals
+        ]
+        tokens = [column_mapping._get_tokens(token)
+                  for _, _, token in intervals]
+        arrays["starts"] = np.array([begin for begin, _, _ in intervals],
+                                    dtype=np.float64)
+        arrays["ends"] = np.array([end for _, end, _ in intervals],
+                                  dtype=np.float64)
+    else:
+        column_mapping = CATEGORICAL[mapping_type](data)
+        generalizations = column_mapping.get_generalizations()
+        tokens = column_mapping.get_tokens()
+        categories = sorted(column_mapping.categories)
+        members = []
+        for category in categories:
+            index = column_mapping.indexes[column_mapping.categories[category]]
+            members.append(sorted(index.nonzero() if mapping_type == "bitmap"
+                                  else index))
+        # Generalization having the category as its only one (if any)
+        counts = np.zeros(len(generalizations), dtype=np.int64)
+        for indexes in members:
+            counts[indexes] += 1
+        only = [next((i for i in indexes if counts[i] == 1), -1)
+                for indexes in members]
+        for name, array in _strings(categories).items():
+            arrays["categories_" + name] = array
+        arrays["members_offsets"] = np.zeros(len(members) + 1,
+                                             dtype=np.int64)
+        np.cumsum([len(indexes) for indexes in members],
+                  out=arrays["members_offsets"][1:])
+        arrays["members"] = np.array([i for indexes in members
+                                      for i in indexes], dtype=np.int64)
+        arrays["only"] = np.array(only, dtype=np.int64)
+
+    for name, array in _strings(generalizations).items():
+        arrays["generalizations_" + name] = array
+    for name, array in _tokens(tokens).items():
+        arrays["tokens_" + name] = array
+    return arrays
+
+
+def pack(mapping):
+    """Pack a multidimensional mapping into a single buffer.
+
+    :mapping: HeterogeneousMapping to pack.
+    :return: bytes holding the shared mapping.
+    """
+    header = {
+        "schema": list(mapping.schema),
+        "types": dict(mapping.types),
+        "is_gids": dict(mapping.is_gids),
+        "columns": {}
+    }
+    arrays = []
+    offset = 0
+    for column in mapping.mappings:
+        header["columns"][column] = {}
+        for name, array in _pack_column(mapping, column).items():
+            array = np.ascontiguousarray(array)
+            header["columns"][column][name] = [array.dtype.str,
+                                               offset,
+                                               len(array)]
+            arrays.append((offset, array))
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    encoded = json.dumps(header).encode("utf-8")
+    start = len(MAGIC) + 8 + len(encoded)
+    start += -start % ALIGNMENT
+    buffer = bytearray(start + offset)
+    buffer[:len(MAGIC)] = MAGIC
+    buffer[len(MAGIC):len(MAGIC) + 8] = struct.pack("<Q", len(encoded))
+    buffer[len(MAGIC) + 8:len(MAGIC) + 8 + len(encoded)] = encoded
+    for position, array in arrays:
+        position += start
+        buffer[position:position + array.nbytes] = array.tobytes()
+    return bytes(buffer)
+
+
+def save(mapping, path):
+    """Pack the mapping into a file readable only by its owner.
+
+    NOTE: the file holds the plaintext mapping, store it on a memory-backed
+          file system (e.g., /dev/shm) rather than on disk.
+
+    :mapping: HeterogeneousMapping to pack.
+    :path: Destination of the packed mapping.
+    """
+    packed = pack(mapping)
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as f:
+        f.write(packed)
+
+
+class _Strings:
+    """Read-only sequence of the strings packed by _strings."""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.data[start:end].tobytes().decode("utf-8")
+
+
+class _Column:
+    """Views over the packed arrays of a column."""
+
+    def __init__(self, kind, arrays):
+        self.kind = kind
+        self.generalizations = _Strings(arrays["generalizations_offsets"],
+                                        arrays["generalizations_bytes"])
+        self.generalization = arrays["tokens_generalization"]
+        if "tokens_values" in arrays:
+            self.values = arrays["tokens_values"]
+            self.strings = None
+        else:
+            self.values = None
+            self.strings = _Strings(arrays["tokens_offsets"],
+                                    arrays["tokens_bytes"])
+        if kind == "set":
+            self.categories = _Strings(arrays["categories_offsets"],
+                                       arrays["categories_bytes"])
+            self.members_offsets = arrays["members_offsets"]
+            self.members = arrays["members"]
+            self.only = arrays["only"]
+        else:
+            self.starts = arrays["starts"]
+            self.ends = arrays["ends"]
+
+    def tokens_of(self, selected):
+        """Return the set of tokens of the selected generalizations.
+
+        :selected: Boolean array over the generalizations.
+        """
+        positions = np.flatnonzero(selected[self.generalization])
+        if self.values is not None:
+            return set(self.values[positions].tolist())
+        return {self.strings[i] for i in positions}
+
+    def category(self, value):
+        """Return the position of the category (None when missing)."""
+        i = bisect.bisect_left(self.categories, value)
+        if i < len(self.categories) and self.categories[i] == value:
+            return i
+        return None
+
+    def selection(self):
+        return np.zeros(len(self.generalizations), dtype=bool)
+
+
+class SharedMapping(MultidimensionalMapping):
+    """Multidimensional mapping reading the packed arrays of a buffer.
+
+    :schema: List of strings representing column names of the original
+        dataset.
+    :mappings: Tuple of the names of the mapped columns.
+    :types: Dictionary stating the mapping type of each column.
+    :buffer: Buffer holding the packed mapping (see pack).
+    """
+
+    def __init__(self, buffer, owner=None):
+        """Read the mapping packed in the buffer.
+
+        :buffer: Object exposing the buffer protocol (e.g., mmap or the buf
+            of a SharedMemory) holding the packed mapping.
+        :owner: Optional object owning the buffer, closed alongside the
+            mapping. Defaults to None.
+        """
+        view = memoryview(buffer)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise Exception("The buffer does not hold a shared mapping.")
+        length, = struct.unpack("<Q", view[len(MAGIC):len(MAGIC) + 8])
+        start = len(MAGIC) + 8 + length
+        header = json.loads(bytes(view[len(MAGIC) + 8:start]))
+        start += -start % ALIGNMENT
+
+        self.buffer = buffer
+        self.owner = owner
+        self.schema = header["schema"]
+        self.types = header["types"]
+        self.is_gids = header["is_gids"]
+        self.mappings = tuple(header["columns"])
+        self.columns = {}
+        for column, descriptors in header["columns"].items():
+            arrays = {}
+            for name, (dtype, offset, count) in descriptors.items():
+                array = np.frombuffer(buffer,
+                                      dtype=np.dtype(dtype),
+                                      count=count,
+                                      offset=start + offset)
+                array.flags.writeable = False
+                arrays[name] = array
+            self.columns[column] = _Column(KINDS[self.types[column]], arrays)
+
+    @classmethod
+    def of(cls, mapping):
+        """Pack the mapping into an anonymous shared memory map, inherited
+        without copies by the processes forked afterwards.
+
+        :mapping: HeterogeneousMapping to pack.
+        """
+        packed = pack(mapping)
+        buffer = mmap.mmap(-1, len(packed))
+        buffer.write(packed)
+        return cls(buffer, owner=buffer)
+
+    @classmethod
+    def open(cls, path):
+        """Map the packed mapping stored at the given path read-only, its
+        pages are shared by all the processes mapping the same file.
+
+        :path: Path of the packed mapping (see save).
+        """
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, owner=buffer)
+
+    def close(self):
+        """Release the views over the buffer and close it."""
+        self.columns = {}
+        self.buffer = None
+        if self.owner is not None:
+            self.owner.close()
+            self.owner = None
+
+    def _get_column(self, column):
+        try:
+            return self.columns[column]
+        except KeyError:
+            raise Exception(f"{column} does not exist in the mapping.")
+
+    def _numerical(self, column, method):
+        mapping = self._get_column(column)
+        if mapping.kind == "set":
+            raise Exception(
+                f"Categorical mapping does not implement the {method} method."
+            )
+        return mapping
+
+    def get_generalizations(self, column):
+        return list(self._get_column(column).generalizations)
+
+    def get_tokens(self, column):
+        mapping = self._get_column(column)
+        tokens = [[] for _ in range(len(mapping.generalizations))]
+        if mapping.values is not None:
+            values = mapping.values.tolist()
+        else:
+            values = list(mapping.strings)
+        for i, token in zip(mapping.generalization.tolist(), values):
+            tokens[i].append(token)
+        return tokens
+
+    def is_gid(self, column):
+        try:
+            return self.is_gids[column]
+        except KeyError:
+            raise Exception(f"{column} does not exist in the mapping.")
+
+    def between(self, column, extremes):
+        mapping = self._numerical(column, "between")
+        a, b = extremes
+        if mapping.kind == "interval":
+            return mapping.tokens_of((mapping.starts < b + DELTA) &
+                                     (mapping.ends > a))
+        return mapping.tokens_of((mapping.ends >= a) & (mapping.starts <= b))
+
+    def eq(self, column, value):
+        mapping = self._get_column(column)
+        if mapping.kind == "interval":
+            return mapping.tokens_of((mapping.starts <= value) &
+                                     (mapping.ends > value))
+        if mapping.kind == "range":
+            return mapping.tokens_of((mapping.starts <= value) &
+                                     (mapping.ends >= value))
+        category = mapping.category(str(value))
+        selected = mapping.selection()
+        if category is not None:
+            start, end = mapping.members_offsets[category:category + 2]
+            selected[mapping.members[start:end]] = True
+        return mapping.tokens_of(selected)
+
+    def neq(self, column, value):
+        mapping = self._get_column(column)
+        if mapping.kind == "interval":
+            # TODO: support this by excluding [value, value+DELTA)
+            return mapping.tokens_of(~mapping.selection())
+        if mapping.kind == "range":
+            return mapping.tokens_of((mapping.starts < value) |
+                                     (mapping.ends > value))
+        category = mapping.category(str(value))
+        selected = ~mapping.selection()
+        if category is not None and mapping.only[category] != -1:
+            selected[mapping.only[category]] = False
+        return mapping.tokens_of(selected)
+
+    def ge(self, column, value):
+        mapping = self._numerical(column, "ge")
+        if mapping.kind == "interval":
+            return mapping.tokens_of(mapping.ends > value)
+        return mapping.tokens_of(mapping.ends >= value)
+
+    def gt(self, column, value):
+        mapping = self._numerical(column, "gt")
+        if mapping.kind == "interval":
+            return mapping.tokens_of(mapping.ends > value + DELTA)
+        return mapping.tokens_of(mapping.ends > value)
+
+    def le(self, column, value):
+        mapping = self._numerical(column, "le")
+        if mapping.kind == "interval":
+            return mapping.tokens_of(mapping.starts < value + DELTA)
+        return mapping.tokens_of(mapping.starts <= value)
+
+    def lt(self, column, value):
+        mapping = self._numerical(column, "lt")
+        return mapping.tokens_of(mapping.starts < value)
+
+    def in_values(self, column, values):
+        tokens = set()
+        for value in values:
+            tokens.update(self.eq(column, value))
+        return tokens
@@ -0,0 +1,79 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageMetrics:
+    """Thread-safe accumulator of the time spent in each stage of the query
+    pipeline.
+
+    Stages running on multiple threads accumulate the time spent by each
+    thread, so their throughput is per core.
+
+    :stages: Dictionary mapping the name of each stage to the number of
+        items it processed, the seconds it took and the bytes it consumed.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, nbytes=0, items=1):
+        """Record the processing of some items by a stage.
+
+        :stage: Name of the stage.
+        :seconds: Time spent processing the items.
+        :nbytes: Number of bytes consumed. Defaults to 0.
+        :items: Number of items processed. Defaults to 1.
+        """
+        with self.lock:
+            count, total, size = self.stages.get(stage, (0, 0.0, 0))
+            self.stages[stage] = (count + items, total + seconds, size + nbytes)
+
+    @contextmanager
+    def measure(self, stage, nbytes=0, items=1):
+        """Context manager recording the time spent in its body."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, nbytes, items)
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+
+    def stats(self):
+        """Return the metrics of each stage.
+
+        :return: Dictionary mapping the name of each stage to its number of
+            items, seconds, bytes, mean latency per item in seconds, items per
+            second and MB per second.
+        """
+        with self.lock:
+            stages = dict(self.stages)
+        return {
+            stage: {
+                "items": count,
+                "seconds": seconds,
+                "bytes": size,
+                "latency": seconds / count if count else 0.0,
+                "items/s": count / seconds if seconds else 0.0,
+                "MB/s": size / 2**20 / seconds if seconds else 0.0,
+            }
+            for stage, (count, seconds, size) in stages.items()
+        }
@@ -0,0 +1,118 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Padding of the group blobs to a small number of size classes.
+
+Padding every blob to the size of the largest one hides the size of the
+groups completely, but a single outlier inflates every blob. With C size
+classes, each blob is padded to the smallest class not smaller than it, so
+the size of a blob reveals only its class: at most log2(C) bits about the
+group it holds. A single class is equivalent to padding to the maximum.
+
+Class boundaries minimize the total padding given the sizes of the blobs.
+"""
+
+import bisect
+import math
+
+import numpy as np
+
+
+def size_classes(sizes, classes=1):
+    """Find the size classes minimizing the total padding.
+
+    :sizes: List of sizes of the blobs.
+    :classes: Maximum number of size classes. Defaults to 1.
+    :return: Sorted list of class sizes, the last one being the maximum size.
+    """
+    if classes < 1:
+        raise Exception("At least a size class is necessary.")
+    values, counts = np.unique(np.asarray(sizes, dtype=np.int64),
+                               return_counts=True)
+    if len(values) <= classes:
+        return values.tolist()
+
+    # Prefix sums of the counts and of the sizes of the distinct sizes
+    n = len(values)
+    count = np.concatenate(([0], np.cumsum(counts)))
+    total = np.concatenate(([0], np.cumsum(values * counts)))
+
+    def waste(i, j):
+        # Padding of the blobs with sizes values[i:j + 1] to values[j]
+        return values[j] * (count[j + 1] - count[i]) - \
+            (total[j + 1] - total[i])
+
+    # cost[j] is the minimum padding of values[:j + 1] with k classes, the
+    # last one being values[j]
+    cost = np.array([waste(0, j) for j in range(n)], dtype=np.float64)
+    splits = []
+    for _ in range(1, classes):
+        new_cost = cost.copy()
+        split = np.full(n, -1)
+        for j in range(1, n):
+            i = np.arange(j)
+            # Last class covering values[i + 1:j + 1]
+            candidates = cost[i] + waste(i + 1, j)
+            best = int(np.argmin(candidates))
+            if candidates[best] < new_cost[j]:
+                new_cost[j] = candidates[best]
+                split[j] = best
+        cost = new_cost
+        splits.append(split)
+
+    # Walk back the splits from the maximum size
+    boundaries = [n - 1]
+    j = n - 1
+    for split in reversed(splits):
+        if split[j] < 0:
+            continue
+        j = split[j]
+        boundaries.append(j)
+    return sorted(values[boundaries].tolist())
+
+
+def padded_size(size, boundaries):
+    """Return the size a blob is padded to.
+
+    :size: Size of the blob.
+    :boundaries: Sorted list of class sizes.
+    :return: Smallest class size not smaller than the blob.
+    """
+    i = bisect.bisect_left(boundaries, size)
+    if i == len(boundaries):
+        raise Exception(f"Blob of {size} bytes exceeds the largest class.")
+    return boundaries[i]
+
+
+def padding_stats(sizes, boundaries=None):
+    """Summarize the cost of the padding.
+
+    :sizes: List of sizes of the blobs.
+    :boundaries: Sorted list of class sizes, None when not padding.
+    :return: Dictionary with the number of classes, the leakage bound in bits
+        per blob, the mean and maximum padding per blob and the total bytes
+        before and after padding.
+    """
+    padded = [padded_size(size, boundaries) if boundaries else size
+              for size in sizes]
+    waste = [after - before for before, after in zip(sizes, padded)]
+    classes = len(boundaries) if boundaries else len(set(sizes))
+    return {
+        "classes": classes,
+        "leakage bits": math.log2(classes) if classes else 0.0,
+        "mean waste": sum(waste) / len(waste) if waste else 0.0,
+        "max waste": max(waste) if waste else 0,
+        "unpadded bytes": sum(sizes),
+        "total bytes": sum(padded),
+    }
@@ -0,0 +1,102 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Posting lists of the key-value store serialized as roaring bitmaps.
+
+Besides the Redis sets (column:label) scanned by the Lua script, the GroupIds
+of each label can be stored as a roaring bitmap in the hash column:postings.
+The client then retrieves the bitmaps of the labels with HMGET and computes
+unions and intersections locally, which keeps Redis memory and CPU low.
+"""
+
+from pyroaring import BitMap
+
+
+SUFFIX = ":postings"
+
+MODES = ["auto", "lua", "roaring"]
+
+# Labels from which the auto mode evaluates the posting lists client-side
+AUTO_LABELS = 256
+
+
+def key_of(column):
+    """Return the name of the hash holding the posting lists of a column."""
+    return column + SUFFIX
+
+
+def dumps(gids):
+    """Serialize the GroupIds of a posting list."""
+    return BitMap(int(gid) for gid in gids).serialize()
+
+
+def loads(blob):
+    """Deserialize a posting list (None when the label is missing)."""
+    return BitMap.deserialize(blob) if blob is not None else BitMap()
+
+
+def use_bitmaps(kv_store_data, mode):
+    """Choose whether to evaluate the posting lists client-side.
+
+    Server-side unions cost a set lookup per label while the bitmaps of
+    the labels are compact, so the auto mode pulls the bitmaps when the
+    query involves many labels or more than a column to intersect.
+
+    :kv_store_data: Dictionary holding for each column the labels to
+        request to the key-value store.
+    :mode: One of auto, lua or roaring.
+    :return: True to evaluate the posting lists client-side.
+    """
+    if mode != "auto":
+        return mode == "roaring"
+    columns = [column for column in kv_store_data if column != "GroupId"]
+    labels = sum(len(kv_store_data[column]) for column in columns)
+    return labels >= AUTO_LABELS or len(kv_store_data) > 2
+
+
+def requests(kv_store_data, chunk_size):
+    """Return the (column, labels) chunks to request with HMGET."""
+    chunks = []
+    for column in kv_store_data:
+        if column == "GroupId":
+            continue
+        labels = list(kv_store_data[column])
+        for i in range(0, len(labels), chunk_size):
+            chunks.append((column, labels[i:i + chunk_size]))
+    return chunks
+
+
+def evaluate(kv_store_data, chunks, replies):
+    """Intersect the unions of the posting lists of each column.
+
+    :kv_store_data: Dictionary holding for each column the labels to
+        request to the key-value store.
+    :chunks: List of (column, labels) chunks returned by requests.
+    :replies: List of the HMGET replies of the chunks.
+    :return: Sorted list of the matching GroupIds.
+    """
+    unions = {}
+    for (column, _), blobs in zip(chunks, replies):
+        union = unions.setdefault(column, BitMap())
+        union |= BitMap.union(*map(loads, blobs)) if blobs else BitMap()
+    if "GroupId" in kv_store_data:
+        unions["GroupId"] = BitMap(map(int, kv_store_data["GroupId"]))
+
+    # Intersect the smallest unions first
+    result = None
+    for union in sorted(unions.values(), key=len):
+        result = union if result is None else result & union
+        if not result:
+            break
+    return list(result) if result is not None else []
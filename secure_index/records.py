@@ -0,0 +1,122 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary format of the wrapped dataset.
+
+The file starts with a magic string and a length-prefixed msgpack header
+listing the columns. Every row follows as a length-prefixed msgpack array,
+where the encrypted tuples are raw bytes instead of base64 text. Lengths are
+4-byte little-endian unsigned integers.
+"""
+
+import struct
+
+import msgpack
+
+
+MAGIC = b"SIWRAP\x00\x01"
+
+LENGTH = struct.Struct("<I")
+
+# Number of rows returned at once by the reader
+BATCH_SIZE = 10000
+
+
+def is_records(path):
+    """Check whether the file is in the binary format."""
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class RecordWriter:
+    """Writer of the wrapped dataset in the binary format.
+
+    :path: Destination of the wrapped dataset.
+    :columns: Names of the columns of the rows.
+    """
+
+    def __init__(self, path, columns):
+        self.columns = list(columns)
+        self.file = open(path, "wb")
+        header = msgpack.packb({"columns": self.columns})
+        self.file.write(MAGIC + LENGTH.pack(len(header)) + header)
+
+    def write(self, rows):
+        """Append the rows to the file.
+
+        :rows: Iterable of rows, one value per column.
+        """
+        packer = msgpack.Packer()
+        chunks = []
+        for row in rows:
+            if len(row) != len(self.columns):
+                raise Exception(f"Row with {len(row)} values does not match "
+                                f"the {len(self.columns)} columns.")
+            record = packer.pack(list(row))
+            chunks.append(LENGTH.pack(len(record)))
+            chunks.append(record)
+        self.file.write(b"".join(chunks))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise Exception("Truncated wrapped dataset.")
+    return data
+
+
+def read(path, batch_size=BATCH_SIZE):
+    """Read the wrapped dataset in the binary format.
+
+    :path: Path to the wrapped dataset.
+    :batch_size: Maximum number of rows of a batch.
+    :return: List of column names and generator of batches of rows.
+    """
+    f = open(path, "rb")
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception(f"{path} is not a binary wrapped dataset.")
+        length, = LENGTH.unpack(_read_exactly(f, LENGTH.size))
+        header = msgpack.unpackb(_read_exactly(f, length))
+    except Exception:
+        f.close()
+        raise
+
+    def batches():
+        with f:
+            batch = []
+            while True:
+                prefix = f.read(LENGTH.size)
+                if not prefix:
+                    break
+                if len(prefix) != LENGTH.size:
+                    raise Exception("Truncated wrapped dataset.")
+                length, = LENGTH.unpack(prefix)
+                batch.append(tuple(msgpack.unpackb(_read_exactly(f, length))))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+    return header["columns"], batches()
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import functools
+import re
 from collections import defaultdict
 
 import sqlparse
@@ -21,8 +22,10 @@ import sqlparse.tokens as T
 
 
 if __package__:
+    from .cover import table_of
     from .sqlparser import parse
 else:
+    from secure_index.cover import table_of
     from secure_index.sqlparser import parse
 
 def truncate(state):
@@ -31,14 +34,55 @@ def truncate(state):
         state.tokens = state.tokens[:state.other]
 
 
-def rewrite_projection(state):
+def rewrite_projection(state, with_gid=False, cached=None):
+    """Rewrite the projection to retrieve the encrypted tuples.
+
+    :state: Information about the query to rewrite.
+    :with_gid: Whether to retrieve the GroupId alongside the encrypted tuples.
+        Defaults to False.
+    :cached: Collection of GroupIds the client already holds, for which the
+        server returns NULL in place of the encrypted tuples. Defaults to
+        None.
+    """
     start, end = state.projection
     for _ in range(start, end):
         del state.tokens[start]
-    for i, token in enumerate(sqlparse.parse(" \"EncTuples\" ")[0].tokens):
+    projection = projection_of(with_gid, cached)
+    for i, token in enumerate(sqlparse.parse(f" {projection} ")[0].tokens):
         state.tokens.insert(start + i, token)
 
 
+def projection_of(with_gid=False, cached=None):
+    """Return the projection retrieving the encrypted tuples (see
+    rewrite_projection)."""
+    projection = "\"EncTuples\""
+    if cached:
+        projection = "CASE WHEN \"GroupId\" IN (VALUES (" + \
+                     to_string(cached) + ")) THEN NULL ELSE \"EncTuples\" END"
+    if with_gid or cached:
+        projection = "\"GroupId\", " + projection
+    return projection
+
+
+def lookup(table, gids, with_gid=False, cached=None):
+    """Return the query retrieving the encrypted tuples of the given groups
+    by their primary key.
+
+    :table: Name of the table holding the encrypted tuples.
+    :gids: Collection of GroupIds to retrieve.
+    :with_gid: Whether to retrieve the GroupId alongside the encrypted tuples.
+        Defaults to False.
+    :cached: Collection of GroupIds the client already holds. Defaults to
+        None.
+    :return: The lookup query.
+    """
+    condition = "False"
+    if gids:
+        condition = "\"GroupId\" IN (VALUES (" + to_string(gids) + "))"
+    return f"SELECT {projection_of(with_gid, cached)} " + \
+           f"FROM \"{table}\" WHERE {condition}"
+
+
 def rewrite_table_with_mapping(state):
     rewritten = f"{state.table.normalized} JOIN mapping USING (\"GroupId\")"
     state.table.tokens = sqlparse.parse(rewritten)[0].tokens
@@ -76,21 +120,58 @@ def get_column(string):
     return drop_double_quotes(string)
 
 
-def rewrite_table_with_normalization(state):
-    columns = set()
-    for comparison in state.comparisons:
-        left, op, right, *additional = filter(comparison.tokens)
+def rename_table(query, table, name):
+    """Make the rewritten query refer to another table (e.g., a partition).
 
-        if isinstance(left, S.Identifier) and isinstance(right, S.Identifier):
-            raise Exception("Comparisons among two columns are not supported.")
+    :query: Rewritten query.
+    :table: Name of the table the query refers to.
+    :name: Name of the table to refer to instead.
+    :return: The query referring to the given table.
+    """
+    pattern = r'(\bFROM\s+)("?)' + re.escape(table) + r'\2(?=[\s;)]|$)'
+    return re.sub(pattern,
+                  lambda match: match.group(1) + '"' + name + '"',
+                  query,
+                  count=1,
+                  flags=re.IGNORECASE)
 
-        # Swap column identifier to the left
-        if isinstance(right, S.Identifier):
-            left, right = right, left
 
-        column = get_column(left.normalized)
-        columns.add(column)
+def _comparison_column(comparison):
+    """Return the column the comparison is on."""
+    left, op, right, *additional = filter(comparison.tokens)
+
+    if isinstance(left, S.Identifier) and isinstance(right, S.Identifier):
+        raise Exception("Comparisons among two columns are not supported.")
+
+    # Swap column identifier to the left
+    if isinstance(right, S.Identifier):
+        left, right = right, left
+
+    return get_column(left.normalized)
+
 
+def _wrap(token, prefix, suffix):
+    """Replace the token in its parent with the token enclosed by the given
+    strings, keeping the token itself in place to be rewritten later."""
+    parent = token.parent
+    i = next(i for i, child in enumerate(parent.tokens) if child is token)
+    wrapper = S.TokenList([S.Token(T.Other, prefix),
+                           token,
+                           S.Token(T.Other, suffix)])
+    wrapper.parent = parent
+    parent.tokens[i] = wrapper
+
+
+def rewrite_table_with_joins(state):
+    """Rewrite the table to the join of the normalized tables.
+
+    The encrypted tuples are joined with the tokens of their group and with
+    the labels of each column in the comparisons, which the WHERE clause then
+    filters.
+    """
+    columns = set()
+    for comparison in state.comparisons:
+        columns.add(_comparison_column(comparison))
 
     # Rewrite query according to the columns in the comparisons
     rewritten = [state.table.normalized,
@@ -100,6 +181,45 @@ def rewrite_table_with_normalization(state):
     state.table.tokens = sqlparse.parse(" ".join(rewritten))[0].tokens
 
 
+def rewrite_table_with_normalization(state):
+    """Push the filters down to the normalized tables as semi-joins.
+
+    Each comparison selects the ids of the matching labels from the table of
+    its column, the WHERE clause selects the GroupIds whose tokens have such
+    ids, and only then the encrypted tuples are fetched by GroupId:
+
+        SELECT "EncTuples" FROM table WHERE "GroupId" IN (
+            SELECT "GroupId" FROM "GroupIdToColumns" WHERE
+                "<col>Id" IN (SELECT "Id" FROM "<col>" WHERE <comparison>)
+                AND ...)
+
+    Comparisons are left in place, to be rewritten to the labels as usual.
+    """
+    for comparison in state.comparisons:
+        column = _comparison_column(comparison)
+        _wrap(comparison,
+              f"\"{column}Id\" IN (SELECT \"Id\" FROM \"{column}\" WHERE ",
+              ")")
+
+    where = next((token for token in state.tokens
+                  if isinstance(token, S.Where)), None)
+    if where is None:
+        return
+    # Close the subquery before trailing whitespaces, comments and semicolons
+    end = len(where.tokens)
+    while end > 1 and (where.tokens[end - 1].is_whitespace or
+                       isinstance(where.tokens[end - 1], S.Comment) or
+                       where.tokens[end - 1].ttype in T.Comment or
+                       where.tokens[end - 1].match(T.Punctuation, ";")):
+        end -= 1
+    where.tokens[1:end] = [
+        S.Token(T.Other, " \"GroupId\" IN (SELECT \"GroupId\" " +
+                         "FROM \"GroupIdToColumns\" WHERE"),
+        *where.tokens[1:end],
+        S.Token(T.Other, ")")
+    ]
+
+
 def get_number(string):
     num = float(string)
     if num.is_integer():
@@ -123,9 +243,33 @@ def to_string(labels):
     return "),(".join(map(str, sorted(labels)))
 
 
+def rewrite_with_cover(column, labels, cover):
+    """Rewrite the membership of a column to the nodes covering the labels.
+
+    :column: Column name.
+    :labels: Set of labels of the column.
+    :cover: RangeCover of the column.
+    :return: SQL condition selecting the labels.
+    """
+    nodes, tokens = cover.cover(labels)
+    conditions = []
+    if nodes:
+        conditions.append(f"\"{column}\" IN (SELECT \"{column}\" FROM " +
+                          f"\"{table_of(column)}\" WHERE \"Node\" IN " +
+                          "(VALUES (" + to_string(nodes) + ")))")
+    if tokens:
+        conditions.append(f"\"{column}\" IN (VALUES (" + to_string(tokens) +
+                          "))")
+    return "(" + " OR ".join(conditions) + ")"
+
+
 ROTATE = {"=": "=", ">": "<", "<": ">", ">=": "<=", "<=": ">=", "<>": "<>"}
 
-def rewrite_comparisons(mapping, state, kv_store_data=None):
+def rewrite_comparisons(mapping,
+                        state,
+                        kv_store_data=None,
+                        covers=None,
+                        complement=None):
     """Rewrite query comparisons using mapping information.
 
     This function rewrites comparisons inplace assuming there is no use of the
@@ -138,6 +282,10 @@ def rewrite_comparisons(mapping, state, kv_store_data=None):
     :state: Information about the query to rewrite.
     :kv_store_data: Dictionary holding for each column the keys to request to
         the key-value store. Defaults to None.
+    :covers: Dictionary from a range column to the RangeCover whose nodes
+        replace its labels. Defaults to None.
+    :complement: Complement rewriting the labels covering most of the domain
+        of their column to the tokens they exclude. Defaults to None.
     """
     FUNCTIONS = {
         "=": mapping.eq,  ">": mapping.gt, "<": mapping.lt, ">=": mapping.ge,
@@ -182,6 +330,9 @@ def rewrite_comparisons(mapping, state, kv_store_data=None):
             # Rewrite comparison
             rewritten = "False"
             if labels:
+                excluded = None
+                if complement is not None and kv_store_data is None:
+                    excluded = complement.excluded(column, labels)
                 column = column if not mapping.is_gid(column) else "GroupId"
 
                 if kv_store_data is not None:
@@ -194,7 +345,16 @@ def rewrite_comparisons(mapping, state, kv_store_data=None):
                         kv_store_data[column].intersection_update(labels)
                     continue
                 
-                rewritten = '"' + column + "\" IN (VALUES (" + to_string(labels) + "))"
+                if excluded is not None:
+                    rewritten = "True"
+                    if excluded:
+                        rewritten = '"' + column + "\" NOT IN (VALUES (" + \
+                                    to_string(excluded) + "))"
+                elif covers and column in covers:
+                    rewritten = rewrite_with_cover(column, labels,
+                                                   covers[column])
+                else:
+                    rewritten = '"' + column + "\" IN (VALUES (" + to_string(labels) + "))"
 
             comparison.tokens = sqlparse.parse(rewritten)[0].tokens
 
@@ -213,23 +373,47 @@ def rewrite(query,
             mapping,
             rewrite_table=None,
             rewrite_comparisons=rewrite_comparisons,
-            kv_store_mode=False):
+            kv_store_mode=False,
+            with_gid=False,
+            cached=None,
+            covers=None,
+            complement=None):
     """
+    Rewriting is thread-safe: the parsed state is local to the call, and the
+    mapping, the range covers and the complement are only read, so concurrent
+    threads (or forked processes) may share them, e.g., a SharedMapping (see
+    test/query/thread_safety.py).
+
     :kv_store_mode: removes part of the query rewriter functionality of the rewriter
+    :with_gid: retrieve the GroupId of each encrypted tuple
+    :cached: GroupIds whose encrypted tuples the server should not return
+    :covers: range covers replacing the labels of range columns with nodes
+    :complement: complement replacing the labels covering most of a domain
+        with the tokens they exclude (or dropping the condition)
     """
     state = parse(query)
     truncate(state)
 
-    rewrite_projection(state)
+    rewrite_projection(state, with_gid, cached)
     if rewrite_table is not None:
         rewrite_table(state)
 
     kv_store_data = defaultdict(set) if kv_store_mode else None
-    rewrite_comparisons(mapping, state, kv_store_data)
+    options = {}
+    if covers and not kv_store_mode:
+        options["covers"] = covers
+    if complement is not None and not kv_store_mode:
+        options["complement"] = complement
+    rewrite_comparisons(mapping, state, kv_store_data, **options)
 
     table = drop_double_quotes(state.table.normalized)
 
     if kv_store_mode:
+        # Cover the labels once every condition on the column is applied
+        for column in covers or {}:
+            if kv_store_data.get(column):
+                nodes, tokens = covers[column].cover(kv_store_data[column])
+                kv_store_data[column] = nodes | tokens
         return kv_store_data, table
 
     rewritten = str(state)
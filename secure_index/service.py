@@ -0,0 +1,151 @@
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from socketserver import ThreadingMixIn
+from socketserver import UnixStreamServer
+
+import msgpack
+import pandas as pd
+
+
+CONTENT_TYPE = "application/msgpack"
+
+
+def encode_result(result):
+    """Encode the result of a query in the binary format of the service.
+
+    :result: DataFrame with the result of the query.
+    :return: MessagePack map with the list of column names and the list of
+        rows.
+    """
+    return msgpack.dumps({
+        "columns": [str(column) for column in result.columns],
+        "rows": result.astype(object).values.tolist(),
+    })
+
+
+def decode_result(body):
+    """Decode the result of a query returned by the service.
+
+    :body: Body of the response.
+    :return: DataFrame with the result of the query.
+    """
+    result = msgpack.loads(body)
+    return pd.DataFrame(result["rows"], columns=result["columns"])
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """HTTP handler of the query service.
+
+    POST /query runs the plaintext SQL query in the body of the request and
+    responds with its result in binary format (see encode_result). GET
+    /metrics responds with the per-stage metrics of the client in JSON.
+    """
+
+    server_version = "SecureIndex/0.1"
+
+    def do_POST(self):
+        if self.path != "/query":
+            self._send(404, "text/plain", b"Not found")
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        query = self.rfile.read(length).decode("utf-8")
+
+        client = self.server.client
+        start = time.perf_counter()
+        try:
+            result = client.execute(query)
+        except Exception as e:
+            self._send(400, "text/plain", str(e).encode("utf-8"))
+            return
+        executed = time.perf_counter()
+        body = encode_result(result)
+        encoded = time.perf_counter()
+
+        client.metrics.record("encode", encoded - executed, len(body))
+        client.metrics.record("query", encoded - start)
+        self._send(200, CONTENT_TYPE, body)
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self._send(404, "text/plain", b"Not found")
+            return
+
+        metrics = self.server.client.metrics.stats()
+        if self.server.client.cache is not None:
+            metrics["cache"] = self.server.client.cache.stats()
+        body = json.dumps(metrics).encode("utf-8")
+        self._send(200, "application/json", body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server running the queries with a long-lived client.
+
+    :address: Host and port the server listens on.
+    :client: Query client holding the mapping, the secret box, the connection
+        pool and the cache.
+    :verbose: Whether to log the requests. Defaults to False.
+    """
+
+    def __init__(self, address, client, verbose=False):
+        super().__init__(address, QueryHandler)
+        self.client = client
+        self.verbose = verbose
+
+
+class UnixQueryServer(ThreadingMixIn, UnixStreamServer):
+    """HTTP server running the queries with a long-lived client listening on
+    a Unix socket.
+
+    :path: Path of the Unix socket.
+    :client: Query client holding the mapping, the secret box, the connection
+        pool and the cache.
+    :verbose: Whether to log the requests. Defaults to False.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, client, verbose=False):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, QueryHandler)
+        self.client = client
+        self.verbose = verbose
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # Unix sockets have no client address
+        return request, ("local", 0)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
@@ -27,9 +27,12 @@ class State:
     :projection: List of tokens representing the projection.
     :table: Token of the table identifier.
     :comparisons: List of tokens representing comparisons in the where clause.
-    :other: Position of the first occurance of a group by, having or order by
-        clause.
+    :other: Position of the first occurance of a group by, having, order by
+        or limit clause.
     :comparisons: List of comparisons the query uses as selection.
+    :limits: Position of the limit clause.
+    :limit: Maximum number of rows the query returns (None when unlimited).
+    :offset: Number of rows the query skips (None when not given).
     """
 
     def __init__(self, tokens):
@@ -38,6 +41,9 @@ class State:
         self.table = None
         self.comparisons = []
         self.other = None
+        self.limits = None
+        self.limit = None
+        self.offset = None
 
     def __str__(self):
         return ''.join(str(token) for token in self.tokens)
@@ -109,6 +115,7 @@ def select(tokens):
         [WHERE expression]
         [GROUP BY expression+ [HAVING expression]]
         [ORDER BY (expression [ASC|DESC] [NULLS [FIRST|LAST]])+]
+        [LIMIT count [OFFSET skip]]
 
     :tokens: The sqlparse SELECT statement representation.
     :return: A tree storing the tables and columns identifiers the statement
@@ -139,7 +146,7 @@ def select(tokens):
                 tokens[i + 1:],
                 item_resolver=_table_resolver,
                 limiter=lambda tok: isinstance(tok, S.Where) or tok.match(
-                    T.Keyword, ["GROUP BY", "ORDER BY"]))
+                    T.Keyword, ["GROUP BY", "ORDER BY", "LIMIT"]))
             i += length
 
         # [WHERE expression]
@@ -153,6 +160,17 @@ def select(tokens):
         # [ORDER BY (expression [ASC|DESC] [NULLS [FIRST|LAST]])+]
         elif tok.match(T.Keyword, ["GROUP BY", "HAVING", "ORDER BY"]):
             state.other = i
+            # [LIMIT count [OFFSET skip]] follows the other clauses
+            for j in range(i + 1, len(tokens)):
+                if tokens[j].match(T.Keyword, "LIMIT"):
+                    _limit(state, tokens, j)
+                    break
+            break
+
+        # [LIMIT count [OFFSET skip]]
+        elif tok.match(T.Keyword, "LIMIT"):
+            state.other = i
+            _limit(state, tokens, i)
             break
 
         elif tok.is_keyword:
@@ -168,6 +186,47 @@ def select(tokens):
     return state
 
 
+def _limit(state, tokens, i):
+    """Resolve the LIMIT clause.
+
+    :state: The state on which the function operates.
+    :tokens: The sqlparse SELECT statement representation.
+    :i: The position of the LIMIT keyword.
+    """
+    def _count(tok):
+        if tok is None or tok.ttype not in T.Number.Integer:
+            raise Exception(
+                "LIMIT and OFFSET are supported only with integer literals.")
+        return int(tok.value)
+
+    items = [tok for tok in tokens[i + 1:]
+             if not (tok.is_whitespace or isinstance(tok, S.Comment) or
+                     tok.ttype in T.Comment)]
+    if items and items[-1].match(T.Punctuation, ";"):
+        items.pop()
+
+    state.limits = i
+    state.limit = _count(items[0] if items else None)
+    if len(items) == 1:
+        return
+    if len(items) != 3 or not items[1].match(T.Keyword, "OFFSET"):
+        raise Exception("LIMIT supports only the LIMIT count [OFFSET skip] " +
+                        "syntax.")
+    state.offset = _count(items[2])
+
+
+def without_limit(state):
+    """Return the query without its LIMIT clause.
+
+    :state: Information about the query, as returned by parse (before any
+        rewriting).
+    :return: The query retrieving every row.
+    """
+    if state.limits is None:
+        return str(state)
+    return ''.join(str(token) for token in state.tokens[:state.limits])
+
+
 def _ignore_comma_separated_list(tokens,
                                  skip=None,
                                  limiter=None):
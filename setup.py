@@ -22,9 +22,17 @@ setup(
     install_requires=[
         "bitmap==0.0.7",
         "intervaltree==3.1.0",
+        "lz4==3.1.3",
+        "msgpack==1.0.2",
+        "numpy==1.22.0",
+        "pandas==1.1.5",
         "pynacl==1.4.0",
         "pyroaring==0.3.3",
+        "python-snappy==0.6.0",
+        "redis==4.4.4",
         "sqlparse==0.4.4",
+        "zstandard==0.19.0",
+        "zstd==1.5.4.0",
     ],
     url="http://github.com/unibg-seclab/secure_index",
     author="UniBG Seclab",
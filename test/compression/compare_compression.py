@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse
+import json
+import pickle
+import random
+import time
+from functools import partial
+
+import lz4.frame
+import msgpack
+import pandas as pd
+import snappy
+import zstd
+
+from secure_index import columnar
+from secure_index import dictionary as zstd_dictionary
+
+
+""" USAGE
+./compare_compression.py datasets/usa2018/usa2018.csv datasets/usa2018/usa2018_25.csv test/results/compression/usa2018_25.csv"""
+
+SERIALIZE = {
+    "json": lambda tuples: json.dumps(tuples).encode("utf-8"),
+    "pickle": pickle.dumps,
+    "msgpack": msgpack.dumps,
+    "columnar": columnar.dumps
+}
+
+COMPRESS = {
+    "none": lambda bytes: bytes,
+    "lz4": partial(lz4.frame.compress,
+                   compression_level=lz4.frame.COMPRESSIONLEVEL_MINHC,
+                   store_size=False),
+    "snappy": snappy.compress,
+    "zstd": lambda bytes: zstd.compress(bytes, 3, 1)
+}
+
+DECOMPRESS = {
+    "none": lambda bytes: bytes,
+    "lz4": lz4.frame.decompress,
+    "snappy": snappy.decompress,
+    "zstd": zstd.decompress
+}
+
+# Maximum number of groups used to train the zstd dictionary
+DICTIONARY_SAMPLES = 5000
+
+
+def evaluate(serialized, compress, decompress):
+    start = time.time()
+    compressed = [compress(blob) for blob in serialized]
+    compression_time = time.time() - start
+
+    start = time.time()
+    for blob in compressed:
+        decompress(blob)
+    decompression_time = time.time() - start
+
+    sizes = [len(blob) for blob in compressed]
+    return {
+        "mean": sum(sizes) / len(sizes),
+        "max": max(sizes),
+        "total": sum(sizes),
+        # Every blob is padded to the maximum size
+        "padded": max(sizes) * len(sizes),
+        "compression time": compression_time,
+        "decompression time": decompression_time,
+    }
+
+
+parser = argparse.ArgumentParser(
+    description='Compare the size of the group blobs produced by the ' +
+                'available compression algorithms.'
+)
+parser.add_argument('dataset',
+                    metavar='PLAIN',
+                    help='path to the plain dataset')
+parser.add_argument('anonymized',
+                    metavar='ANONIMIZED',
+                    help='path to the anonymized dataset')
+parser.add_argument('output',
+                    metavar='OUTPUT',
+                    help='where to store the comparison report')
+parser.add_argument('-s',
+                    '--serialization',
+                    metavar='FORMAT',
+                    nargs='+',
+                    choices=['columnar', 'json', 'msgpack', 'pickle'],
+                    default=['json'],
+                    help='one or more serialization formats: columnar, json '
+                         '(default), msgpack, pickle')
+
+args = parser.parse_args()
+
+print("[*] Read datasets")
+df = pd.read_csv(args.dataset, index_col="INDEX")
+adf = pd.read_csv(args.anonymized, index_col="INDEX", usecols=["INDEX", "GID"])
+groups = [list(group[df.columns].itertuples(index=False, name=None))
+          for _, group in df.join(adf).groupby("GID")]
+print(f"Groups: \t\t {len(groups)}")
+
+random.seed(0)
+rows = []
+for serialization in args.serialization:
+    print(f"[*] Serialize groups with {serialization}")
+    serialize = SERIALIZE[serialization]
+    serialized = [serialize(group) for group in groups]
+    original = sum(len(blob) for blob in serialized)
+
+    for compression in COMPRESS:
+        print(f"[*] Compress groups with {compression}")
+        stats = evaluate(serialized,
+                         COMPRESS[compression],
+                         DECOMPRESS[compression])
+        rows.append({"serialization": serialization,
+                     "compression": compression,
+                     "dictionary": 0,
+                     "serialized": original,
+                     **stats})
+
+    print(f"[*] Compress groups with zstd-dict")
+    start = time.time()
+    sample = random.sample(serialized,
+                           min(DICTIONARY_SAMPLES, len(serialized)))
+    dictionary = zstd_dictionary.train(sample)
+    training_time = time.time() - start
+    stats = evaluate(serialized,
+                     zstd_dictionary.compressor(dictionary),
+                     zstd_dictionary.decompressor(dictionary))
+    rows.append({"serialization": serialization,
+                 "compression": "zstd-dict",
+                 "dictionary": len(dictionary),
+                 "serialized": original,
+                 **stats,
+                 "training time": training_time})
+
+report = pd.DataFrame(rows)
+report["ratio"] = report["serialized"] / report["total"]
+report["padded ratio"] = report["serialized"] / report["padded"]
+print(report.to_string(index=False))
+
+print("[*] Write report")
+report.to_csv(args.output, index=False)
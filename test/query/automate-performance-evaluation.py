@@ -87,10 +87,10 @@ if __name__ == "__main__":
     parser.add_argument('--compression',
                         metavar='ALGORITHM',
                         nargs='+',
-                        choices=['none', 'lz4', 'snappy', 'zstd'],
+                        choices=['none', 'lz4', 'snappy', 'zstd', 'zstd-dict'],
                         default=['zstd'],
                         help='one or more compression algorithms: none, lz4, '
-                             'snappy, zstd (default)')
+                             'snappy, zstd (default), zstd-dict')
     parser.add_argument('-c',
                         '--config',
                         metavar='CONFIG',
@@ -127,10 +127,10 @@ if __name__ == "__main__":
     parser.add_argument('--serialization',
                         metavar='FORMAT',
                         nargs='+',
-                        choices=['json', 'msgpack', 'pickle'],
+                        choices=['columnar', 'json', 'msgpack', 'pickle'],
                         default=['json'],
-                        help='serialization format: json (default), msgpack, '
-                             'pickle')
+                        help='serialization format: columnar, json (default), '
+                             'msgpack, pickle')
     args = parser.parse_args()
 
     queries = args.query
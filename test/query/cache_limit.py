@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Check that cached groups are not decrypted again.
+
+Every query of the logs is run twice by a client caching more groups than
+the GroupIds it lists in the rewritten queries. The second run must take
+every group from the cache, decrypting none of those the server returns
+anyway, and produce the same result.
+"""
+
+import argparse
+import getpass
+import sys
+
+import nacl.pwhash
+import nacl.secret
+import pandas as pd
+import sqlalchemy
+
+from secure_index.cache import GroupCache
+from secure_index.client import QueryClient
+from secure_index.mapping.heterogeneous import HeterogeneousMapping
+
+
+def sorted_rows(df):
+    return sorted(df.astype(str).values.tolist())
+
+
+parser = argparse.ArgumentParser(
+    description='Check that the groups cached beyond the GroupIds listed ' +
+                'in the rewritten queries are not decrypted again.'
+)
+parser.add_argument('url', metavar='URL', help='database URL')
+parser.add_argument('input', metavar='INPUT', help='path to the mapping')
+parser.add_argument('workload',
+                    metavar='LOG',
+                    nargs='+',
+                    help='query logs (CSV files with a query column, where '
+                         '<TABLE> stands for the wrapped table)')
+parser.add_argument('--cached-limit',
+                    type=int,
+                    default=10,
+                    help='number of cached GroupIds listed in the rewritten '
+                         'queries (default: 10)')
+parser.add_argument('--password',
+                    help='password necessary to read the mapping')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    pw = args.password.encode("utf-8") if args.password else None
+    if not pw:
+        pw = getpass.getpass("Password: ").encode("utf-8")
+    salt = b'\xd0\xe1\x03\xc2Z<R\xaf]\xfe\xd5\xbf\xf8u|\x8f'
+    # Generate the key
+    kdf = nacl.pwhash.argon2id.kdf
+    key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
+    box = nacl.secret.SecretBox(key)
+
+    mapping = HeterogeneousMapping(args.input, key)
+    engine = sqlalchemy.create_engine(args.url)
+    client = QueryClient(mapping,
+                         box,
+                         engine,
+                         cached_limit=args.cached_limit)
+
+    # Count the groups decrypted
+    decrypted = 0
+    decrypt = client.decrypt
+
+    def counting_decrypt(enc_tuples):
+        global decrypted
+        decrypted += 1
+        return decrypt(enc_tuples)
+
+    client.decrypt = counting_decrypt
+
+    queries = []
+    for path in args.workload:
+        df = pd.read_csv(path)
+        queries.extend(query.replace("<TABLE>", "wrapped")
+                       for query in df["query"])
+
+    failed = False
+    checked = 0
+    for query in queries:
+        # Large enough to keep every group retrieved
+        client.cache = GroupCache(2**40)
+        expected = client.execute(query)
+        if len(client.cache) <= args.cached_limit:
+            continue
+        checked += 1
+        decrypted = 0
+        misses = client.cache.misses
+        result = client.execute(query)
+        if decrypted or client.cache.misses != misses:
+            print(f"ERROR: {decrypted} cached groups decrypted again by "
+                  f"{query}")
+            failed = True
+        # Cached groups come first, so the rows may be in another order
+        if sorted_rows(result) != sorted_rows(expected):
+            print(f"ERROR: different results from the cache for {query}")
+            failed = True
+
+    client.close()
+    print(f"[*] Checked {checked} queries retrieving more than "
+          f"{args.cached_limit} groups")
+    if failed:
+        sys.exit(1)
+    print("[*] No cached group was decrypted again")
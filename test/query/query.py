@@ -21,7 +21,6 @@ import json
 import os
 import pickle
 import re
-import sqlite3
 import sys
 from timeit import default_timer as timer
 
@@ -35,8 +34,14 @@ import snappy
 import sqlalchemy
 import zstd
 
+from secure_index import columnar
+from secure_index import dictionary as zstd_dictionary
+from secure_index.filtering import compile_filter
+from secure_index.filtering import sqlite_filter
+from secure_index.filtering import to_columns
 from secure_index.mapping.heterogeneous import HeterogeneousMapping
 from secure_index.rewriting import rewrite as official_rewrite
+from secure_index.sqlparser import parse
 
 
 CHUNK_SIZE= 10000
@@ -48,7 +53,8 @@ MAPPINGS = {
 DESERIALIZE = {
     "json": lambda bytes: json.loads(bytes.decode("utf-8")),
     "pickle": pickle.loads,
-    "msgpack": msgpack.loads
+    "msgpack": msgpack.loads,
+    "columnar": columnar.loads_tuples
 }
 
 DECOMPRESS = {
@@ -145,11 +151,12 @@ def wrapped(engine, query, schema, box, kv_mode=False):
                     if column != "GroupId":
                         columns.append(column)
                 # Query key-value store using indices
-                rows = script(keys=[column for column in columns],
-                              args=[
-                                  ",".join(map(str, kv_store_data[column]))
-                                  for column in columns
-                              ])
+                _, rows = script(keys=[table] + columns,
+                                 args=[
+                                     msgpack.packb(
+                                         list(map(str, kv_store_data[column])))
+                                     for column in columns
+                                 ])
             execute_time = timer() - start
 
             # Decrypt the encrypted tuples
@@ -158,22 +165,20 @@ def wrapped(engine, query, schema, box, kv_mode=False):
                 tuples.extend(decrypt(row, box))
             decrypt_time = timer() - start
 
+    # Compile the original query into a vectorized filter
     start = timer()
-    df = pd.DataFrame(tuples, columns=schema)
-    with sqlite3.connect(':memory:') as conn:
-        # Store plaintext tuples in local cache
-        df.to_sql(table, conn, if_exists='replace', index=False,
-                  method='multi', chunksize=10000)
-        create_time = timer() - start
-
-        # Run original query on the local cache
-        start = timer()
-        cursor = conn.cursor()
-        cursor.execute(query)
-        columns = [description[0] for description in cursor.description]
-        result = pd.DataFrame(cursor.fetchall(), columns=columns)
-        filter_time = timer() - start
-        return result, [rewriting_time, execute_time, decrypt_time, create_time, filter_time]
+    evaluator = compile_filter(parse(query))
+    columns = to_columns(tuples, schema) if evaluator is not None else None
+    create_time = timer() - start
+
+    # Run original query on the plaintext tuples (falling back to SQLite
+    # when the query is not supported)
+    start = timer()
+    result = evaluator(columns) if evaluator is not None else None
+    if result is None:
+        result = sqlite_filter(query, tuples, schema, table)
+    filter_time = timer() - start
+    return result, [rewriting_time, execute_time, decrypt_time, create_time, filter_time]
 
 
 def decrypt(row, box):
@@ -261,10 +266,10 @@ if __name__ == '__main__':
     parser.add_argument('-c',
                         '--compression',
                         metavar='ALGORITHM',
-                        choices=['none', 'lz4', 'snappy', 'zstd'],
+                        choices=['none', 'lz4', 'snappy', 'zstd', 'zstd-dict'],
                         default='zstd',
                         help='compression algorithm: none, lz4, snappy, zstd '
-                             '(default)')
+                             '(default), zstd-dict (trained dictionary)')
     parser.add_argument('-k',
                         '--kvstore',
                         metavar='KVSTORE_URL',
@@ -287,10 +292,10 @@ if __name__ == '__main__':
     parser.add_argument('-s',
                         '--serialization',
                         metavar='FORMAT',
-                        choices=['json', 'msgpack', 'pickle'],
+                        choices=['columnar', 'json', 'msgpack', 'pickle'],
                         default='json',
-                        help='serialization format: json (default), msgpack, '
-                             'pickle')
+                        help='serialization format: columnar, json (default), '
+                             'msgpack, pickle')
     parser.add_argument('-t',
                         '--type',
                         metavar='TYPE',
@@ -309,7 +314,7 @@ if __name__ == '__main__':
     representation = args.representation
     pw = args.password.encode("utf-8") if args.password else None
     deserialize = DESERIALIZE[args.serialization]
-    decompress = DECOMPRESS[args.compression]
+    decompress = DECOMPRESS.get(args.compression)
 
     if type not in MAPPINGS:
         parser.error(f"{type} is not a valid mapping type.")
@@ -359,6 +364,10 @@ if __name__ == '__main__':
         key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
         box = nacl.secret.SecretBox(key)
         mapping = MAPPINGS[type](path, key)
+        if args.compression == "zstd-dict":
+            dictionary = zstd_dictionary.load(zstd_dictionary.path_of(path),
+                                              box)
+            decompress = zstd_dictionary.decompressor(dictionary)
 
     # Number of tuples of the dataset
     result = engine.execute("SELECT COUNT(*) FROM plain")
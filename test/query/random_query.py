@@ -21,7 +21,6 @@ import json
 import os
 import pickle
 import re
-import sqlite3
 import sys
 from timeit import default_timer as timer
 
@@ -36,8 +35,14 @@ import sqlalchemy
 import zstd
 from pympler import asizeof
 
+from secure_index import columnar
+from secure_index import dictionary as zstd_dictionary
+from secure_index.filtering import compile_filter
+from secure_index.filtering import sqlite_filter
+from secure_index.filtering import to_columns
 from secure_index.mapping.heterogeneous import HeterogeneousMapping
 from secure_index.rewriting import rewrite as official_rewrite
+from secure_index.sqlparser import parse
 
 
 CHUNK_SIZE= 10000
@@ -49,7 +54,8 @@ MAPPINGS = {
 DESERIALIZE = {
     "json": lambda bytes: json.loads(bytes.decode("utf-8")),
     "pickle": pickle.loads,
-    "msgpack": msgpack.loads
+    "msgpack": msgpack.loads,
+    "columnar": columnar.loads_tuples
 }
 
 DECOMPRESS = {
@@ -159,11 +165,12 @@ def wrapped(engine, query, schema, box, kv_mode=False):
                     if column != "GroupId":
                         columns.append(column)
                 # Query key-value store using indices
-                rows = script(keys=[column for column in columns],
-                              args=[
-                                  ",".join(map(str, kv_store_data[column]))
-                                  for column in columns
-                              ])
+                _, rows = script(keys=[table] + columns,
+                                 args=[
+                                     msgpack.packb(
+                                         list(map(str, kv_store_data[column])))
+                                     for column in columns
+                                 ])
             execute_time = timer() - start
 
             # Compute size of the server-side query result in bytes
@@ -175,21 +182,19 @@ def wrapped(engine, query, schema, box, kv_mode=False):
                 tuples.extend(decrypt(row, box))
             decrypt_time = timer() - start
 
+    # Compile the original query into a vectorized filter
     start = timer()
-    df = pd.DataFrame(tuples, columns=schema)
-    with sqlite3.connect(':memory:') as conn:
-        # Store plaintext tuples in local cache
-        df.to_sql(table, conn, if_exists='replace', index=False,
-                  method='multi', chunksize=10000)
-        create_time = timer() - start
-
-        # Run original query on the local cache
-        start = timer()
-        cursor = conn.cursor()
-        cursor.execute(query)
-        columns = [description[0] for description in cursor.description]
-        result = pd.DataFrame(cursor.fetchall(), columns=columns)
-        filter_time = timer() - start
+    evaluator = compile_filter(parse(query))
+    columns = to_columns(tuples, schema) if evaluator is not None else None
+    create_time = timer() - start
+
+    # Run original query on the plaintext tuples (falling back to SQLite
+    # when the query is not supported)
+    start = timer()
+    result = evaluator(columns) if evaluator is not None else None
+    if result is None:
+        result = sqlite_filter(query, tuples, schema, table)
+    filter_time = timer() - start
 
     # Keep track of the number of encrypted tuples
     nof_enctuples = len(rows)
@@ -280,10 +285,10 @@ if __name__ == '__main__':
     parser.add_argument('-c',
                         '--compression',
                         metavar='ALGORITHM',
-                        choices=['none', 'lz4', 'snappy', 'zstd'],
+                        choices=['none', 'lz4', 'snappy', 'zstd', 'zstd-dict'],
                         default='zstd',
                         help='compression algorithm: none, lz4, snappy, zstd '
-                             '(default)')
+                             '(default), zstd-dict (trained dictionary)')
     parser.add_argument('-k',
                         '--kvstore',
                         action='store_true',
@@ -311,10 +316,10 @@ if __name__ == '__main__':
                         help='size of the sample of queries to pick')
     parser.add_argument('--serialization',
                         metavar='FORMAT',
-                        choices=['json', 'msgpack', 'pickle'],
+                        choices=['columnar', 'json', 'msgpack', 'pickle'],
                         default='json',
-                        help='serialization format: json (default), msgpack, '
-                             'pickle')
+                        help='serialization format: columnar, json (default), '
+                             'msgpack, pickle')
     parser.add_argument('-t',
                         '--type',
                         metavar='TYPE',
@@ -328,7 +333,7 @@ if __name__ == '__main__':
     output = args.output
 
     # Optional flags and parameters
-    decompress = DECOMPRESS[args.compression]
+    decompress = DECOMPRESS.get(args.compression)
     kvstore = args.kvstore
     path = args.mapping
     pw = args.password.encode("utf-8") if args.password else None
@@ -378,6 +383,10 @@ if __name__ == '__main__':
         key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
         box = nacl.secret.SecretBox(key)
         mapping = MAPPINGS[type](path, key)
+        if args.compression == "zstd-dict":
+            dictionary = zstd_dictionary.load(zstd_dictionary.path_of(path),
+                                              box)
+            decompress = zstd_dictionary.decompressor(dictionary)
 
     print("[*] Evaluate performance of queries")
     df = pd.read_csv(queries)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Check that rewriting is thread-safe and fork-safe.
+
+The queries of the logs are rewritten with the HeterogeneousMapping, then
+concurrently by several threads and by forked processes sharing a single
+SharedMapping, and every rewritten query is compared with the expected one.
+"""
+
+import argparse
+import getpass
+import multiprocessing as mp
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import nacl.pwhash
+import nacl.secret
+import pandas as pd
+
+from secure_index.mapping.heterogeneous import HeterogeneousMapping
+from secure_index.mapping.shared import SharedMapping
+from secure_index.rewriting import rewrite
+
+
+def rewrite_all(mapping, queries):
+    """Rewrite the queries, recording the error of the unsupported ones."""
+    rewritten = []
+    for query in queries:
+        try:
+            rewritten.append(rewrite(query, mapping)[0])
+        except Exception as e:
+            rewritten.append(f"error: {e}")
+    return rewritten
+
+
+def child(connection):
+    # The shared mapping and the queries are inherited from the parent
+    connection.send(rewrite_all(shared, queries))
+    connection.close()
+
+
+def mismatches(expected, rewritten):
+    return sum(a != b for a, b in zip(expected, rewritten))
+
+
+parser = argparse.ArgumentParser(
+    description='Check that concurrent threads and forked processes sharing ' +
+                'a SharedMapping rewrite queries as the HeterogeneousMapping.'
+)
+parser.add_argument('input', metavar='INPUT', help='path to the mapping')
+parser.add_argument('workload',
+                    metavar='LOG',
+                    nargs='+',
+                    help='query logs (CSV files with a query column, where '
+                         '<TABLE> stands for the wrapped table)')
+parser.add_argument('--password',
+                    help='password necessary to read the mapping')
+parser.add_argument('--processes',
+                    type=int,
+                    default=2,
+                    help='number of forked processes (default: 2)')
+parser.add_argument('--threads',
+                    type=int,
+                    default=8,
+                    help='number of concurrent threads (default: 8)')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    pw = args.password.encode("utf-8") if args.password else None
+    if not pw:
+        pw = getpass.getpass("Password: ").encode("utf-8")
+    salt = b'\xd0\xe1\x03\xc2Z<R\xaf]\xfe\xd5\xbf\xf8u|\x8f'
+    # Generate the key
+    kdf = nacl.pwhash.argon2id.kdf
+    key = kdf(nacl.secret.SecretBox.KEY_SIZE, pw, salt)
+
+    mapping = HeterogeneousMapping(args.input, key)
+    shared = SharedMapping.of(mapping)
+
+    queries = []
+    for path in args.workload:
+        df = pd.read_csv(path)
+        queries.extend(query.replace("<TABLE>", "wrapped")
+                       for query in df["query"])
+    print(f"[*] Rewrite {len(queries)} queries")
+    expected = rewrite_all(mapping, queries)
+
+    failed = False
+
+    print(f"[*] Rewrite them in {args.threads} threads")
+    with ThreadPoolExecutor(args.threads) as pool:
+        results = list(pool.map(lambda _: rewrite_all(shared, queries),
+                                range(args.threads)))
+    for i, rewritten in enumerate(results):
+        wrong = mismatches(expected, rewritten)
+        if wrong:
+            print(f"ERROR: thread {i} rewrote {wrong} queries differently")
+            failed = True
+
+    print(f"[*] Rewrite them in {args.processes} forked processes")
+    context = mp.get_context("fork")
+    pipes = []
+    for _ in range(args.processes):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=child, args=(sender,))
+        process.start()
+        sender.close()
+        pipes.append((process, receiver))
+    for i, (process, receiver) in enumerate(pipes):
+        rewritten = receiver.recv()
+        process.join()
+        wrong = mismatches(expected, rewritten)
+        if wrong or process.exitcode:
+            print(f"ERROR: process {i} rewrote {wrong} queries differently")
+            failed = True
+
+    shared.close()
+    if failed:
+        sys.exit(1)
+    print("[*] Every rewritten query matches")
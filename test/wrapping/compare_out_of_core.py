@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Copyright 2022 Unibg Seclab (https://seclab.unibg.it)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Check that wrapping out of core yields the same groups as in memory.
+
+The dataset is wrapped by script/wrap.py in memory and with --memory, then
+the groups of both outputs are decrypted and their plaintext tuples compared
+GroupId by GroupId. Tuples are compared by their representation, so that
+values serialized differently (e.g., 1 and 1.0) are told apart.
+"""
+
+import argparse
+import base64
+import getpass
+import os
+import subprocess
+import sys
+import tempfile
+
+import nacl.pwhash
+import nacl.secret
+import pandas as pd
+
+from secure_index.client import QueryClient
+from secure_index.mapping.heterogeneous import HeterogeneousMapping
+
+
+""" USAGE
+./compare_out_of_core.py datasets/usa2019/usa2019.csv datasets/usa2019/usa2019_10.csv datasets/usa2019/usa2019_10.enc --memory 1"""
+
+ROOT = os.path.realpath(os.path.join(__file__, "..", "..", ".."))
+
+
+def wrap(args, output, memory=None):
+    command = [sys.executable,
+               os.path.join(ROOT, "script", "wrap.py"),
+               args.dataset,
+               args.anonymized,
+               args.mapping,
+               output,
+               "--compression", args.compression,
+               "--password", args.password,
+               "--serialization", args.serialization]
+    if memory is not None:
+        command.extend(["--memory", str(memory)])
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+
+def groups_of(client, output):
+    """Return the sorted representations of the tuples of each group."""
+    df = pd.read_csv(output)
+    return {gid: sorted(map(repr, client.decrypt(base64.b64decode(enc))))
+            for gid, enc in zip(df["GroupId"], df["EncTuples"])}
+
+
+parser = argparse.ArgumentParser(
+    description='Check that the out of core wrapping produces the same ' +
+                'group plaintexts as the in-memory one.'
+)
+parser.add_argument('dataset', metavar='DATASET',
+                    help='path to the plain dataset')
+parser.add_argument('anonymized', metavar='ANONIMIZED',
+                    help='path to the anonymized dataset')
+parser.add_argument('mapping', metavar='MAPPING',
+                    help='path to the encrypted mapping')
+parser.add_argument('-c',
+                    '--compression',
+                    metavar='ALGORITHM',
+                    choices=['none', 'lz4', 'snappy', 'zstd'],
+                    default='zstd',
+                    help='compression algorithm: none, lz4, snappy, zstd '
+                         '(default)')
+parser.add_argument('--memory',
+                    metavar='MB',
+                    type=float,
+                    default=1,
+                    help='megabytes of tuples in memory of the out of core '
+                         'wrapping (default: 1)')
+parser.add_argument('--password',
+                    help='password necessary to read the mapping')
+parser.add_argument('-s',
+                    '--serialization',
+                    metavar='FORMAT',
+                    choices=['columnar', 'json', 'msgpack', 'pickle'],
+                    default='json',
+                    help='serialization format: columnar, json (default), '
+                         'msgpack, pickle')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if not args.password:
+        args.password = getpass.getpass("Password: ")
+    salt = b'\xd0\xe1\x03\xc2Z<R\xaf]\xfe\xd5\xbf\xf8u|\x8f'
+    # Generate the key
+    kdf = nacl.pwhash.argon2id.kdf
+    key = kdf(nacl.secret.SecretBox.KEY_SIZE, args.password.encode("utf-8"),
+              salt)
+    box = nacl.secret.SecretBox(key)
+
+    mapping = HeterogeneousMapping(args.mapping, key)
+    client = QueryClient(mapping,
+                         box,
+                         None,
+                         serialization=args.serialization,
+                         compression=args.compression)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print("[*] Wrap in memory")
+        in_memory = os.path.join(directory, "in-memory.csv")
+        wrap(args, in_memory)
+        print(f"[*] Wrap out of core with {args.memory} MB")
+        out_of_core = os.path.join(directory, "out-of-core.csv")
+        wrap(args, out_of_core, args.memory)
+
+        expected = groups_of(client, in_memory)
+        groups = groups_of(client, out_of_core)
+
+    failed = False
+    if expected.keys() != groups.keys():
+        print("ERROR: the wrappings hold different groups")
+        failed = True
+    different = [gid for gid in expected.keys() & groups.keys()
+                 if expected[gid] != groups[gid]]
+    for gid in different[:10]:
+        print(f"ERROR: group {gid} differs")
+        print(f"  in memory:   {expected[gid][:3]}")
+        print(f"  out of core: {groups[gid][:3]}")
+    if different:
+        print(f"ERROR: {len(different)} groups differ")
+        failed = True
+
+    client.close()
+    if failed:
+        sys.exit(1)
+    print(f"[*] The {len(groups)} groups match")